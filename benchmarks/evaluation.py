@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""Compare the evaluator backends (see --evaluator) on some specifications.
+
+For each query in each specification file, this enumerates expressions up to
+a small size (as the synthesizer would) over a few examples from the solver,
+and then times how long it takes to fingerprint all of the cached
+expressions with each backend.  The "cold" numbers include compiling every
+expression; the "warm" numbers reuse the compiled programs.  Expressions that
+the column-at-a-time evaluator handles are evaluated the same way by both
+backends.
+
+Usage:
+
+    python -m benchmarks.evaluation examples/*.ds
+"""
+
+import contextlib
+import io
+import sys
+import time
+
+from cozy.target_syntax import EEq, ENot, EAll
+from cozy import parse, typecheck, desugar, invariant_preservation, syntax_tools, synthesis
+from cozy.evaluation import evaluator, compiled_programs, uneval
+from cozy.solver import solver_for_context
+from cozy.cost_model import CostModel
+from cozy.pools import RUNTIME_POOL
+from cozy.synthesis.enumeration import Enumerator, Fingerprint
+
+def find_examples(context, assumptions, num_examples : int):
+    solver = solver_for_context(context, assumptions=assumptions)
+    vars = [v for (v, p) in context.vars()]
+    examples = []
+    while len(examples) < num_examples:
+        different = []
+        for ex in examples:
+            same = []
+            for v in vars:
+                try:
+                    same.append(EEq(v, uneval(v.type, ex[v.id])))
+                except NotImplementedError:
+                    pass
+            different.append(ENot(EAll(same)))
+        ex = solver.satisfy(EAll(different))
+        if ex is None:
+            break
+        examples.append(ex)
+    return examples
+
+def fingerprint_all(workload):
+    return [Fingerprint.of(e, examples) for (e, examples) in workload]
+
+def measure(f):
+    start = time.perf_counter()
+    res = f()
+    return res, time.perf_counter() - start
+
+def benchmark(files : [str], max_size : int = 1, num_examples : int = 8):
+    saved = evaluator.value
+    print("{:<24} {:>6} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "file", "exps", "examples", "stack cold", "stack warm", "py cold", "py warm"))
+    try:
+        for fname in files:
+            with open(fname) as f:
+                ast = parse.parse_spec(f.read())
+            if typecheck.typecheck(ast):
+                print("{:<24} (does not typecheck)".format(fname[-24:]))
+                continue
+            workload = []
+            with contextlib.redirect_stdout(io.StringIO()):
+                ast = desugar.desugar(ast)
+                ast = invariant_preservation.add_implicit_handle_assumptions(ast)
+                ast = syntax_tools.inline_calls(ast)
+                impl = synthesis.construct_initial_implementation(ast)
+                for q in impl.query_specs:
+                    context = impl.context_for_method(q)
+                    assumptions = EAll(q.assumptions)
+                    examples = find_examples(context, assumptions, num_examples)
+                    enumerator = Enumerator(examples, CostModel(funcs=context.funcs(), assumptions=assumptions))
+                    for size in range(max_size + 1):
+                        for e in enumerator.enumerate(context, size, RUNTIME_POOL):
+                            pass
+                    for (pool, ctx), (by_size, _) in enumerator.cache.data.items():
+                        ctx_examples = ctx.instantiate_examples(examples)
+                        workload.extend((entry.e, ctx_examples) for entries in by_size.values() for entry in entries)
+
+            row = []
+            results = []
+            for backend in ("stack", "python"):
+                evaluator.value = backend
+                compiled_programs.clear()
+                res, cold = measure(lambda: fingerprint_all(workload))
+                _, warm = measure(lambda: fingerprint_all(workload))
+                results.append(res)
+                row.extend((cold, warm))
+            assert results[0] == results[1]
+            print("{:<24} {:>6} {:>8} {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms".format(
+                fname[-24:], len(workload), num_examples, *(x * 1000 for x in row)))
+    finally:
+        evaluator.value = saved
+        compiled_programs.clear()
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:])
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""Compare cozy.wire with pickle on some specifications.
+
+For each file, this saves a checkpoint of the initial implementation (as
+`cozy --checkpoint-prefix` does) with both pickle and cozy.wire and reports
+the sizes and the best time of several runs.
+
+Usage:
+
+    python -m benchmarks.wire examples/*.ds
+"""
+
+import contextlib
+import io
+import pickle
+import sys
+import time
+
+from cozy import parse, typecheck, desugar, invariant_preservation, syntax_tools, synthesis
+from cozy import wire
+
+def measure(f, repeat : int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return res, best
+
+def benchmark(files : [str], repeat : int = 5):
+    print("{:<24} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "file", "pickle B", "wire B", "pickle w", "wire w", "pickle r", "wire r"))
+    totals = [0] * 6
+    for fname in files:
+        with open(fname) as f:
+            ast = parse.parse_spec(f.read())
+        if typecheck.typecheck(ast):
+            print("{:<24} (does not typecheck)".format(fname[-24:]))
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            ast = desugar.desugar(ast)
+            ast = invariant_preservation.add_implicit_handle_assumptions(ast)
+            ast = syntax_tools.inline_calls(ast)
+            impl = synthesis.construct_initial_implementation(ast)
+        checkpoint = synthesis.Checkpoint(impl, {})
+
+        pickled, pickle_w = measure(lambda: pickle.dumps(checkpoint, protocol=pickle.HIGHEST_PROTOCOL), repeat)
+        _, pickle_r = measure(lambda: pickle.loads(pickled), repeat)
+        encoded, wire_w = measure(lambda: wire.encode(checkpoint), repeat)
+        _, wire_r = measure(lambda: wire.decode(encoded), repeat)
+
+        row = [len(pickled), len(encoded), pickle_w, wire_w, pickle_r, wire_r]
+        for i, x in enumerate(row):
+            totals[i] += x
+        print("{:<24} {:>10} {:>10} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms".format(
+            fname[-24:], row[0], row[1], *(x * 1000 for x in row[2:])))
+    print("{:<24} {:>10} {:>10} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms".format(
+        "total", totals[0], totals[1], *(x * 1000 for x in totals[2:])))
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:])
@@ -294,6 +294,9 @@ class FrozenDict(_FrozenDict):
     def __repr__(self):
         return "FrozenDict({!r})".format(list(self.items()))
 
+    def __reduce__(self):
+        return (type(self), (list(self.items()),))
+
 _name_counter = Value(ctypes.c_uint64, 0)
 
 def fresh_name(hint : str = "name", omit : {str} = ()) -> str:
@@ -48,7 +48,7 @@ from cozy.common import OrderedSet, unique, Visitor, save_property
 from cozy.syntax import TFunc, TBag, Exp, EVar, EAll, ESingleton
 from cozy.target_syntax import EDeepIn
 from cozy.evaluation import eval
-from cozy.syntax_tools import pprint, alpha_equivalent, free_vars, subst, BottomUpRewriter
+from cozy.syntax_tools import pprint, alpha_equivalent, alpha_key, free_vars, subst, BottomUpRewriter
 from cozy.pools import Pool, RUNTIME_POOL, STATE_POOL
 
 class Context(object):
@@ -126,6 +126,17 @@ class Context(object):
         """
         raise NotImplementedError()
 
+    def alpha_key(self):
+        """Return a hashable key that respects alpha equivalence.
+
+        Contexts with the same key are alpha equivalent, so the key can be
+        used to look up an alpha-equivalent context in a dictionary instead
+        of calling `alpha_equivalent` on every candidate.  (Like
+        syntax_tools.alpha_key, the key also distinguishes contexts whose
+        bags have different types.)
+        """
+        raise NotImplementedError()
+
     def adapt(self, e : Exp, ctx, e_fvs : {EVar} = None) -> Exp:
         """
         If expression `e` is legal in context `ctx` and this context is
@@ -180,6 +191,8 @@ class RootCtx(Context):
         return examples
     def alpha_equivalent(self, other):
         return self == other
+    def alpha_key(self):
+        return self
     def adapt(self, e : Exp, ctx, e_fvs=None) -> Exp:
         if self == ctx:
             return e
@@ -221,6 +234,7 @@ class UnderBinder(Context):
         self.var = v
         self.bag = bag
         self.pool = bag_pool
+        self._alpha_key = None
     def vars(self):
         return self._parent.vars() | {(self.var, self.pool)}
     def funcs(self):
@@ -247,6 +261,21 @@ class UnderBinder(Context):
         if not self._parent.alpha_equivalent(other._parent):
             return False
         return alpha_equivalent(self.bag, self._parent.adapt(other.bag, other._parent))
+    def alpha_key(self):
+        # (contexts from older versions lack the _alpha_key attribute)
+        k = getattr(self, "_alpha_key", None)
+        if k is None:
+            # The bag may mention the binders of enclosing contexts; those
+            # are numbered from the outermost one.
+            binders = []
+            ctx = self._parent
+            while isinstance(ctx, UnderBinder):
+                binders.append(ctx.var)
+                ctx = ctx._parent
+            binders.reverse()
+            k = (self._parent.alpha_key(), self.var.type, self.pool, alpha_key(self.bag, bound_vars=binders))
+            self._alpha_key = k
+        return k
     def adapt(self, e : Exp, ctx, e_fvs=None) -> Exp:
         if self == ctx:
             return e
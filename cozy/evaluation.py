@@ -5,16 +5,31 @@ Important functions:
  - eval_bulk: execute the same expression in many different environments
 """
 
+import builtins
+from collections import namedtuple, OrderedDict
 from functools import cmp_to_key, lru_cache
 import itertools
+import operator
 from fractions import Fraction
 
 from cozy.target_syntax import *
-from cozy.syntax_tools import pprint, free_vars, free_funcs, purify
+from cozy.syntax_tools import pprint, free_vars, free_funcs, purify, alpha_key
 from cozy.common import FrozenDict, OrderedSet, extend, unique
 from cozy.typecheck import is_numeric, is_collection
 from cozy.structures import extension_handler
 from cozy.value_types import Map, Bag, Handle, compare_values, values_equal, LT, EQ, GT
+from cozy.opts import Option
+
+evaluation_cache_size = Option("evaluation-cache-size", int, 4096,
+    description="Number of compiled expressions that the evaluator keeps "
+        + "for reuse.",
+    metavar="N")
+evaluator = Option("evaluator", str, "stack",
+    description="How to evaluate expressions: \"stack\" runs a stack "
+        + "machine, while \"python\" translates each expression to Python "
+        + "source code and compiles it.  Compiling takes longer, but the "
+        + "result runs faster.",
+    metavar="stack|python")
 
 def eval(e : Exp, env : {str:object}, *args, **kwargs):
     """Evaluate an expression in an environment.
@@ -53,11 +68,9 @@ def eval_bulk(
     if not envs:
         return []
 
-    e = purify(e)
-    ops = []
-    types = { v.id : v.type for v in free_vars(e) }
-    vars = OrderedSet(itertools.chain(types.keys(), free_funcs(e).keys()))
-    vmap = { v : i for (i, v) in enumerate(vars) }
+    program = compiled_programs.lookup(e)
+    vars = program.vars
+    types = program.types
 
     try:
         envs = [ [(env.get(v, mkval(types[v])) if (use_default_values_for_undefined_vars and v in types) else env[v]) for v in vars] for env in envs ]
@@ -67,9 +80,80 @@ def eval_bulk(
         print("e = {}".format(pprint(e)), file=sys.stderr)
         print("eval_bulk({!r}, {!r}, use_default_values_for_undefined_vars={!r})".format(e, envs, use_default_values_for_undefined_vars), file=sys.stderr)
         raise
-    _compile(e, vmap, ops)
+    if len(envs) > 1 and program.columns is not None:
+        return list(program.columns(list(zip(*envs)), len(envs)))
+    if program.python is not None:
+        return program.python(envs)
+    ops = program.ops
     return [_eval_compiled(ops, env) for env in envs]
 
+# A compiled expression.
+_Program = namedtuple("_Program", (
+    "vars",     # names of the free variables and functions, in environment order
+    "types",    # types of the free variables
+    "ops",      # the program for the stack machine (see `_compile`), or None if there is a Python version
+    "columns",  # the column-at-a-time version, or None (see `_compile_columns`)
+    "python"))  # the Python version, or None (see `_compile_python`)
+
+class _ProgramCache(object):
+    """A bounded cache of compiled expressions, least recently used first.
+
+    Entries are keyed by `alpha_key`, so alpha-equivalent expressions (e.g.
+    the same predicate built with fresh binders on every call) share one
+    compiled program.
+    """
+
+    def __init__(self):
+        self.programs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, e : Exp) -> _Program:
+        """Get the compiled program for an expression, compiling it if needed."""
+        key = (evaluator.value, alpha_key(e))
+        programs = self.programs
+        try:
+            program = programs.get(key)
+        except TypeError:
+            # Some hand-built trees are unhashable, e.g. TEnum(["A", "B"]).
+            self.misses += 1
+            return _compile_program(e)
+        if program is not None:
+            self.hits += 1
+            programs.move_to_end(key)
+            return program
+        self.misses += 1
+        program = _compile_program(e)
+        programs[key] = program
+        limit = max(evaluation_cache_size.value, 1)
+        while len(programs) > limit:
+            programs.popitem(last=False)
+        return program
+
+    def clear(self):
+        self.programs.clear()
+
+# Programs compiled by eval_bulk.  The `hits` and `misses` counters on this
+# object show how well the cache works.
+compiled_programs = _ProgramCache()
+
+def _compile_program(e : Exp) -> _Program:
+    e = purify(e)
+    types = { v.id : v.type for v in free_vars(e) }
+    vars = tuple(OrderedSet(itertools.chain(types.keys(), free_funcs(e).keys())))
+    vmap = { v : i for (i, v) in enumerate(vars) }
+    if evaluator.value == "python":
+        python = _compile_python(e, vmap)
+    elif evaluator.value == "stack":
+        python = None
+    else:
+        raise ValueError("unknown evaluator {!r}".format(evaluator.value))
+    ops = None
+    if python is None:
+        ops = []
+        _compile(e, vmap, ops)
+    return _Program(vars, types, ops, _compile_columns(e, vmap), python)
+
 @lru_cache(maxsize=None)
 def mkval(type : Type):
     """
@@ -412,6 +496,349 @@ def list_slice(stk):
     stk.append(l[start:end])
 
 _EMPTY_BAG = Bag()
+# Types whose values compare_values compares with Python's own operators.
+_PRIMITIVE_COLUMN_TYPES = (TInt, TLong, TFloat, TBool, TString)
+
+_COMPARISONS = {
+    "==":  operator.eq,
+    "===": operator.eq,
+    "!=":  operator.ne,
+    "<":   operator.lt,
+    "<=":  operator.le,
+    ">":   operator.gt,
+    ">=":  operator.ge }
+
+_ARITHMETIC = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul }
+
+def _compile_columns(e, env : {str:int}):
+    """Compile an expression to run on all environments at once.
+
+    This is an alternative to `_compile` for expressions whose every
+    subexpression has a primitive scalar type (e.g. arithmetic and
+    comparisons over integer variables).  Instead of running a program once
+    per environment, the returned function takes a list of columns (one
+    sequence of values per variable in `env`) and the number of
+    environments, and returns the column of results.  It does one
+    list-at-a-time operation per node.
+
+    Returns None if the expression is not supported.
+    """
+    t = getattr(e, "type", None)
+    if not (isinstance(t, _PRIMITIVE_COLUMN_TYPES) or isinstance(t, TEnum)):
+        return None
+    if isinstance(e, EVar):
+        i = env.get(e.id)
+        if not isinstance(i, int):
+            return None
+        return lambda cols, n: cols[i]
+    if isinstance(e, (EBool, ENum, EStr, EEnumEntry)):
+        if isinstance(e, EEnumEntry):
+            val = e.name
+        elif isinstance(e, ENum) and t == FLOAT:
+            val = Fraction(str(e.val))
+        else:
+            val = e.val
+        return lambda cols, n: [val] * n
+    if isinstance(e, EStateVar):
+        return _compile_columns(e.e, env)
+    if isinstance(e, ECond):
+        cond = _compile_columns(e.cond, env)
+        then_branch = _compile_columns(e.then_branch, env)
+        else_branch = _compile_columns(e.else_branch, env)
+        if cond is None or then_branch is None or else_branch is None:
+            return None
+        return lambda cols, n: [x if c else y for (c, x, y) in zip(cond(cols, n), then_branch(cols, n), else_branch(cols, n))]
+    if isinstance(e, EUnaryOp):
+        arg = _compile_columns(e.e, env)
+        if arg is None:
+            return None
+        if e.op == UOp.Not:
+            return lambda cols, n: [not x for x in arg(cols, n)]
+        if e.op == "-":
+            return lambda cols, n: map(operator.neg, arg(cols, n))
+        return None
+    if isinstance(e, EBinOp):
+        lhs = _compile_columns(e.e1, env)
+        rhs = _compile_columns(e.e2, env)
+        if lhs is None or rhs is None:
+            return None
+        # These match the ECond translations in `_compile`.
+        if e.op == BOp.And:
+            return lambda cols, n: [y if x else False for (x, y) in zip(lhs(cols, n), rhs(cols, n))]
+        if e.op == BOp.Or:
+            return lambda cols, n: [True if x else y for (x, y) in zip(lhs(cols, n), rhs(cols, n))]
+        if e.op == "=>":
+            return lambda cols, n: [y if x else True for (x, y) in zip(lhs(cols, n), rhs(cols, n))]
+        f = _ARITHMETIC.get(e.op)
+        if f is not None:
+            return lambda cols, n: map(f, lhs(cols, n), rhs(cols, n))
+        f = _COMPARISONS.get(e.op)
+        if f is not None:
+            arg_type = e.e1.type
+            if isinstance(arg_type, TEnum):
+                # enums are ordered by their position in the declaration
+                index = { case : i for (i, case) in enumerate(arg_type.cases) }
+                return lambda cols, n: [f(index[x], index[y]) for (x, y) in zip(lhs(cols, n), rhs(cols, n))]
+            return lambda cols, n: map(f, lhs(cols, n), rhs(cols, n))
+        return None
+    return None
+
+def _lift(op):
+    """Turn a stack-machine operator into a function of its operands."""
+    def lifted(*args):
+        stk = list(args)
+        op(stk)
+        return stk[-1]
+    return lifted
+
+def _arg_best(bag, key, better, default):
+    """The first element of `bag` whose key no other element is `better` than."""
+    if not bag:
+        return default
+    it = iter(bag)
+    best = next(it)
+    best_key = key(best)
+    for x in it:
+        k = key(x)
+        if better(k, best_key):
+            best = x
+            best_key = k
+    return best
+
+def _make_map(t, default, pairs):
+    res = Map(t, default)
+    for (k, v) in pairs:
+        res[k] = v
+    return res
+
+# Python operators that agree with compare_values on primitive types.
+_PYTHON_COMPARISONS = {
+    "==":  "==",
+    "===": "==",
+    "!=":  "!=",
+    "<":   "<",
+    "<=":  "<=",
+    ">":   ">",
+    ">=":  ">=" }
+
+_STACK_COMPARISONS = {
+    "==":  binaryop_eq,
+    "===": lambda t: binaryop_eq(t, deep=True),
+    "!=":  binaryop_ne,
+    "<":   binaryop_lt,
+    "<=":  binaryop_le,
+    ">":   binaryop_gt,
+    ">=":  binaryop_ge }
+
+class _PythonCompiler(object):
+    """Translates an expression to the source of a Python expression.
+
+    Free variables become the locals `_v0`, `_v1`, ... in environment order
+    and binders become comprehension variables or lambda parameters.  Values
+    that have no convenient literal syntax, and the stack machine's more
+    complicated operators, are passed in as globals.
+    """
+
+    def __init__(self, env : {str:int}):
+        self.names = { v : "_v{}".format(i) for (v, i) in env.items() }
+        self.globals = { "Bag": Bag, "Handle": Handle, "FrozenDict": FrozenDict,
+            "_arg_best": _arg_best, "_make_map": _make_map }
+        self.counter = 0
+
+    def fresh(self, prefix : str) -> str:
+        self.counter += 1
+        return "{}{}".format(prefix, self.counter)
+
+    def const(self, value) -> str:
+        name = self.fresh("_k")
+        self.globals[name] = value
+        return name
+
+    def lift(self, op, *args) -> str:
+        return "{}({})".format(self.const(_lift(op)), ", ".join(args))
+
+    def lam(self, f : ELambda) -> (str, str):
+        """Returns (name of the argument, body)."""
+        arg = self.fresh("_b")
+        with extend(self.names, f.arg.id, arg):
+            return (arg, self.visit(f.body))
+
+    def visit(self, e) -> str:
+        res = self.visit_node(e)
+        if hasattr(e, "type") and isinstance(e.type, TList):
+            res = "tuple({})".format(res)
+        return res
+
+    def visit_node(self, e) -> str:
+        if isinstance(e, EVar):
+            return self.names[e.id]
+        if isinstance(e, EBool):
+            return "True" if e.val else "False"
+        if isinstance(e, ENum):
+            return self.const(Fraction(str(e.val)) if e.type == FLOAT else e.val)
+        if isinstance(e, EStr):
+            return self.const(e.val)
+        if isinstance(e, EEnumEntry):
+            return self.const(e.name)
+        if isinstance(e, EEmptyList):
+            return self.const(_EMPTY_BAG)
+        if isinstance(e, ESingleton):
+            x = self.visit(e.e)
+            return "({},)".format(x) if isinstance(e.type, TList) else "Bag(({},))".format(x)
+        if isinstance(e, EHandle):
+            return "Handle({}, {})".format(self.visit(e.addr), self.visit(e.value))
+        if isinstance(e, ENull):
+            return "None"
+        if isinstance(e, ECond):
+            return "({} if {} else {})".format(self.visit(e.then_branch), self.visit(e.cond), self.visit(e.else_branch))
+        if isinstance(e, EMakeRecord):
+            # the stack machine builds the pairs in reverse order
+            return "FrozenDict(({},))".format(", ".join(
+                "({}, {})".format(self.const(f), self.visit(ee)) for (f, ee) in reversed(e.fields)))
+        if isinstance(e, EGetField):
+            if isinstance(e.e.type, THandle):
+                return "{}.value".format(self.visit(e.e))
+            return "{}[{}]".format(self.visit(e.e), self.const(e.field_name))
+        if isinstance(e, ETuple):
+            return "({},)".format(", ".join(self.visit(ee) for ee in e.es)) if e.es else "()"
+        if isinstance(e, ETupleGet):
+            return "{}[{}]".format(self.visit(e.e), int(e.index))
+        if isinstance(e, EStateVar):
+            return self.visit(e.e)
+        if isinstance(e, ENative):
+            return "({}, {})".format(self.const(e.type.name), self.visit(e.e))
+        if isinstance(e, EUnaryOp):
+            x = self.visit(e.e)
+            if e.op == UOp.Not or e.op == UOp.Empty:
+                return "(not {})".format(x)
+            if e.op == UOp.Sum:
+                return "sum({})".format(x)
+            if e.op == UOp.Exists:
+                return "bool({})".format(x)
+            if e.op == UOp.All:
+                return "all({})".format(x)
+            if e.op == UOp.Any:
+                return "any({})".format(x)
+            if e.op == UOp.Length:
+                return "len({})".format(x)
+            if e.op == UOp.AreUnique:
+                return self.lift(unaryop_areunique(e.e.type.elem_type), x)
+            if e.op == UOp.Distinct:
+                return self.lift(unaryop_distinct(e.e.type.elem_type), x)
+            if e.op == UOp.The:
+                v = self.fresh("_t")
+                return "(lambda {v}: {v}[0] if {v} else {default})({x})".format(v=v, x=x, default=self.const(mkval(e.type)))
+            if e.op == UOp.Reversed:
+                return "tuple(reversed({}))".format(x)
+            if e.op == "-":
+                return "(-{})".format(x)
+            raise NotImplementedError(e.op)
+        if isinstance(e, EBinOp):
+            if e.op == BOp.And:
+                return "({} if {} else False)".format(self.visit(e.e2), self.visit(e.e1))
+            if e.op == BOp.Or:
+                return "(True if {} else {})".format(self.visit(e.e1), self.visit(e.e2))
+            if e.op == "=>":
+                return "({} if {} else True)".format(self.visit(e.e2), self.visit(e.e1))
+            x = self.visit(e.e1)
+            y = self.visit(e.e2)
+            t = e.e1.type
+            if e.op == "+":
+                if is_collection(e.type):
+                    return self.lift(binaryop_add_sets if isinstance(e.type, TSet) else binaryop_add_collections, x, y)
+                return "({} + {})".format(x, y)
+            if e.op == "*":
+                return "({} * {})".format(x, y)
+            if e.op == "-":
+                if isinstance(e.type, TBag) or isinstance(e.type, TSet):
+                    return self.lift(binaryop_sub_bags(e.type.elem_type), x, y)
+                if isinstance(e.type, TList):
+                    return self.lift(binaryop_sub_lists(e.type.elem_type), x, y)
+                return "({} - {})".format(x, y)
+            if e.op in _PYTHON_COMPARISONS:
+                if isinstance(t, _PRIMITIVE_COLUMN_TYPES):
+                    return "({} {} {})".format(x, _PYTHON_COMPARISONS[e.op], y)
+                return self.lift(_STACK_COMPARISONS[e.op](t), x, y)
+            if e.op == BOp.In:
+                return self.lift(binaryop_in(t), x, y)
+            raise NotImplementedError(e.op)
+        if isinstance(e, EListGet):
+            return self.lift(list_index(mkval(e.type)), self.visit(e.e), self.visit(e.index))
+        if isinstance(e, EListSlice):
+            return self.lift(list_slice, self.visit(e.e), self.visit(e.start), self.visit(e.end))
+        if isinstance(e, EDropFront):
+            return "{}[1:]".format(self.visit(e.e))
+        if isinstance(e, EDropBack):
+            return "{}[:-1]".format(self.visit(e.e))
+        if isinstance(e, EFilter):
+            bag = self.visit(e.e)
+            arg, body = self.lam(e.predicate)
+            return "Bag([{arg} for {arg} in {bag} if {body}])".format(arg=arg, bag=bag, body=body)
+        if isinstance(e, EMap):
+            bag = self.visit(e.e)
+            arg, body = self.lam(e.transform_function)
+            return "Bag([{body} for {arg} in {bag}])".format(arg=arg, bag=bag, body=body)
+        if isinstance(e, EFlatMap):
+            bag = self.visit(e.e)
+            arg, body = self.lam(e.transform_function)
+            x = self.fresh("_x")
+            return "Bag([{x} for {arg} in {bag} for {x} in {body}])".format(x=x, arg=arg, bag=bag, body=body)
+        if isinstance(e, EArgMin) or isinstance(e, EArgMax):
+            keytype = e.key_function.body.type
+            order = LT if isinstance(e, EArgMin) else GT
+            better = lambda k1, k2: compare_values(keytype, k1, k2) == order
+            arg, body = self.lam(e.key_function)
+            return "_arg_best({}, lambda {}: {}, {}, {})".format(
+                self.visit(e.e), arg, body, self.const(better), self.const(mkval(e.type)))
+        if isinstance(e, EMakeMap2):
+            bag = self.visit(e.e)
+            arg, body = self.lam(e.value_function)
+            return "_make_map({}, {}, [({arg}, {body}) for {arg} in {bag}])".format(
+                self.const(e.type), self.const(mkval(e.type.v)), arg=arg, body=body, bag=bag)
+        if isinstance(e, EMapGet):
+            return "{}[{}]".format(self.visit(e.map), self.visit(e.key))
+        if isinstance(e, EHasKey):
+            return self.lift(has_key(e.key.type), self.visit(e.map), self.visit(e.key))
+        if isinstance(e, EMapKeys):
+            return "Bag({}.keys())".format(self.visit(e.e))
+        if isinstance(e, ECall):
+            return "{}({})".format(self.names[e.func], ", ".join(self.visit(a) for a in e.args))
+        if isinstance(e, ELet):
+            arg, body = self.lam(e.body_function)
+            return "(lambda {}: {})({})".format(arg, body, self.visit(e.e))
+        h = extension_handler(type(e))
+        if h is not None:
+            return self.visit(h.encode(e))
+        raise NotImplementedError(type(e))
+
+def _compile_python(e, env : {str:int}):
+    """Compile an expression to a Python function.
+
+    This is an alternative to `_compile` (see the --evaluator option).  The
+    returned function takes a list of environments (each a list of values in
+    the order given by `env`) and returns the list of results.
+
+    Returns None if the expression cannot be translated.
+    """
+    compiler = _PythonCompiler(env)
+    try:
+        body = compiler.visit(e)
+    except NotImplementedError:
+        return None
+    if env:
+        params = "({},)".format(", ".join("_v{}".format(i) for i in sorted(env.values())))
+    else:
+        params = "_"
+    source = "lambda _envs: [{} for {} in _envs]".format(body, params)
+    try:
+        return builtins.eval(compile(source, "<cozy expression>", "eval"), compiler.globals)
+    except (SyntaxError, RecursionError, MemoryError):
+        # e.g. "too many nested parentheses"
+        return None
+
 def _compile(e, env : {str:int}, out):
     if isinstance(e, EVar):
         i = env[e.id]
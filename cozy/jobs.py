@@ -1,23 +1,69 @@
 """Helper class to implement interruptable tasks."""
 
-from multiprocessing import Process, Array, Queue
-from queue import Queue as PlainQueue, Empty, Full
+import datetime
+import os
 import threading
+import weakref
+from multiprocessing import Process, Array, Queue, Pipe
+from multiprocessing.connection import wait
+from multiprocessing.util import Finalize
+from queue import Empty
 
 from cozy.opts import Option
 
 do_profiling = Option("profile", bool, False, description="Profile Cozy itself")
 
+# Jobs are not daemonic processes, since daemonic processes may not start
+# processes of their own (such as --enumeration-workers or --solver-processes
+# workers).  Instead, the jobs that a process started and that are still
+# alive when it exits are killed before multiprocessing waits for them.
+_live_jobs = weakref.WeakSet()
+_reaper_pid = None
+
+def _kill_live_jobs():
+    for j in list(_live_jobs):
+        if j._thread.exitcode is None:
+            j.kill()
+            j.join()
+
+def _track(job):
+    global _reaper_pid
+    if _reaper_pid != os.getpid():
+        # (forked processes start with no finalizers)
+        _live_jobs.clear()
+        Finalize(None, _kill_live_jobs, exitpriority=20)
+        _reaper_pid = os.getpid()
+    _live_jobs.add(job)
+
 class Job(object):
     def __init__(self):
-        self._thread = Process(target=self._run, daemon=True)
+        self._thread = Process(target=self._run)
         self._flags = Array("b", [False] * 3)
         # flags[0] - stop_requested?
         # flags[1] - done?
         # flags[2] - true iff completed with no exception
+        # The channels to and from the job are created by `start` and closed
+        # once the job has exited (see `_finish`), so jobs that are waiting
+        # to start or that are long gone hold no pipes open.
+        self._inbox = None
+        self._outbox = None
+        self._outbox_sender = None
+        self._outbox_closed = True
     def start(self):
+        self._inbox = Queue()
+        # The parent should never block on exit because of messages that
+        # the job did not read.
+        self._inbox.cancel_join_thread()
+        # Messages from the job to the parent.  The parent closes its copy of
+        # the sending end once the job starts, so it sees EOF when the job
+        # exits.
+        self._outbox, self._outbox_sender = Pipe(duplex=False)
+        self._outbox_closed = False
         self._thread.start()
+        _track(self)
+        self._outbox_sender.close()
     def _run(self):
+        self._outbox.close()
         try:
             if do_profiling.value:
                 import cProfile
@@ -46,6 +92,65 @@ class Job(object):
     def request_stop(self):
         print("requesting stop for {}".format(self))
         self._flags[0] = True
+    def send(self, message):
+        """Send a message to the running job.
+
+        Call this from the process that started the job.  The job can read
+        its messages using `receive`.  Messages sent after the job has been
+        reaped are dropped.
+        """
+        if self._inbox is not None:
+            self._inbox.put(message)
+    def receive(self):
+        """Return (and forget) all messages sent to this job so far.
+
+        Call this from inside `run`.  It never blocks, and it may miss
+        messages that were sent very recently; those will be returned by a
+        later call.
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self._inbox.get(block=False))
+            except Empty:
+                return messages
+    def report(self, message):
+        """Send a message to the process that started this job.
+
+        Call this from inside `run`.  It may block until the parent reads
+        earlier messages.  The parent receives messages through
+        `JobScheduler.wait` or `stop_jobs`.
+
+        If the message cannot be serialized, this raises an exception and
+        nothing is sent.
+        """
+        self._outbox_sender.send(message)
+    def _collect(self):
+        """Return all messages from the job that can be read without blocking.
+
+        Call this from the process that started the job.
+        """
+        messages = []
+        if self._outbox_closed:
+            return messages
+        try:
+            while self._outbox.poll():
+                messages.append(self._outbox.recv())
+        except EOFError:
+            self._outbox.close()
+            self._outbox_closed = True
+        return messages
+    def _finish(self):
+        """Join the exited job, collect its last messages, and close its channels."""
+        self.join()
+        messages = self._collect()
+        if not self._outbox_closed:
+            self._outbox.close()
+            self._outbox_closed = True
+        if self._inbox is not None:
+            self._inbox.close()
+            self._inbox = None
+        return messages
     def join(self, timeout=None):
         self._thread.join(timeout=timeout)
     def kill(self):
@@ -54,84 +159,284 @@ class Job(object):
     def pid(self):
         return self._thread.pid
 
-def stop_jobs(jobs):
+def wait_for_jobs(jobs, timeout : datetime.timedelta = None, interrupt=None) -> [(Job, object)]:
+    """Wait until one of the given started jobs sends a message or exits.
+
+    Returns the (job, message) pairs that were received, in the order each
+    job sent them.  The result may be empty if a job exited or the timeout
+    expired.  Jobs that have already exited are not waited on.
+
+    If given, `interrupt` is a connection (see multiprocessing.Pipe) that
+    also ends the wait when it becomes readable.  The caller is responsible
+    for reading from it.
+    """
+    waitables = {}
+    for j in jobs:
+        if not j._outbox_closed:
+            waitables[j._outbox] = j
+        if j._thread.exitcode is None:
+            waitables[j._thread.sentinel] = j
+    if interrupt is not None:
+        waitables[interrupt] = None
+    if not waitables:
+        return []
+    if timeout is not None:
+        timeout = max(timeout.total_seconds(), 0)
+    res = []
+    for ready in wait(list(waitables.keys()), timeout=timeout):
+        j = waitables[ready]
+        if j is not None and ready is j._outbox:
+            res.extend((j, m) for m in j._collect())
+    return res
+
+def wait_for_schedulers(schedulers, timeout : datetime.timedelta = None, interrupt=None) -> [[(Job, object)]]:
+    """Wait for messages from the jobs of several JobSchedulers at once.
+
+    Like `JobScheduler.wait`, but returns one list of (job, message) pairs
+    for each scheduler, in the same order as `schedulers`.  See
+    `wait_for_jobs` for the meaning of `interrupt`.
+    """
+    if any(s._mailbox for s in schedulers):
+        timeout = datetime.timedelta(0)
+    owners = {}
+    res = []
+    for i, s in enumerate(schedulers):
+        for j in s.running + s.stopping:
+            owners[j] = i
+        res.append(s._mailbox)
+        s._mailbox = []
+    for (j, m) in wait_for_jobs(list(owners.keys()), timeout, interrupt):
+        res[owners[j]].append((j, m))
+    return res
+
+def stop_jobs(jobs) -> [(Job, object)]:
+    """Stop the given started jobs and wait for them to exit.
+
+    Returns the (job, message) pairs the jobs sent while stopping.
+    """
     jobs = list(jobs)
     for j in jobs:
         j.request_stop()
 
+    res = []
+    deadline = datetime.datetime.now() + datetime.timedelta(seconds=1)
     while jobs:
-        for j in jobs:
-            j.join(timeout=1)
-        jobs = [j for j in jobs if not j.done]
-        if jobs:
+        res.extend(wait_for_jobs(jobs, timeout=deadline - datetime.datetime.now()))
+        for j in [j for j in jobs if j.done and j._thread.exitcode is not None]:
+            res.extend((j, m) for m in j._finish())
+            jobs.remove(j)
+        if jobs and datetime.datetime.now() >= deadline:
             print("Waiting on {} jobs...".format(len(jobs)))
             for j in jobs:
                 print("  --> {} [pid={}]".format(j, j.pid))
+            deadline = datetime.datetime.now() + datetime.timedelta(seconds=1)
+    return res
 
-class SafeQueue(object):
+class JobSlots(object):
+    """A budget of running jobs shared by several JobSchedulers.
+
+    Each scheduler that was given the same JobSlots object takes a slot when
+    it starts a job and gives it back when the job exits, so the schedulers
+    together run at most `n` jobs at once.
     """
-    The multiprocessing.Queue class and its cousins come with a lot of caveats!
-    Use this class if you want to worry less. Specifically:
-        - This queue does not need to be drained to guarantee termination of
-          child processes. From the docs [1]:
-            > ... if a child process has put items on a queue (and it has not used
-            > JoinableQueue.cancel_join_thread), then that process will not terminate
-            > until all buffered items have been flushed to the pipe.
-          This queue uses an auxiliary thread to solve this problem.
-    However:
-        - This queue needs to be closed.
-    Proper usage example:
-        with SafeQueue() as q:
-            # spawn processes to insert items into q
-            # get items from q
-            # join spawned processes
-
-    [1]: https://docs.python.org/3/library/multiprocessing.html#pipes-and-queues
+
+    def __init__(self, n : int):
+        assert n >= 1
+        self.n = n
+        self.available = n
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.available > 0:
+                self.available -= 1
+                return True
+            return False
+
+    def release(self):
+        with self._lock:
+            assert self.available < self.n
+            self.available += 1
+
+class JobScheduler(object):
     """
-    def __init__(self, queue_to_wrap=None):
-        if queue_to_wrap is None:
-            queue_to_wrap = Queue()
-        self.q = queue_to_wrap
-        self.sideq = PlainQueue()
-        self.stop_requested = False
-    def __enter__(self, *args, **kwargs):
-        self.thread = threading.Thread(target=self._copy_items, daemon=True)
-        self.thread.start()
-        return self
-    def __exit__(self, *args, **kwargs):
-        print("Stopping SafeQueue...")
-        self.stop_requested = True
-        self.thread.join()
-        print("Done!")
-    def _copy_items(self):
-        while not self.stop_requested:
-            try:
-                self.sideq.put(self.q.get(timeout=1), timeout=1)
-            except Empty:
-                pass
-            except Full:
-                pass
-    def put(self, item, block=False, timeout=None):
-        return self.q.put(item, block=block, timeout=timeout)
-    def get(self, block=False, timeout=None):
-        return self.sideq.get(block=block, timeout=timeout)
-    def drain(self, block=False, timeout=None):
+    Runs a bounded number of jobs at once.
+
+    Jobs are added with `submit` and started whenever a running slot is free,
+    highest priority first (ties are broken by submission order).  The owner
+    should call `step` periodically; each call reaps finished jobs, preempts
+    jobs that have used up their time slice while other jobs are waiting, and
+    starts pending jobs.
+
+    The `priority(job)` function gives each job a positive weight.  Every
+    running job gets a share of the base time slice proportional to its
+    weight relative to the average weight of all jobs, and when jobs must be
+    preempted the lowest-weight ones go first.  The weights are recomputed on
+    every step, so they may change as jobs make progress.  No job's share is
+    smaller than `min_time_slice` (or the base time slice, if that is
+    smaller), so that low-priority jobs are not preempted as soon as they
+    start.
+
+    A job's time slice restarts every time `note_progress` is called for it,
+    so jobs that keep producing results are not preempted in favor of jobs
+    that have stalled.  When a job is preempted, `respawn(job)` is called
+    (just before the job is asked to stop) to obtain a replacement job that
+    will continue the same work later.  The replacement goes back in the
+    queue.  If `respawn` returns None, the preempted job's work is simply
+    dropped.
+
+    Jobs that have been asked to stop keep occupying their slot until they
+    actually exit, so at most `max_running` processes are alive at any time.
+
+    Messages that jobs send with `Job.report` are returned by `wait`, which
+    blocks until there is something to do: a message arrived, a job exited,
+    or a job's time slice ran out.
+
+    If given, `slots` is a JobSlots object shared with other schedulers;
+    jobs only start when both this scheduler and the shared budget have
+    room for them.
+    """
+
+    def __init__(self, max_running : int, respawn=lambda job: None, priority=lambda job: 1, slots : JobSlots = None, min_time_slice : datetime.timedelta = datetime.timedelta(0)):
+        assert max_running >= 1
+        self.max_running = max_running
+        self.min_time_slice = min_time_slice
+        self.slots = slots
+        self.respawn = respawn
+        self.priority = priority
+        self.pending = []  # submitted but not yet started
+        self.running = []  # started and not asked to stop
+        self.stopping = [] # asked to stop, but have not exited yet
+        self._last_progress = {}
+        self._mailbox = [] # messages collected from jobs as they exited
+
+    def jobs(self):
+        """All jobs whose work is still wanted: pending and running ones."""
+        return self.pending + self.running
+
+    def submit(self, job):
+        self.pending.append(job)
+
+    def cancel(self, jobs):
+        """Drop the given jobs, stopping them if they are running."""
+        for j in jobs:
+            if j in self.pending:
+                self.pending.remove(j)
+            elif j in self.running:
+                self._stop(j)
+
+    def note_progress(self, job, now=None):
+        if job in self.running:
+            self._last_progress[job] = now or datetime.datetime.now()
+
+    def idle_time(self, job, now=None) -> datetime.timedelta:
+        """How long a running job has gone without making progress."""
+        return (now or datetime.datetime.now()) - self._last_progress[job]
+
+    @property
+    def finished(self) -> bool:
+        return not self.pending and not self.running
+
+    def _weights(self):
+        return { j : self.priority(j) for j in self.jobs() }
+
+    def _allowance(self, job, time_slice, weights, average_weight) -> datetime.timedelta:
+        return max(
+            time_slice * (weights[job] / average_weight),
+            min(time_slice, self.min_time_slice))
+
+    def time_until_preemption(self, time_slice : datetime.timedelta, now=None) -> datetime.timedelta:
+        """How long until `step` will preempt a job, or None if it never will.
+
+        The result assumes that no job makes progress in the meantime.
         """
-        Remove all elements currently in the queue and put them in a list,
-        in the order they would have been returned by .get().
+        if not self.pending or not self.running:
+            return None
+        now = now or datetime.datetime.now()
+        weights = self._weights()
+        average_weight = sum(weights.values()) / len(weights)
+        return max(datetime.timedelta(0), min(
+            self._allowance(j, time_slice, weights, average_weight) - self.idle_time(j, now)
+            for j in self.running))
 
-        If block=False (the default), then the timeout is ignored and this
-        method may return an empty list.
+    def wait(self, timeout : datetime.timedelta = None) -> [(Job, object)]:
+        """Wait for messages from running and stopping jobs.
 
-        If block=True, then this function blocks until at least one element is
-        available. If a timeout is also provided, then a queue.Empty exception
-        is raised if no element is available in the given number of seconds.
+        Returns as soon as at least one message arrives or a job exits, or
+        after the timeout.  The result is a list of (job, message) pairs.
         """
-        res = []
-        if block:
-            res.append(self.get(block=True, timeout=timeout))
-        while True:
-            try:
-                res.append(self.get(block=False))
-            except Empty:
-                return res
+        return wait_for_schedulers([self], timeout)[0]
+
+    def step(self, time_slice : datetime.timedelta, now=None) -> [Job]:
+        """Reap, preempt, and start jobs.
+
+        The given time slice is what a job of average priority gets.
+
+        Returns the list of jobs that exited on their own since the last call.
+        """
+        now = now or datetime.datetime.now()
+
+        for j in [j for j in self.stopping if j.done]:
+            self._mailbox.extend((j, m) for m in j._finish())
+            self.stopping.remove(j)
+            self._release_slot()
+
+        exited = [j for j in self.running if j.done]
+        for j in exited:
+            self._mailbox.extend((j, m) for m in j._finish())
+            self.running.remove(j)
+            del self._last_progress[j]
+            self._release_slot()
+
+        weights = self._weights()
+
+        if self.pending:
+            average_weight = sum(weights.values()) / len(weights)
+            stalled = [j for j in self.running
+                if self.idle_time(j, now) >= self._allowance(j, time_slice, weights, average_weight)]
+            stalled.sort(key=lambda j: (weights[j], -self.idle_time(j, now).total_seconds()))
+            for j in stalled[:len(self.pending)]:
+                print("preempting {} [priority={:.2f}] after {} without progress".format(j, weights[j], self.idle_time(j, now)))
+                replacement = self.respawn(j)
+                self._stop(j)
+                if replacement is not None:
+                    self.pending.append(replacement)
+                    weights[replacement] = self.priority(replacement)
+
+        # stable sort: among equal priorities, keep submission order
+        self.pending.sort(key=lambda j: -weights[j])
+        while (self.pending
+                and len(self.running) + len(self.stopping) < self.max_running
+                and (self.slots is None or self.slots.try_acquire())):
+            j = self.pending.pop(0)
+            j.start()
+            self.running.append(j)
+            self._last_progress[j] = now
+
+        return exited
+
+    def stop_all(self) -> [(Job, object)]:
+        """Drop all pending jobs and wait for all running jobs to stop.
+
+        Returns the messages that have not been returned by `wait` yet.
+        """
+        self.pending.clear()
+        to_stop = self.running + self.stopping
+        res = self._mailbox + stop_jobs(to_stop)
+        self._mailbox = []
+        for j in to_stop:
+            self._release_slot()
+        self.running.clear()
+        self.stopping.clear()
+        self._last_progress.clear()
+        return res
+
+    def _release_slot(self):
+        if self.slots is not None:
+            self.slots.release()
+
+    def _stop(self, job):
+        job.request_stop()
+        self.running.remove(job)
+        self.stopping.append(job)
+        del self._last_progress[job]
@@ -5,6 +5,7 @@ Main entry point for Cozy synthesis. Run with --help for options.
 """
 
 from collections import defaultdict
+import contextlib
 import sys
 import argparse
 import datetime
@@ -20,11 +21,104 @@ from cozy import invariant_preservation
 from cozy import synthesis
 from cozy.structures import rewriting
 from cozy import opts
+from cozy import wire
 
 save_failed_codegen_inputs = opts.Option("save-failed-codegen-inputs", str, "/tmp/failed_codegen.py", metavar="PATH")
-checkpoint_prefix = opts.Option("checkpoint-prefix", str, "")
+checkpoint_prefix = opts.Option("checkpoint-prefix", str, "",
+    description="Periodically save synthesis progress to files with this prefix.  "
+        + "Checkpoints can be resumed with --resume.")
+checkpoint_interval = opts.Option("checkpoint-interval", int, 60,
+    description="With --checkpoint-prefix, save a checkpoint at most this "
+        + "often, and once more when synthesis ends.  Checkpoints hold the "
+        + "state of every search, so they can be large.",
+    metavar="SECONDS")
 do_cse = opts.Option("cse", bool, False, description="Perform common subexpression elimination just before codegen")
 
+class InvalidSpecification(Exception):
+    """Raised by `initial_implementation` for specifications with errors."""
+    def __init__(self, errors : [str]):
+        super().__init__("\n".join(str(e) for e in errors))
+        self.errors = errors
+
+def initial_implementation(input_text : str) -> synthesis.Implementation:
+    """Parse and check a specification, and build its initial implementation.
+
+    Raises InvalidSpecification if the specification does not typecheck or
+    fails the invariant checks.
+    """
+    ast = parse.parse_spec(input_text)
+
+    # Collection of errors in user-provided specification
+    errors = typecheck.typecheck(ast)
+    if errors:
+        raise InvalidSpecification(errors)
+
+    ast = desugar.desugar(ast)
+    ast = invariant_preservation.add_implicit_handle_assumptions(ast)
+
+    print("Checking call legality...")
+    call_errors = invariant_preservation.check_calls_wf(ast)
+    ast = syntax_tools.inline_calls(ast)
+
+    print("Checking invariant preservation...")
+    errors = (
+        invariant_preservation.check_ops_preserve_invariants(ast) +
+        invariant_preservation.check_the_wf(ast) +
+        invariant_preservation.check_minmax_wf(ast) +
+        call_errors)
+    if errors:
+        raise InvalidSpecification(errors)
+    print("Done!")
+
+    return synthesis.construct_initial_implementation(ast)
+
+def generate_code(impl : synthesis.Implementation, java=None, unboxed : bool = False, cxx=None, use_qhash : bool = False):
+    """Generate code for an implementation.
+
+    The `java` and `cxx` parameters are writable text files for the Java and
+    C++ output; a language is skipped if its file is None.  The `unboxed` and
+    `use_qhash` flags are the --unboxed and --use-qhash command-line options.
+    """
+    print("Generating IR...")
+    code = impl.code
+
+    print("Inlining calls...")
+    code = syntax_tools.inline_calls(code)
+
+    print("Generating code for extension types...")
+    code, state_map = rewriting.rewrite_extensions(code, impl.concretization_functions)
+
+    if do_cse.value:
+        print("Eliminating common subexpressions...")
+        code = syntax_tools.cse_replace_spec(code)
+
+    print("Concretization functions:")
+    print()
+    for v, e in state_map.items():
+        print("{} : {} = {}".format(v, syntax_tools.pprint(e.type), syntax_tools.pprint(e)))
+    print()
+    print(syntax_tools.pprint(code))
+
+    abstract_state = impl.spec.statevars
+    impl = code
+    share_info = defaultdict(list)
+
+    try:
+        if java is not None:
+            codegen.JavaPrinter(out=java, boxed=(not unboxed)).visit(impl, state_map, share_info, abstract_state=abstract_state)
+
+        if cxx is not None:
+            codegen.CxxPrinter(out=cxx, use_qhash=use_qhash).visit(impl, state_map, share_info, abstract_state=abstract_state)
+    except:
+        print("Code generation failed!")
+        if save_failed_codegen_inputs.value:
+            with open(save_failed_codegen_inputs.value, "w") as f:
+                f.write("impl = {}\n".format(repr(impl)))
+                f.write("state_map = {}\n".format(repr(state_map)))
+                f.write("share_info = {}\n".format(repr(share_info)))
+            print("Implementation was dumped to {}".format(save_failed_codegen_inputs.value))
+        raise
+
 def run():
     """Entry point for Cozy executable.
 
@@ -55,43 +149,25 @@ def run():
     args = parser.parse_args()
     opts.read(args)
 
+    # state of the search for each query, saved alongside the implementation
+    search_states = {}
+
     if args.resume:
         with common.open_maybe_stdin(args.file or "-", mode="rb") as f:
-            ast = pickle.load(f)
+            ast = wire.load(f)
+        if isinstance(ast, synthesis.Checkpoint):
+            ast, search_states = ast
         print("Loaded implementation from {}".format("stdin" if args.file is None else "file {}".format(args.file)))
     else:
         with common.open_maybe_stdin(args.file or "-") as f:
             input_text = f.read()
-        ast = parse.parse_spec(input_text)
-
-        # Collection of errors in user-provided specification
-        errors = typecheck.typecheck(ast)
-        if errors:
-            for e in errors:
-                print("Error: {}".format(e))
+        try:
+            ast = initial_implementation(input_text)
+        except InvalidSpecification as e:
+            for error in e.errors:
+                print("Error: {}".format(error))
             sys.exit(1)
 
-        ast = desugar.desugar(ast)
-        ast = invariant_preservation.add_implicit_handle_assumptions(ast)
-
-        print("Checking call legality...")
-        call_errors = invariant_preservation.check_calls_wf(ast)
-        ast = syntax_tools.inline_calls(ast)
-
-        print("Checking invariant preservation...")
-        errors = (
-            invariant_preservation.check_ops_preserve_invariants(ast) +
-            invariant_preservation.check_the_wf(ast) +
-            invariant_preservation.check_minmax_wf(ast) +
-            call_errors)
-        if errors:
-            for e in errors:
-                print("Error: {}".format(e))
-            sys.exit(1)
-        print("Done!")
-
-        ast = synthesis.construct_initial_implementation(ast)
-
     start = datetime.datetime.now()
 
     if not args.simple:
@@ -99,14 +175,20 @@ def run():
         server = None
 
         if checkpoint_prefix.value:
-            def callback(impl):
+            def save_checkpoint(impl):
                 assert isinstance(impl, synthesis.Implementation)
                 now = datetime.datetime.now()
                 elapsed = now - start
                 fname = "{}{:010d}.synthesized".format(checkpoint_prefix.value, int(elapsed.total_seconds()))
                 with open(fname, "wb") as f:
-                    pickle.dump(impl, f)
+                    wire.dump(synthesis.Checkpoint(impl, search_states), f)
                     print("Saved checkpoint {}".format(fname))
+            latest = [None]
+            checkpoint_timer = common.Periodically(lambda: save_checkpoint(latest[0]),
+                timespan=datetime.timedelta(seconds=checkpoint_interval.value))
+            def callback(impl):
+                latest[0] = impl
+                checkpoint_timer.check()
 
         if args.port:
             from cozy import progress_server
@@ -138,55 +220,24 @@ def run():
         ast = synthesis.improve_implementation(
             ast,
             timeout           = datetime.timedelta(seconds=args.timeout),
-            progress_callback = callback)
+            progress_callback = callback,
+            search_states     = search_states)
+
+        if checkpoint_prefix.value:
+            # save the final state of the search, too
+            save_checkpoint(ast)
 
         if server is not None:
             server.join()
 
     if args.save:
         with open(args.save, "wb") as f:
-            pickle.dump(ast, f)
+            pickle.dump(synthesis.Checkpoint(ast, search_states), f)
             print("Saved implementation to file {}".format(args.save))
 
-    print("Generating IR...")
-    code = ast.code
-
-    print("Inlining calls...")
-    code = syntax_tools.inline_calls(code)
-
-    print("Generating code for extension types...")
-    code, state_map = rewriting.rewrite_extensions(code, ast.concretization_functions)
-
-    if do_cse.value:
-        print("Eliminating common subexpressions...")
-        code = syntax_tools.cse_replace_spec(code)
-
-    print("Concretization functions:")
-    print()
-    for v, e in state_map.items():
-        print("{} : {} = {}".format(v, syntax_tools.pprint(e.type), syntax_tools.pprint(e)))
-    print()
-    print(syntax_tools.pprint(code))
-
-    impl = code
-    share_info = defaultdict(list)
-
-    try:
-        java = args.java
-        if java is not None:
-            with common.open_maybe_stdout(java) as out:
-                codegen.JavaPrinter(out=out, boxed=(not args.unboxed)).visit(impl, state_map, share_info, abstract_state=ast.spec.statevars)
-
-        cxx = getattr(args, "c++")
-        if cxx is not None:
-            with common.open_maybe_stdout(cxx) as out:
-                codegen.CxxPrinter(out=out, use_qhash=args.use_qhash).visit(impl, state_map, share_info, abstract_state=ast.spec.statevars)
-    except:
-        print("Code generation failed!")
-        if save_failed_codegen_inputs.value:
-            with open(save_failed_codegen_inputs.value, "w") as f:
-                f.write("impl = {}\n".format(repr(impl)))
-                f.write("state_map = {}\n".format(repr(state_map)))
-                f.write("share_info = {}\n".format(repr(share_info)))
-            print("Implementation was dumped to {}".format(save_failed_codegen_inputs.value))
-        raise
+    with contextlib.ExitStack() as outputs:
+        generate_code(ast,
+            java=outputs.enter_context(common.open_maybe_stdout(args.java)) if args.java is not None else None,
+            unboxed=args.unboxed,
+            cxx=outputs.enter_context(common.open_maybe_stdout(getattr(args, "c++"))) if getattr(args, "c++") is not None else None,
+            use_qhash=args.use_qhash)
@@ -0,0 +1,261 @@
+"""Asynchronous interface for embedding Cozy in a long-running service.
+
+The functions in this module are asyncio counterparts of
+`synthesis.improve_implementation` and of the pipeline in `main.run`:
+
+ - improve_implementation: an async iterator over better implementations
+ - synthesize: parse, check, and improve a specification
+ - generate_code: generate code for an implementation
+
+Any number of these may run concurrently.  All of their work happens on a
+`SynthesisDriver`, a single background thread that runs every synthesis
+in turn and shares one budget of job processes (--max-jobs) among them.
+Cozy's solver bindings are not thread-safe, so clients should do any other
+work on implementations (e.g. anything that calls the solver) through
+`SynthesisDriver.run`.
+
+Synthesis stops when its timeout expires, when no query can be improved
+further, or when the consumer stops iterating (e.g. because its task was
+cancelled).
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import io
+import threading
+from multiprocessing import Pipe
+
+from cozy import jobs
+from cozy import main
+from cozy.synthesis import high_level_interface
+from cozy.synthesis.high_level_interface import max_jobs
+
+class _Session(object):
+    """One synthesis run by a SynthesisDriver."""
+
+    def __init__(self, make_steps, on_done):
+        self.make_steps = make_steps
+        self.on_done = on_done
+        self.steps = None
+        self.scheduler = None
+        self.wait_time = None
+        self.cancelled = False
+
+class SynthesisDriver(object):
+    """A background thread that runs many syntheses at once.
+
+    The thread starts when there is work to do and exits when there is
+    none left.  At most `max_running` jobs run at once across all of the
+    driver's syntheses (by default, the value of --max-jobs).
+    """
+
+    def __init__(self, max_running : int = None):
+        self.slots = jobs.JobSlots(max_running or max_jobs.value)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sessions = []
+        self._new_sessions = []
+        self._calls = []
+        self._wakeup, self._wakeup_sender = Pipe(duplex=False)
+
+    def run(self, f, *args, **kwargs) -> concurrent.futures.Future:
+        """Call `f(*args, **kwargs)` on the driver thread.
+
+        Returns a Future for the result; use asyncio.wrap_future to await it.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._calls.append((future, f, args, kwargs))
+            self._ensure_running()
+        return future
+
+    def improve(self, impl, timeout : datetime.timedelta, search_states=None, on_progress=None, on_done=None):
+        """Start improving an implementation on the driver thread.
+
+        The parameters are as for improve_implementation_steps.  Each better
+        implementation is passed to `on_progress`, and when synthesis ends,
+        `on_done(result, exception)` is called.  Both are called on the
+        driver thread.
+
+        Returns a handle for `cancel`.
+        """
+        session = _Session(
+            lambda session: high_level_interface.improve_implementation_steps(
+                impl,
+                timeout=timeout,
+                progress_callback=on_progress,
+                search_states=search_states,
+                stop_callback=lambda: session.cancelled,
+                job_slots=self.slots),
+            on_done=on_done or (lambda result, exception: None))
+        with self._lock:
+            self._new_sessions.append(session)
+            self._ensure_running()
+        return session
+
+    def cancel(self, session : _Session):
+        """Stop a synthesis started with `improve`.
+
+        Its `on_done` callback is still called with the best implementation
+        found so far.  Cancelling a finished synthesis does nothing.
+        """
+        session.cancelled = True
+        self._wake()
+
+    def _wake(self):
+        self._wakeup_sender.send_bytes(b"")
+
+    def _ensure_running(self):
+        # called with self._lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cozy-synthesis-driver", daemon=True)
+            self._thread.start()
+        else:
+            self._wake()
+
+    def _run(self):
+        while True:
+            while self._wakeup.poll():
+                self._wakeup.recv_bytes()
+
+            with self._lock:
+                calls = self._calls
+                self._calls = []
+                new_sessions = self._new_sessions
+                self._new_sessions = []
+                if not calls and not new_sessions and not self._sessions:
+                    self._thread = None
+                    return
+
+            for (future, f, args, kwargs) in calls:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(f(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+
+            for session in new_sessions:
+                try:
+                    session.steps = session.make_steps(session)
+                except BaseException as e:
+                    session.on_done(None, e)
+                    continue
+                self._sessions.append(session)
+                self._advance(session, None)
+
+            if not self._sessions:
+                continue
+
+            timeout = min(s.wait_time for s in self._sessions)
+            messages = jobs.wait_for_schedulers(
+                [s.scheduler for s in self._sessions],
+                timeout,
+                interrupt=self._wakeup)
+            for session, msgs in list(zip(self._sessions, messages)):
+                self._advance(session, msgs)
+
+    def _advance(self, session : _Session, messages):
+        """Resume a session's generator until it waits again or finishes."""
+        try:
+            if messages is None:
+                session.scheduler, session.wait_time = next(session.steps)
+            else:
+                session.scheduler, session.wait_time = session.steps.send(messages)
+        except StopIteration as stop:
+            self._sessions.remove(session)
+            session.on_done(stop.value, None)
+        except BaseException as e:
+            self._sessions.remove(session)
+            session.on_done(None, e)
+
+_default_driver = None
+_default_driver_lock = threading.Lock()
+
+def default_driver() -> SynthesisDriver:
+    """The driver used when none is given explicitly."""
+    global _default_driver
+    with _default_driver_lock:
+        if _default_driver is None:
+            _default_driver = SynthesisDriver()
+        return _default_driver
+
+async def improve_implementation(
+        impl,
+        timeout       : datetime.timedelta = datetime.timedelta(seconds=60),
+        search_states = None,
+        driver        : SynthesisDriver = None):
+    """Improve an implementation, yielding better versions as they are found.
+
+    This is an async iterator.  It yields a copy of the implementation each
+    time one of its queries improves, and a final copy of the best
+    implementation when synthesis ends.  Leaving the iteration early stops
+    the synthesis.  The `search_states` parameter is as for
+    `synthesis.improve_implementation`.
+    """
+    driver = driver or default_driver()
+    loop = asyncio.get_event_loop()
+    events = asyncio.Queue()
+
+    def post(event):
+        try:
+            loop.call_soon_threadsafe(events.put_nowait, event)
+        except RuntimeError:
+            # the event loop was closed; nobody is listening anymore
+            pass
+
+    def on_progress(impl):
+        post((impl.safe_copy(), None, False))
+
+    def on_done(result, exception):
+        post((result.safe_copy() if result is not None else None, exception, True))
+
+    session = driver.improve(impl, timeout, search_states, on_progress=on_progress, on_done=on_done)
+    try:
+        while True:
+            result, exception, done = await events.get()
+            if exception is not None:
+                raise exception
+            yield result
+            if done:
+                return
+    finally:
+        driver.cancel(session)
+
+async def synthesize(
+        input_text : str,
+        timeout    : datetime.timedelta = datetime.timedelta(seconds=60),
+        driver     : SynthesisDriver = None):
+    """Parse and check a specification, then improve its implementation.
+
+    This is an async iterator that yields the initial implementation and
+    then everything that `improve_implementation` yields.  It raises
+    main.InvalidSpecification if the specification has errors.
+    """
+    driver = driver or default_driver()
+    impl = await asyncio.wrap_future(driver.run(main.initial_implementation, input_text))
+    yield impl
+    improvements = improve_implementation(impl, timeout, driver=driver)
+    try:
+        async for better in improvements:
+            yield better
+    finally:
+        await improvements.aclose()
+
+async def generate_code(impl, java : bool = False, cxx : bool = False, driver : SynthesisDriver = None, **kwargs) -> {str : str}:
+    """Generate code for an implementation.
+
+    Returns a dictionary with the source code for each requested language
+    ("java" and/or "c++").  Other keyword arguments are passed to
+    `main.generate_code`.
+    """
+    driver = driver or default_driver()
+    def run():
+        outputs = {}
+        if java:
+            outputs["java"] = io.StringIO()
+        if cxx:
+            outputs["c++"] = io.StringIO()
+        main.generate_code(impl, java=outputs.get("java"), cxx=outputs.get("c++"), **kwargs)
+        return { lang : out.getvalue() for lang, out in outputs.items() }
+    return await asyncio.wrap_future(driver.run(run))
@@ -6,19 +6,27 @@ Important functions and classes:
  - valid: check whether an expression is valid for all small models
  - IncrementalSolver: a class to efficiently check assertions incrementally
  - ModelCachingSolver: a class that saves models between satisfiability checks
+ - SolverCache: results of earlier solver calls (see `solver_cache`)
+ - EncodingStats: how much work ToZ3's encoding memo saved (see `encoding_stats`)
+ - DeepeningStats: which collection depths resolved queries (see `deepening_stats`)
 """
 
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, Counter
 from datetime import datetime, timedelta
 from functools import lru_cache
+import hashlib
+import itertools
+import os
+import pickle
 import threading
+import time
 
 import z3
 
 from cozy.target_syntax import *
-from cozy.syntax_tools import BottomUpExplorer, pprint, free_vars, free_funcs, cse, all_exps, purify
+from cozy.syntax_tools import BottomUpExplorer, pprint, free_vars, free_funcs, cse, all_exps, purify, alpha_key, fresh_var, subst
 from cozy.typecheck import is_collection, is_numeric
-from cozy.common import declare_case, fresh_name, Visitor, FrozenDict, typechecked, extend, OrderedSet, make_random_access
+from cozy.common import declare_case, fresh_name, Visitor, FrozenDict, typechecked, extend, OrderedSet, make_random_access, AtomicWriteableFile, ADT
 from cozy import evaluation
 from cozy.opts import Option
 from cozy.structures import extension_handler
@@ -26,9 +34,31 @@ from cozy.logging import task
 from cozy.value_types import Map, Bag, Handle
 from cozy.evaluation import eval_bulk
 from cozy.contexts import Context
+from cozy import solver_service
+from cozy.solver_service import SAT, UNSAT, UNKNOWN
 
 collection_depth_opt = Option("collection-depth", int, 4, metavar="N", description="Bound for bounded verification")
 use_quantified_encoding = Option("quantified-encoding", bool, False, description="Allow the use of quantifiers during formula encoding. The resulting formulas are still decideable using Z3's macro_finder option. Enabling this option offloads work from Python to Z3. Generally it harms performance.")
+solver_cache_size = Option("solver-cache-size", int, 10000, metavar="N",
+    description="Number of solver results to remember in memory.  A formula "
+        + "that is alpha equivalent to one solved before (under the same "
+        + "assumptions and bounds) is not sent to Z3 again.  0 disables the "
+        + "cache.")
+solver_cache_dir = Option("solver-cache-dir", str, "", metavar="DIR",
+    description="Directory in which to remember solver results across "
+        + "processes and runs.  By default, results are only remembered in "
+        + "memory.")
+iterative_deepening = Option("iterative-deepening", int, 0, metavar="N",
+    description="Solve each query at collection depth N first, doubling N "
+        + "until it reaches --collection-depth.  A model found at a small "
+        + "depth is returned right away; an unsatisfiable result is checked "
+        + "again deeper, but only if the query mentions collection-typed "
+        + "variables.  0 disables iterative deepening.")
+encoding_memo_size = Option("encoding-memo-size", int, 10000, metavar="N",
+    description="Number of subterm encodings each solver remembers.  A "
+        + "collection-valued subterm (or lambda) that is encoded again under "
+        + "the same bindings for its variables reuses the earlier encoding.  "
+        + "0 disables the memo.")
 
 class SolverReportedUnknown(Exception):
     pass
@@ -224,10 +254,55 @@ def ite(ty : Type, cond : z3.AstRef, then_branch, else_branch):
 def grid(rows, cols):
     return [[None for c in range(cols)] for r in range(rows)]
 
+class DeepeningStats(object):
+    """Counters for iterative deepening (see --iterative-deepening)."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.resolved = Counter() # collection depth -> queries answered at that depth
+        self.escalations = 0      # unsatisfiable answers that had to be checked deeper
+
+    def __str__(self):
+        return "resolved at depth {}, {} escalations".format(
+            ", ".join("{}: {}".format(d, n) for d, n in sorted(self.resolved.items())) or "-",
+            self.escalations)
+
+deepening_stats = DeepeningStats()
+
+class EncodingStats(object):
+    """Counters for the encoding memo of every ToZ3 in this process."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0 # time the hits took to encode originally
+
+    def __str__(self):
+        return "{} hits, {} misses, {:.3f}s saved".format(
+            self.hits, self.misses, self.seconds_saved)
+
+encoding_stats = EncodingStats()
+
+# Beyond this many distinct subterm shapes (or remembered nodes), ToZ3
+# forgets them.
+_MAX_SHAPES = 100000
+
 class ToZ3(Visitor):
     def __init__(self, z3ctx, z3solver):
         self.ctx = z3ctx
         self.solver = z3solver
+
+        # Encoding memo (see `visit`).  Subterms are identified by "shapes":
+        # small ints that stand for a subterm's structure and types.
+        self.memo = OrderedDict() # (shape, ids of bindings) -> (bindings, encoding, seconds)
+        self.shape_ids = { }      # (node kind, type, child shapes...) -> shape
+        self.shapes = { }         # id(node) -> (node, shape, names of free variables and functions)
+
         self.int_zero = z3.IntVal(0, self.ctx)
         self.int_one  = z3.IntVal(1, self.ctx)
         self.true = z3.BoolVal(True, self.ctx)
@@ -837,7 +912,92 @@ class ToZ3(Visitor):
         return e
     def visit_bool(self, e, env):
         return z3.BoolVal(e, self.ctx)
+    def _shape(self, x):
+        """Returns (shape, names) for a syntax tree node.
+
+        Equal shapes mean structurally equal subterms with equal types
+        everywhere.  `names` is a sorted tuple of every variable and function
+        name that appears in the subterm, bound or not.
+        """
+        entry = self.shapes.get(id(x))
+        if entry is not None and entry[0] is x:
+            return entry[1], entry[2]
+        names = set()
+        if isinstance(x, EVar):
+            names.add(x.id)
+        elif isinstance(x, ECall):
+            names.add(x.func)
+        parts = [type(x).__name__, getattr(x, "type", None)]
+        for child in x.children():
+            parts.append(self._shape_part(child, names))
+        shape = self.shape_ids.setdefault(tuple(parts), len(self.shape_ids))
+        names = tuple(sorted(names))
+        self.shapes[id(x)] = (x, shape, names)
+        return shape, names
+
+    def _shape_part(self, x, names):
+        if isinstance(x, Type):
+            return x
+        if isinstance(x, ADT):
+            shape, child_names = self._shape(x)
+            names.update(child_names)
+            return shape
+        if isinstance(x, tuple) or isinstance(x, list):
+            return tuple(self._shape_part(y, names) for y in x)
+        return (type(x).__name__, x)
+
+    def _remembers(self, e):
+        """Is the encoding of `e` worth remembering?"""
+        if isinstance(e, ELambda):
+            return True
+        if not isinstance(e, Exp):
+            return False
+        for x in itertools.chain((e,), e.children()):
+            t = getattr(x, "type", None)
+            if isinstance(x, Exp) and (is_collection(t) or isinstance(t, TMap)):
+                return True
+        return False
+
     def visit(self, e, *args):
+        # Encodings are remembered for subterms that are expensive to encode.
+        # An encoding depends only on the subterm and on the bindings of its
+        # variables in `env`, so the memo key is the subterm's shape plus the
+        # identities of those bindings.  A hit returns the very same objects
+        # as the original encoding; that is safe because no visit_ method
+        # mutates the encodings of its children.  Reusing objects also lets
+        # hits cascade: e.g. the body of a let whose bound value was a hit
+        # sees the same binding as before.
+        limit = encoding_memo_size.value
+        if limit > 0 and len(args) == 1 and isinstance(args[0], dict) and self._remembers(e):
+            env = args[0]
+            if len(self.shape_ids) > _MAX_SHAPES:
+                # memo keys refer to shape ids, so they have to go too
+                self.memo.clear()
+                self.shape_ids.clear()
+                self.shapes.clear()
+            elif len(self.shapes) > _MAX_SHAPES:
+                self.shapes.clear()
+            shape, names = self._shape(e)
+            bindings = tuple(env.get(name) for name in names)
+            key = (shape, use_quantified_encoding.value, tuple(id(b) for b in bindings))
+            entry = self.memo.get(key)
+            if entry is not None:
+                self.memo.move_to_end(key)
+                encoding_stats.hits += 1
+                encoding_stats.seconds_saved += entry[2]
+                return entry[1]
+            start = time.perf_counter()
+            res = self._visit(e, *args)
+            encoding_stats.misses += 1
+            # `bindings` keeps the bound objects alive so that their ids are
+            # not reused while the entry exists.
+            self.memo[key] = (bindings, res, time.perf_counter() - start)
+            while len(self.memo) > limit:
+                self.memo.popitem(last=False)
+            return res
+        return self._visit(e, *args)
+
+    def _visit(self, e, *args):
         try:
             return super().visit(e, *args)
         except KeyboardInterrupt:
@@ -997,10 +1157,110 @@ class ExtractedFunc(object):
     def __call__(self, *args):
         return self.cases.get(args, self.default)
 
+# Bump this whenever the format of the solver cache entries or keys changes.
+SOLVER_CACHE_FORMAT_VERSION = 2
+
+class SolverCache(object):
+    """Results of earlier solver calls.
+
+    Keys are computed by `IncrementalSolver` from the alpha-normalized
+    formula, the solver's assumptions, and the options and bounds that
+    affect the result.  Each entry is either None (the formula was
+    unsatisfiable) or a model.  Models whose functions cannot be saved are
+    stored as empty dictionaries; they still say that the formula is
+    satisfiable.
+
+    Entries are kept in an in-memory LRU of --solver-cache-size entries and,
+    if --solver-cache-dir is set, in that directory.  The directory entries
+    are written atomically, so several Cozy processes may share it.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict() # key -> None or model
+        self.hits = 0
+        self.disk_hits = 0 # hits that had to be read from disk
+        self.misses = 0
+        self.rejected = 0  # cached models that failed validation
+
+    def clear(self):
+        """Forget the in-memory entries and reset the statistics."""
+        self.entries.clear()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def _path(self, key : str) -> str:
+        return os.path.join(solver_cache_dir.value, key[:2], key + ".pickle")
+
+    def lookup(self, key : str):
+        """Find a cached result.
+
+        Returns (True, entry) on a hit and (False, None) on a miss.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return (True, self.entries[key])
+        if solver_cache_dir.value:
+            try:
+                with open(self._path(key), "rb") as f:
+                    entry = pickle.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print("unable to read solver cache entry {}: {}".format(self._path(key), e))
+            else:
+                self._remember(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return (True, entry)
+        self.misses += 1
+        return (False, None)
+
+    def store(self, key : str, entry):
+        """Remember the result for a key."""
+        self._remember(key, entry)
+        if solver_cache_dir.value:
+            try:
+                data = pickle.dumps(entry)
+            except Exception:
+                return
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with AtomicWriteableFile(path, mode="wb") as f:
+                f.write(data)
+
+    def reject(self, key : str):
+        """Forget an entry whose model turned out to be wrong."""
+        self.rejected += 1
+        self.entries.pop(key, None)
+        if solver_cache_dir.value:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _remember(self, key : str, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > max(solver_cache_size.value, 0):
+            self.entries.popitem(last=False)
+
+    def __str__(self):
+        return "{} hits ({} from disk), {} misses, {} rejected".format(
+            self.hits, self.disk_hits, self.misses, self.rejected)
+
+# The cache shared by all IncrementalSolvers in this process.
+solver_cache = SolverCache()
+
 class IncrementalSolver(object):
     SAVE_PROPS = [
         "vars",
         "funcs",
+        "assumptions",
+        "_assumptions_key",
+        "definitions",
         "_env"]
 
     def __init__(self,
@@ -1023,7 +1283,14 @@ class IncrementalSolver(object):
         self.collection_depth = collection_depth
         self.validate_model = validate_model
         self.model_callback = model_callback
+        self.logic = logic
+        self.timeout = timeout
+        self.deepening = True
+        self.shallow_solvers = OrderedDict() # collection depth -> IncrementalSolver (see `_deepen`)
         self._env = OrderedDict()
+        self.assumptions = []
+        self._assumptions_key = "" # digest of the assumptions (see `_cache_key`)
+        self.definitions = OrderedDict() # name of defined var -> Exp (see `define`)
         self.stk = []
         self.do_cse = do_cse
 
@@ -1044,12 +1311,20 @@ class IncrementalSolver(object):
     def push(self):
         self.stk.append(tuple(type(getattr(self, p))(getattr(self, p)) for p in IncrementalSolver.SAVE_PROPS))
         self.z3_solver.push()
+        for s in self.shallow_solvers.values():
+            s.push()
 
     def pop(self):
         x = self.stk.pop()
         for v, p in zip(x, IncrementalSolver.SAVE_PROPS):
             setattr(self, p, v)
         self.z3_solver.pop()
+        for depth, s in list(self.shallow_solvers.items()):
+            if s.stk:
+                s.pop()
+            else:
+                # created inside the scope that just ended
+                del self.shallow_solvers[depth]
 
     def _create_vars(self, vars, funcs):
         for f, t in funcs.items():
@@ -1078,10 +1353,33 @@ class IncrementalSolver(object):
             print("conversion failed for: {!r}".format(orig_e))
             raise
 
+    def define(self, e : Exp) -> EVar:
+        """Encode an expression once, for use in many later calls.
+
+        Returns a fresh variable that stands for `e` in formulas given to
+        this solver.  Those formulas reuse the encoding of `e` instead of
+        encoding it again.  Definitions are local to the current push/pop
+        scope.
+        """
+        v = fresh_var(e.type, "defined")
+        with _LOCK:
+            self._env[v.id] = self._convert(e)
+            self.definitions[v.id] = self.expand_definitions(e)
+        return v
+
+    def expand_definitions(self, e : Exp) -> Exp:
+        """Replace the variables returned by `define` in `e` with their definitions."""
+        if self.definitions and any(v.id in self.definitions for v in free_vars(e)):
+            return subst(e, self.definitions)
+        return e
+
     def add_assumption(self, e):
         try:
             with _LOCK:
                 self.z3_solver.add(self._convert(e))
+                e = self.expand_definitions(e)
+                self.assumptions.append(e)
+                self._assumptions_key = hashlib.sha256(repr((self._assumptions_key, alpha_key(e))).encode("utf-8")).hexdigest()
         except Exception:
             print(" ---> to reproduce: satisfy({e!r}, vars={vars!r}, collection_depth={collection_depth!r}, validate_model={validate_model!r})".format(
                 e=e,
@@ -1090,7 +1388,175 @@ class IncrementalSolver(object):
                 validate_model=self.validate_model))
             raise
 
+    def _cache_key(self, e) -> str:
+        """The key for `e` in the solver cache, or None if the cache is disabled.
+
+        The assumptions are summarized by a digest that `add_assumption`
+        extends (and `pop` restores), so only `e` is normalized here.
+        """
+        if solver_cache_size.value <= 0 and not solver_cache_dir.value:
+            return None
+        data = (
+            SOLVER_CACHE_FORMAT_VERSION,
+            self.collection_depth,
+            self.min_collection_depth,
+            use_quantified_encoding.value,
+            self._assumptions_key,
+            alpha_key(e))
+        return hashlib.sha256(repr(data).encode("utf-8")).hexdigest()
+
+    def _cached_model(self, e, model, model_extraction):
+        """Turn a model from the solver cache into a model for this solver.
+
+        Only the values of the variables and functions that appear in `e`
+        and the assumptions are taken from the cached model; the key says
+        nothing about the others, so they get default values.  Returns None
+        if the model does not satisfy `e` and the assumptions.
+        """
+        if not model:
+            # satisfiable, but the model was not saved
+            return None if (model_extraction or self.validate_model) else {}
+        formulas = list(itertools.chain(self.assumptions, (e,)))
+        vars = OrderedSet(self.vars)
+        funcs = OrderedDict(self.funcs)
+        for x in formulas:
+            vars |= free_vars(x)
+            funcs.update(free_funcs(x))
+        relevant = { v.id for x in formulas for v in free_vars(x) } | { f for x in formulas for f in free_funcs(x) }
+        res = {}
+        for name, t in funcs.items():
+            res[name] = model[name] if name in relevant and name in model else ExtractedFunc({}, evaluation.mkval(t.ret_type))
+        for v in vars:
+            res[v.id] = model[v.id] if v.id in relevant and v.id in model else evaluation.mkval(v.type)
+        try:
+            if not all(evaluation.eval(x, res) is True for x in formulas):
+                return None
+        except Exception:
+            return None
+        return res
+
     def satisfy(self, e, model_extraction=True):
+        with _LOCK:
+            expanded = self.expand_definitions(e)
+            key = self._cache_key(expanded)
+            if key is not None:
+                found, entry = solver_cache.lookup(key)
+                if found:
+                    if entry is None:
+                        return None
+                    res = self._cached_model(expanded, entry, model_extraction)
+                    if res is not None:
+                        if res and self.model_callback is not None:
+                            self.model_callback(res)
+                        return res
+                    if entry:
+                        solver_cache.reject(key)
+            res = self._deepen(e, expanded, model_extraction)
+            if key is not None:
+                solver_cache.store(key, self._cache_entry(res))
+            return res
+
+    def _shallow_depths(self, expanded) -> [int]:
+        """The collection depths to try before self.collection_depth."""
+        depth = iterative_deepening.value if self.deepening else 0
+        if depth <= 0 or depth >= self.collection_depth:
+            return []
+        # The encodings of other types do not depend on the depth, so
+        # deepening only pays off for collection-typed variables.
+        fvs = free_vars(EAll([expanded] + self.assumptions))
+        ffs = free_funcs(EAll([expanded] + self.assumptions))
+        types = [v.type for v in fvs] + [t for f in ffs.values() for t in itertools.chain(f.arg_types, (f.ret_type,))]
+        if all(deterministic_flattenable(t) for t in types):
+            return []
+        res = []
+        while depth < self.collection_depth:
+            if depth >= self.min_collection_depth:
+                res.append(depth)
+            depth *= 2
+        return res
+
+    def _shallow_solver(self, depth : int):
+        s = self.shallow_solvers.get(depth)
+        if s is not None and s.assumptions != self.assumptions[:len(s.assumptions)]:
+            s = None
+        if s is None:
+            s = IncrementalSolver(
+                vars=self.vars,
+                funcs=self.funcs,
+                collection_depth=depth,
+                min_collection_depth=self.min_collection_depth,
+                validate_model=self.validate_model,
+                model_callback=self.model_callback,
+                logic=self.logic,
+                timeout=self.timeout,
+                do_cse=self.do_cse)
+            s.deepening = False
+            self.shallow_solvers[depth] = s
+        with _LOCK:
+            s._create_vars(vars=self.vars, funcs=self.funcs)
+        for a in self.assumptions[len(s.assumptions):]:
+            s.add_assumption(a)
+        return s
+
+    def _deepen(self, e, expanded, model_extraction):
+        """Solve `expanded`, first at the depths of --iterative-deepening.
+
+        A model at a small depth is also a model at full depth, so it is
+        returned right away.  Only unsatisfiable (or unknown) answers move
+        on to the next depth.
+        """
+        depths = self._shallow_depths(expanded)
+        for depth in depths:
+            try:
+                res = self._shallow_solver(depth).satisfy(expanded, model_extraction)
+            except SolverReportedUnknown:
+                res = None
+            if res is not None:
+                deepening_stats.resolved[depth] += 1
+                return res
+            deepening_stats.escalations += 1
+        res = self._satisfy(e, expanded, model_extraction)
+        if depths:
+            deepening_stats.resolved[self.collection_depth] += 1
+        return res
+
+    def _cache_entry(self, res):
+        if res is None:
+            return None
+        if not all(isinstance(f, ExtractedFunc) for name, f in res.items() if name in self.funcs):
+            return {}
+        return dict(res)
+
+    def _check(self, model_extraction):
+        """Check the Z3 solver's assertions.
+
+        If --solver-processes is set, the check runs in the solver service
+        (see cozy.solver_service).  Then, if a model is needed, the Z3 solver
+        is checked again in-process under the service's model, which is
+        cheap and leaves the model in the usual place.
+        """
+        solver = self.z3_solver
+        service = solver_service.default_service()
+        if service is None:
+            return solver.check()
+        timeout = self.timeout or solver_service.solver_service_timeout.value or None
+        smt2 = solver.to_smt2()
+        answer, info, _ = service.check(
+            [(smt2, strategy, (SAT, UNSAT)) for strategy in solver_service.portfolio()],
+            timeout=timeout)
+        if answer == UNSAT:
+            return z3.unsat
+        if answer == UNKNOWN:
+            return z3.unknown
+        if not model_extraction:
+            return z3.sat
+        res = solver.check(*solver_service.model_hints(info, self.visitor.ctx))
+        if res != z3.sat:
+            res = solver.check()
+        return res
+
+    def _satisfy(self, e, expanded, model_extraction):
+        """Call Z3.  `expanded` is `e` without defined variables."""
         _env = self._env
         solver = self.z3_solver
         vars = self.vars
@@ -1162,7 +1628,7 @@ class IncrementalSolver(object):
 
             _tock(e, "encode")
             with task("invoke Z3"):
-                res = solver.check()
+                res = self._check(model_extraction)
             _tock(e, "solve")
             if res == z3.unsat:
                 solver.pop()
@@ -1197,19 +1663,19 @@ class IncrementalSolver(object):
                     if self.model_callback is not None:
                         self.model_callback(res)
                     if self.validate_model:
-                        x = evaluation.eval(e, res)
+                        x = evaluation.eval(expanded, res)
                         if x is not True:
                             print("solver returned a bad model: {}".format(res))
-                            print(" ---> formula: {}".format(pprint(e)))
+                            print(" ---> formula: {}".format(pprint(expanded)))
                             print(" ---> got {}".format(repr(x)))
                             print(" ---> model: {}".format(model))
                             print(" ---> assertions: {}".format(solver.assertions()))
                             print(" ---> to reproduce: satisfy({e}, vars={vars}, collection_depth={collection_depth}, validate_model={validate_model})".format(
-                                e=repr(e),
+                                e=repr(expanded),
                                 vars=repr(vars),
                                 collection_depth=repr(self.collection_depth),
                                 validate_model=repr(self.validate_model)))
-                            wq = [(e, _env, res)]
+                            wq = [(expanded, _env, res)]
                             while wq:
                                 x, solver_env, eval_env = wq.pop()
                                 for x in sorted(all_exps(x), key=lambda xx: xx.size()):
@@ -1282,12 +1748,44 @@ class ModelCachingSolver(object):
         self.calls = 0
         self.hits = 0
         self.examples = list(examples)
+        self.assumptions = assumptions
         self.solver = IncrementalSolver(vars=vars, funcs=funcs)
         self.solver.add_assumption(assumptions)
 
+    def add_examples(self, examples : [dict]) -> int:
+        """Add models found elsewhere to the cache.
+
+        Examples must bind every variable and function that this solver knows
+        about.  Examples that do not, examples that are already cached, and
+        examples that violate the assumptions are ignored.
+
+        Returns the number of examples that were added.
+        """
+        added = 0
+        for x in examples:
+            if any(v.id not in x for v in self.vars) or any(f not in x for f in self.funcs):
+                continue
+            if x in self.examples:
+                continue
+            if not evaluation.eval(self.assumptions, x):
+                continue
+            self.examples.append(x)
+            added += 1
+        return added
+
+    def push(self):
+        self.solver.push()
+
+    def pop(self):
+        self.solver.pop()
+
+    def define(self, e : Exp) -> EVar:
+        """See IncrementalSolver.define."""
+        return self.solver.define(e)
+
     def satisfy(self, e):
         self.calls += 1
-        eval_results = eval_bulk(e, self.examples, use_default_values_for_undefined_vars=True)
+        eval_results = eval_bulk(self.solver.expand_definitions(e), self.examples, use_default_values_for_undefined_vars=True)
         for x, res in zip(self.examples, eval_results):
             if res:
                 self.hits += 1
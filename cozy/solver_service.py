@@ -0,0 +1,291 @@
+"""A pool of Z3 worker processes.
+
+Normally every solver call runs on the calling thread (see cozy.solver), so
+one hard query stalls the whole process until Z3 gives up.  A SolverService
+instead sends formulas, as SMT-LIB2 text, to worker processes.  It enforces
+a hard timeout on each call (a worker that does not finish in time is killed
+and replaced) and it can race a portfolio of strategies---different tactics
+or logics, or even different encodings of the same problem---returning the
+first definitive answer.
+
+IncrementalSolver uses the service when --solver-processes is positive.
+
+Important functions and classes:
+ - SolverService: the pool itself
+ - default_service: the shared pool configured by the command-line options
+ - portfolio: the strategies named by --solver-portfolio
+ - model_hints: turn a worker's model back into Z3 constraints
+"""
+
+from collections import OrderedDict, Counter
+from fractions import Fraction
+from multiprocessing import Process, Pipe, current_process
+from multiprocessing.connection import wait
+from multiprocessing.util import Finalize
+import os
+import signal
+import time
+
+import z3
+
+from cozy.opts import Option
+
+SAT = "sat"
+UNSAT = "unsat"
+UNKNOWN = "unknown"
+
+class Strategy(object):
+    """A way to run Z3 on a formula.
+
+    A strategy uses either a sequence of tactics, a logic (as for
+    z3.SolverFor), or Z3's default solver.  `params` are extra solver
+    parameters as (name, value) pairs.
+    """
+
+    def __init__(self, name : str, tactics : [str] = (), logic : str = None, params = ()):
+        self.name = name
+        self.tactics = tuple(tactics)
+        self.logic = logic
+        self.params = tuple(params)
+
+    def make_solver(self, ctx : z3.Context) -> z3.Solver:
+        if self.tactics:
+            tactics = [z3.Tactic(t, ctx=ctx) for t in self.tactics]
+            tactic = tactics[0] if len(tactics) == 1 else z3.Then(*tactics, ctx=ctx)
+            solver = tactic.solver()
+        elif self.logic is not None:
+            solver = z3.SolverFor(self.logic, ctx=ctx)
+        else:
+            solver = z3.Solver(ctx=ctx)
+        for (param, value) in self.params:
+            solver.set(param, value)
+        return solver
+
+    def __repr__(self):
+        return "Strategy({!r})".format(self.name)
+
+STRATEGIES = OrderedDict((s.name, s) for s in [
+    Strategy("default"),
+    Strategy("simplify", tactics=["simplify", "propagate-values", "solve-eqs", "smt"]),
+    Strategy("uflira", logic="QF_UFLIRA"),
+    Strategy("random-seed", params=[("smt.random_seed", 7)]),
+])
+
+solver_processes = Option("solver-processes", int, 0, metavar="N",
+    description="Run Z3 in a pool of N worker processes instead of in the "
+        + "synthesis process.  This enables hard per-call timeouts (see "
+        + "--solver-service-timeout) and racing the strategies in "
+        + "--solver-portfolio.  0 runs Z3 in-process.")
+solver_service_timeout = Option("solver-service-timeout", int, 0, metavar="SECONDS",
+    description="When using --solver-processes, give up on a solver call "
+        + "after this many seconds.  The call then fails as if Z3 had "
+        + "reported 'unknown'.  0 means no limit.")
+solver_portfolio = Option("solver-portfolio", str, "default", metavar="NAMES",
+    description="Comma-separated strategies to race on every solver call "
+        + "when using --solver-processes.  Available strategies: "
+        + ", ".join(STRATEGIES) + ".")
+
+def portfolio() -> [Strategy]:
+    """The strategies named by --solver-portfolio."""
+    res = []
+    for name in solver_portfolio.value.split(","):
+        name = name.strip()
+        if name not in STRATEGIES:
+            raise ValueError("unknown solver strategy {!r} (available: {})".format(name, ", ".join(STRATEGIES)))
+        res.append(STRATEGIES[name])
+    return res
+
+def _model_values(model : z3.ModelRef) -> {str : object}:
+    """The values of the integer, real, and boolean constants in `model`."""
+    values = { }
+    for d in model.decls():
+        if d.arity() != 0:
+            continue
+        v = model[d]
+        if z3.is_int_value(v):
+            values[d.name()] = v.as_long()
+        elif z3.is_rational_value(v):
+            values[d.name()] = Fraction(v.numerator_as_long(), v.denominator_as_long())
+        elif z3.is_true(v) or z3.is_false(v):
+            values[d.name()] = z3.is_true(v)
+    return values
+
+def model_hints(values : {str : object}, ctx : z3.Context) -> [z3.BoolRef]:
+    """Constraints that fix constants to the values found by a worker.
+
+    Z3 identifies constants by name and sort, so the constraints mention the
+    same constants as the formula that was sent to the worker.  Checking a
+    formula under these assumptions is nearly free, and it yields a model
+    for the formula in `ctx`.
+    """
+    hints = []
+    for name, v in sorted(values.items()):
+        if isinstance(v, bool):
+            hints.append(z3.Bool(name, ctx) == z3.BoolVal(v, ctx))
+        elif isinstance(v, int):
+            hints.append(z3.Int(name, ctx) == z3.IntVal(v, ctx))
+        else:
+            hints.append(z3.Real(name, ctx) == z3.RealVal("{}/{}".format(v.numerator, v.denominator), ctx))
+    return hints
+
+def _check(smt2 : str, strategy : Strategy, timeout : float):
+    ctx = z3.Context()
+    solver = strategy.make_solver(ctx)
+    if timeout is not None:
+        solver.set("timeout", max(1, int(timeout * 1000)))
+    solver.from_string(smt2)
+    res = solver.check()
+    if res == z3.sat:
+        return (SAT, _model_values(solver.model()))
+    if res == z3.unsat:
+        return (UNSAT, None)
+    return (UNKNOWN, solver.reason_unknown())
+
+def _serve(conn):
+    # Interrupts are the parent's business; it kills us when it stops.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            smt2, strategy, timeout = conn.recv()
+        except EOFError:
+            return
+        try:
+            answer = _check(smt2, strategy, timeout)
+        except Exception as e:
+            answer = (UNKNOWN, "worker failed: {}".format(e))
+        conn.send(answer)
+
+class _Worker(object):
+    def __init__(self):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_serve, args=(child_conn,), name="cozy-solver-worker", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+
+class SolverService(object):
+    """A pool of `size` Z3 worker processes.
+
+    Workers are started on demand and live until `close` (which runs
+    automatically when the process exits).  The methods are not thread-safe.
+
+    A service belongs to the process that created it: a copy inherited by a
+    forked child must not be used, since its workers are the parent's.
+    """
+
+    def __init__(self, size : int):
+        assert size > 0
+        self.pid = os.getpid()
+        self.size = size
+        self.workers = [None] * size
+        self.calls = 0
+        self.timeouts = 0
+        self.restarts = 0        # workers killed because their answer was no longer needed
+        self.answers = Counter() # strategy name -> number of races won
+        Finalize(self, SolverService.close, args=(self,), exitpriority=10)
+
+    def _worker(self, i : int) -> _Worker:
+        w = self.workers[i]
+        if w is None:
+            w = self.workers[i] = _Worker()
+        return w
+
+    def _kill(self, i : int):
+        w = self.workers[i]
+        if w is not None:
+            w.kill()
+            self.workers[i] = None
+            self.restarts += 1
+
+    def check(self, formulas, timeout : float = None):
+        """Race several formulas against each other.
+
+        Each element of `formulas` is a tuple (smt2, strategy, definitive):
+        an SMT-LIB2 benchmark, the Strategy to run it with, and the set of
+        answers (SAT and/or UNSAT) that end the race.  For instance, an
+        underapproximate encoding of a problem might accept only SAT.
+
+        Returns (answer, info, index).  When some formula got a definitive
+        answer, `index` is its position in `formulas`, and for SAT, `info`
+        holds the model's constants (see `model_hints`).  Otherwise the
+        answer is UNKNOWN and `index` is None.  When `timeout` seconds pass
+        first, the call returns UNKNOWN and kills the workers still running.
+        """
+        assert self.pid == os.getpid(), "this SolverService belongs to another process"
+        self.calls += 1
+        formulas = list(formulas)
+        deadline = None if timeout is None else time.time() + timeout
+        pending = list(range(len(formulas)))
+        busy = OrderedDict() # connection -> (worker index, formula index)
+        reason = "no strategy gave a definitive answer"
+        try:
+            while pending or busy:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self.timeouts += 1
+                    return (UNKNOWN, "timeout", None)
+                idle = set(range(self.size)) - { i for (i, j) in busy.values() }
+                for i in sorted(idle):
+                    if not pending:
+                        break
+                    j = pending.pop(0)
+                    smt2, strategy, definitive = formulas[j]
+                    w = self._worker(i)
+                    w.conn.send((smt2, strategy, remaining))
+                    busy[w.conn] = (i, j)
+                for conn in wait(list(busy), remaining):
+                    i, j = busy.pop(conn)
+                    try:
+                        answer, info = conn.recv()
+                    except EOFError:
+                        self.workers[i] = None
+                        answer, info = (UNKNOWN, "worker died")
+                    smt2, strategy, definitive = formulas[j]
+                    if answer in definitive:
+                        self.answers[strategy.name] += 1
+                        return (answer, info, j)
+                    if answer == UNKNOWN:
+                        reason = info
+            return (UNKNOWN, reason, None)
+        finally:
+            for (i, j) in busy.values():
+                self._kill(i)
+
+    def close(self):
+        """Stop all workers."""
+        if self.pid != os.getpid():
+            return
+        for w in self.workers:
+            if w is not None:
+                w.kill()
+        self.workers = [None] * self.size
+
+    def __str__(self):
+        return "{} calls, {} timeouts, {} workers restarted, wins: {}".format(
+            self.calls, self.timeouts, self.restarts,
+            ", ".join("{}={}".format(name, n) for name, n in self.answers.most_common()) or "none")
+
+_service = None
+
+def default_service() -> SolverService:
+    """The shared pool of this process, or None if Z3 should run in-process.
+
+    That is the case when --solver-processes is 0, and in daemonic processes
+    (such as enumeration workers), which may not start workers.
+    """
+    global _service
+    n = solver_processes.value
+    if n <= 0 or current_process().daemon:
+        return None
+    if _service is not None and _service.pid != os.getpid():
+        # inherited through fork; leave the parent's workers alone
+        _service = None
+    if _service is None or _service.size != n:
+        if _service is not None:
+            _service.close()
+        _service = SolverService(n)
+    return _service
@@ -1376,6 +1376,54 @@ def alpha_equivalent(e1 : syntax.Exp, e2 : syntax.Exp) -> bool:
 
     return V().visit(e1, e2)
 
+def alpha_key(e : syntax.Exp, bound_vars : [syntax.EVar] = ()):
+    """
+    Returns a hashable representation of `e` that respects alpha equivalence.
+
+    If e1 and e2 have the same types everywhere, then
+        alpha_key(e1) == alpha_key(e2)
+    if and only if alpha_equivalent(e1, e2).  (Unlike alpha_equivalent, the
+    key also distinguishes nodes with different types.)
+
+    The key is made only of names, types, and literals, so repr(alpha_key(e))
+    is the same in every process and can be used to build persistent cache
+    keys.  (`Aeq` objects, by contrast, have a hash that changes between runs.)
+
+    If given, `bound_vars` are treated as if they were bound by enclosing
+    binders, outermost first.
+    """
+    bound_vars = list(bound_vars)
+    levels = { v.id : i for (i, v) in enumerate(bound_vars) }
+
+    def key(x, depth):
+        if isinstance(x, syntax.EVar):
+            level = levels.get(x.id)
+            return ("EVar", x.id if level is None else level, getattr(x, "type", None))
+        if isinstance(x, target_syntax.ELambda):
+            with common.extend(levels, x.arg.id, depth):
+                return ("ELambda", x.arg.type, key(x.body, depth + 1))
+        if isinstance(x, syntax.EListComprehension):
+            return ("EListComprehension", getattr(x, "type", None), clauses(x.clauses, x.e, depth))
+        if isinstance(x, syntax.Type):
+            return x
+        if isinstance(x, common.ADT):
+            return (type(x).__name__, getattr(x, "type", None)) + tuple(key(child, depth) for child in x.children())
+        if isinstance(x, tuple) or isinstance(x, list):
+            return tuple(key(child, depth) for child in x)
+        return x
+
+    def clauses(cs, e, depth):
+        if not cs:
+            return (key(e, depth),)
+        c = cs[0]
+        if isinstance(c, syntax.CPull):
+            head = ("CPull", key(c.e, depth))
+            with common.extend(levels, c.id, depth):
+                return (head,) + clauses(cs[1:], e, depth + 1)
+        return (key(c, depth),) + clauses(cs[1:], e, depth)
+
+    return key(e, len(bound_vars))
+
 def freshen_binders(e : syntax.Exp, context):
     fvs = { v : True for v, p in context.vars() }
     class V(BottomUpRewriter):
@@ -5,3 +5,4 @@ from . import high_level_interface
 Implementation                   = impls.Implementation
 construct_initial_implementation = impls.construct_initial_implementation
 improve_implementation           = high_level_interface.improve_implementation
+Checkpoint                       = high_level_interface.Checkpoint
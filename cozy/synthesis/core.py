@@ -13,8 +13,9 @@ See their docstrings for more information.
 """
 
 from collections import OrderedDict, namedtuple
+import datetime
 import itertools
-from typing import Callable
+from typing import Any, Callable, List, Optional
 
 from cozy.syntax import (
     INT, BOOL, TMap,
@@ -26,9 +27,9 @@ from cozy.target_syntax import (
     EFlatMap, EFilter, EMakeMap2, EStateVar,
     EDropFront, EDropBack)
 from cozy.typecheck import is_collection, is_scalar
-from cozy.syntax_tools import subst, pprint, free_vars, fresh_var, alpha_equivalent, strip_EStateVar, freshen_binders, wrap_naked_statevars, break_conj, inline_lets
+from cozy.syntax_tools import subst, pprint, free_vars, fresh_var, alpha_equivalent, alpha_key, strip_EStateVar, freshen_binders, wrap_naked_statevars, break_conj, inline_lets
 from cozy.wf import exp_wf
-from cozy.common import No, OrderedSet, unique, OrderedSet, StopException
+from cozy.common import No, OrderedSet, unique, OrderedSet, StopException, Periodically
 from cozy.solver import valid, solver_for_context, ModelCachingSolver
 from cozy.evaluation import construct_value
 from cozy.cost_model import CostModel, Order, LINEAR_TIME_UOPS
@@ -56,6 +57,16 @@ cost_pruning = Option("prune-using-cost", bool, False,
         + "than the current best. This makes Cozy faster since it caches "
         + "fewer expressions, but also makes Cozy slower since it needs to do "
         + "more work when it sees each one for the first time.")
+incremental_examples = Option("incremental-examples", bool, True,
+    description="When a candidate improvement turns out to be wrong, keep "
+        + "the enumerator's cache and extend it with the counterexample "
+        + "instead of enumerating everything again from scratch.")
+
+# How often a search checks `hints_callback` and `examples_callback` for
+# news.  The search checks for interruptions after every candidate, which is
+# far too often to pay for the callbacks (they may have to drain a
+# multiprocessing queue).
+POLL_INTERVAL = datetime.timedelta(seconds=1)
 
 # Options that control `possibly_useful`
 allow_conditional_state = Option("allow-conditional-state", bool, True,
@@ -94,6 +105,37 @@ def never_stop():
     """Takes no arguments, always returns False."""
     return False
 
+def no_new_hints():
+    """Takes no arguments, always returns None."""
+    return None
+
+def no_new_examples():
+    """Takes no arguments, always returns an empty list."""
+    return []
+
+def ignore_example(example):
+    """Takes one argument and does nothing."""
+    pass
+
+# A snapshot of the progress made by `improve`, used to continue the search
+# later (possibly in a different process).  The enumerator_* fields describe
+# the Enumerator of the search that was in progress and `size` is the size it
+# was working on; they are None if no search was in progress.
+SearchState = namedtuple("SearchState", (
+    "target",               # the best version of the target found so far
+    "examples",             # counterexamples found so far
+    "watched_targets",      # correct versions of the target being improved
+    "blacklist",            # see `search_for_improvements`
+    "hints",                # hints used by the search (see `improve`)
+    "enumerator_hints",
+    "enumerator_cache",
+    "enumerator_complete",
+    "size"))
+
+def ignore_search_state(state):
+    """Takes one argument and does nothing."""
+    pass
+
 def improve(
         target        : Exp,
         context       : Context,
@@ -102,7 +144,12 @@ def improve(
         hints         : [Exp]              = (),
         examples      : [{str:object}]     = (),
         cost_model    : CostModel          = None,
-        ops           : [Op]               = ()):
+        ops           : [Op]               = (),
+        hints_callback : Callable[[], Optional[List[Exp]]] = no_new_hints,
+        examples_callback : Callable[[], List[dict]] = no_new_examples,
+        counterexample_callback : Callable[[dict], Any] = ignore_example,
+        resume        : Optional[SearchState] = None,
+        checkpoint_callback : Callable[[SearchState], Any] = ignore_search_state):
     """Improve the target expression using enumerative synthesis.
 
     This function is a generator that yields increasingly better and better
@@ -112,6 +159,21 @@ def improve(
     It periodically calls `stop_callback` and exits gracefully when
     `stop_callback` returns True.
 
+    It also periodically calls `hints_callback`.  When that returns a list of
+    expressions instead of None, the list replaces `hints` and the search
+    restarts without forgetting the examples and targets found so far.
+
+    To share work with other searches over the same state, every new
+    counterexample is passed to `counterexample_callback`, and the examples
+    returned by periodic calls to `examples_callback` (which must bind every
+    variable in `context`) are used to answer solver queries without calling
+    the solver when possible.
+
+    A snapshot of the search is passed to `checkpoint_callback` at the start
+    of every round of enumeration and when the search is stopped.  Passing
+    the latest snapshot as `resume` to a later call with the same arguments
+    continues the search where it left off instead of starting over.
+
     Other parameters:
         - assumptions: a precondition.  The yielded improvements will only be
           correct when the assumptions are true.
@@ -146,7 +208,12 @@ def improve(
         hints={hints!r},
         examples={examples!r},
         cost_model={cost_model!r},
-        ops={ops!r})""".format(
+        ops={ops!r},
+        hints_callback={hints_callback!r},
+        examples_callback={examples_callback!r},
+        counterexample_callback={counterexample_callback!r},
+        resume={resume!r},
+        checkpoint_callback={checkpoint_callback!r})""".format(
             target=target,
             context=context,
             assumptions=assumptions,
@@ -154,7 +221,12 @@ def improve(
             hints=hints,
             examples=examples,
             cost_model=cost_model,
-            ops=ops))
+            ops=ops,
+            hints_callback=hints_callback,
+            examples_callback=examples_callback,
+            counterexample_callback=counterexample_callback,
+            resume=resume,
+            checkpoint_callback=checkpoint_callback))
 
     target = inline_lets(target)
     target = freshen_binders(target, context)
@@ -177,12 +249,16 @@ def improve(
         print("This job does not depend on state_vars.")
         # TODO: what can we do about it?
 
-    hints = ([freshen_binders(h, context) for h in hints]
-        + [freshen_binders(wrap_naked_statevars(a, state_vars), context) for a in break_conj(assumptions)]
+    extra_hints = (
+        [freshen_binders(wrap_naked_statevars(a, state_vars), context) for a in break_conj(assumptions)]
         + [target])
-    print("{} hints".format(len(hints)))
-    for h in hints:
-        print(" - {}".format(pprint(h)))
+    def prepare_hints(hints):
+        hints = [freshen_binders(h, context) for h in hints] + extra_hints
+        print("{} hints".format(len(hints)))
+        for h in hints:
+            print(" - {}".format(pprint(h)))
+        return hints
+    hints = prepare_hints(hints)
     vars = list(v for (v, p) in context.vars())
     funcs = context.funcs()
 
@@ -203,73 +279,183 @@ def improve(
 
     watched_targets = [target]
     blacklist = {}
-
-    while True:
-        # 1. find any potential improvement to any sub-exp of target
-        for new_target in search_for_improvements(
-                targets=watched_targets,
-                wf_solver=solver,
-                context=context,
-                examples=examples,
-                cost_model=cost_model,
-                stop_callback=stop_callback,
-                hints=hints,
-                ops=ops,
-                blacklist=blacklist):
-            print("Found candidate improvement: {}".format(pprint(new_target)))
-
-            # 2. check
-            with task("verifying candidate"):
-                counterexample = solver.satisfy(ENot(EEq(target, new_target)))
-
-            if counterexample is not None:
-                if counterexample in examples:
-                    print("assumptions = {!r}".format(assumptions))
-                    print("duplicate example: {!r}".format(counterexample))
-                    print("old target = {!r}".format(target))
-                    print("new target = {!r}".format(new_target))
-                    raise Exception("got a duplicate example")
-                # a. if incorrect: add example, restart
-                examples.append(counterexample)
-                print("new example: {!r}".format(counterexample))
-                print("wrong; restarting with {} examples".format(len(examples)))
-                break
+    enumerator_state = None
+
+    if resume is not None:
+        examples = list(resume.examples)
+        watched_targets = list(resume.watched_targets)
+        if not any(alpha_equivalent(target, t) for t in watched_targets):
+            if target not in retention_policy(resume.target, context, target, context, RUNTIME_POOL, cost_model):
+                print("continuing from the earlier search's target: {}".format(pprint(resume.target)))
+                target = resume.target
+                yield target
+                if heuristic_done(target):
+                    return
             else:
-                # b. if correct: yield it, watch the new target, goto 1
-                print("The candidate is valid!")
-                print(repr(new_target))
-                print("Determining whether to yield it...")
-                with task("updating frontier"):
-                    to_evict = []
-                    keep = True
-                    old_better = None
-                    for old_target in watched_targets:
-                        evc = retention_policy(new_target, context, old_target, context, RUNTIME_POOL, cost_model)
-                        if old_target not in evc:
-                            to_evict.append(old_target)
-                        if new_target not in evc:
-                            old_better = old_target
-                            keep = False
-                            break
-                    for t in to_evict:
-                        watched_targets.remove(t)
-                    if not keep:
-                        print("Whoops! Looks like we already found something better.")
-                        print(" --> {}".format(pprint(old_better)))
-                        continue
-                    if target in to_evict:
-                        print("Yep, it's an improvement!")
-                        yield new_target
-                        if heuristic_done(new_target):
-                            print("target now matches doneness heuristic")
-                            return
-                        target = new_target
+                watched_targets.insert(0, target)
+        blacklist = dict(resume.blacklist)
+        # The hints include the target that the earlier search started from.
+        # That is as good as our own target, and keeping it lets us reuse the
+        # earlier search's enumerator.
+        if len(resume.hints) == len(hints) and all(alpha_equivalent(h1, h2) for (h1, h2) in zip(resume.hints[:-1], hints[:-1])):
+            hints = list(resume.hints)
+        if resume.enumerator_cache is not None:
+            enumerator_state = (resume.enumerator_hints, resume.enumerator_cache, resume.enumerator_complete, resume.size)
+        print("resuming with {} examples and {} targets".format(len(examples), len(watched_targets)))
+
+    # The enumerator and size of the search in progress, if any.
+    current_search = []
+    def note_progress(enum, size):
+        current_search[:] = [(enum, size)]
+        checkpoint_callback(search_state())
+    def search_state():
+        if current_search:
+            enum, size = current_search[0]
+            return SearchState(target, list(examples), list(watched_targets), dict(blacklist), list(hints),
+                list(enum.hints), enum.cache, set(enum.complete), size)
+        return SearchState(target, list(examples), list(watched_targets), dict(blacklist), list(hints),
+            None, None, None, None)
+
+    # New hints that arrived in the middle of a search.  Receiving new hints
+    # interrupts the search the same way `stop_callback` does.
+    # Examples shared by other searches are handed to the solver in one
+    # batch per poll.  Hints that are alpha equivalent to the ones in use
+    # are ignored.
+    new_hints = []
+    def same_hints(h):
+        latest = new_hints[-1] if new_hints else hints
+        return (set(alpha_key(x) for x in itertools.chain(h, extra_hints))
+            == set(alpha_key(x) for x in latest))
+    def poll():
+        shared_examples = examples_callback()
+        if shared_examples:
+            added = solver.add_examples(shared_examples)
+            if added:
+                event("got {} shared examples ({} new)".format(len(shared_examples), added))
+        h = hints_callback()
+        if h is not None and not same_hints(h):
+            new_hints.append(h)
+    poller = Periodically(poll, timespan=POLL_INTERVAL)
+    def interrupt():
+        if stop_callback():
+            return True
+        poller.check()
+        return bool(new_hints)
+
+    # Every candidate is verified against the current target.  The target
+    # is encoded once (each time it changes) in its own solver scope, so
+    # that only the candidate is encoded for each check.
+    verification = [] # [(target, variable defined as target)] while the scope is open
+    def verification_formula(new_target):
+        if verification and verification[0][0] is not target:
+            solver.pop()
+            verification.clear()
+        if not verification:
+            solver.push()
+            verification.append((target, solver.define(target)))
+        return ENot(EEq(verification[0][1], new_target))
+
+    try:
+        while True:
+            # An enumerator to extend with a new counterexample once its search
+            # has been closed.
+            to_extend = None
+            try:
+                # 1. find any potential improvement to any sub-exp of target
+                for new_target in search_for_improvements(
+                        targets=watched_targets,
+                        wf_solver=solver,
+                        context=context,
+                        examples=examples,
+                        cost_model=cost_model,
+                        stop_callback=interrupt,
+                        hints=hints,
+                        ops=ops,
+                        blacklist=blacklist,
+                        resume=enumerator_state,
+                        progress_callback=note_progress):
+                    print("Found candidate improvement: {}".format(pprint(new_target)))
+                    last_search = current_search[0] if current_search else None
+                    enumerator_state = None
+                    current_search.clear()
+
+                    # 2. check
+                    with task("verifying candidate"):
+                        counterexample = solver.satisfy(verification_formula(new_target))
+
+                    if counterexample is not None:
+                        if counterexample in examples:
+                            print("assumptions = {!r}".format(assumptions))
+                            print("duplicate example: {!r}".format(counterexample))
+                            print("old target = {!r}".format(target))
+                            print("new target = {!r}".format(new_target))
+                            raise Exception("got a duplicate example")
+                        # a. if incorrect: add example, restart
+                        examples.append(counterexample)
+                        counterexample_callback(counterexample)
+                        print("new example: {!r}".format(counterexample))
+                        print("wrong; restarting with {} examples".format(len(examples)))
+                        if incremental_examples.value and last_search is not None:
+                            to_extend = last_search[0]
+                        break
                     else:
-                        print("Nope, it isn't substantially better!")
-
-                watched_targets.append(new_target)
-                print("Now watching {} targets".format(len(watched_targets)))
-                break
+                        # b. if correct: yield it, watch the new target, goto 1
+                        print("The candidate is valid!")
+                        print(repr(new_target))
+                        print("Determining whether to yield it...")
+                        with task("updating frontier"):
+                            to_evict = []
+                            keep = True
+                            old_better = None
+                            for old_target in watched_targets:
+                                evc = retention_policy(new_target, context, old_target, context, RUNTIME_POOL, cost_model)
+                                if old_target not in evc:
+                                    to_evict.append(old_target)
+                                if new_target not in evc:
+                                    old_better = old_target
+                                    keep = False
+                                    break
+                            for t in to_evict:
+                                watched_targets.remove(t)
+                            if not keep:
+                                print("Whoops! Looks like we already found something better.")
+                                print(" --> {}".format(pprint(old_better)))
+                                continue
+                            if target in to_evict:
+                                print("Yep, it's an improvement!")
+                                yield new_target
+                                if heuristic_done(new_target):
+                                    print("target now matches doneness heuristic")
+                                    return
+                                target = new_target
+                            else:
+                                print("Nope, it isn't substantially better!")
+
+                        watched_targets.append(new_target)
+                        print("Now watching {} targets".format(len(watched_targets)))
+                        break
+
+                if to_extend is not None:
+                    # The search has been closed, so its enumerator is idle.
+                    promoted = to_extend.add_examples([examples[-1]])
+                    print("reusing |cache|={} ({} newly distinguished expressions)".format(to_extend.cache_size(), promoted))
+                    enumerator_state = (list(to_extend.hints), to_extend.cache, set(to_extend.complete), 0)
+            except StopException:
+                if not new_hints:
+                    checkpoint_callback(search_state())
+                    raise
+                # Keep the interrupted search's cache; the next search
+                # resumes from it (see `search_for_improvements`).
+                if current_search:
+                    enum, size = current_search[0]
+                    enumerator_state = (list(enum.hints), enum.cache, set(enum.complete), size)
+                    current_search.clear()
+                hints = prepare_hints(new_hints[-1])
+                new_hints.clear()
+                print("restarting with new hints and {} examples".format(len(examples)))
+    finally:
+        if verification:
+            solver.pop()
 
 SearchInfo = namedtuple("SearchInfo", (
     "context",
@@ -289,7 +475,9 @@ def search_for_improvements(
         stop_callback : Callable[[], bool],
         hints         : [Exp],
         ops           : [Op],
-        blacklist     : {(Exp, Context, Pool, Exp) : str}):
+        blacklist     : {(Exp, Context, Pool, Exp) : str},
+        resume        = None,
+        progress_callback : Callable[[Enumerator, int], Any] = None):
     """Search for potential improvements to any of the target expressions.
 
     This function yields expressions that look like improvements (or are
@@ -297,6 +485,14 @@ def search_for_improvements(
     guaranteed to be correct on the given examples.
 
     This function may add new items to the given blacklist.
+
+    If given, `progress_callback(enumerator, size)` is called at the start of
+    each round of enumeration.  The `resume` parameter may be a tuple
+    (hints, cache, complete, size) describing the enumerator of an earlier
+    call with the same arguments, except possibly the hints.  If the hints
+    match, the search continues from that enumerator's cache at the given
+    size.  Otherwise it starts over from size 0, but it keeps the cached
+    expressions.
     """
 
     root_ctx = context
@@ -324,7 +520,24 @@ def search_for_improvements(
             hints=frags,
             heuristics=try_optimize,
             stop_callback=stop_callback,
-            do_eviction=enable_eviction.value)
+            do_eviction=enable_eviction.value,
+            keep_shadows=incremental_examples.value)
+
+    start_size = 0
+    if resume is not None:
+        saved_hints, cache, complete, saved_size = resume
+        if len(enum.hints) == len(saved_hints) and all(
+                p1 == p2 and alpha_equivalent(e1, e2) and ctx1.alpha_equivalent(ctx2)
+                for ((e1, ctx1, p1), (e2, ctx2, p2)) in zip(enum.hints, saved_hints)):
+            enum.load_state(cache, complete)
+            start_size = saved_size
+            print("resuming search at size {} with |cache|={}".format(start_size, enum.cache_size()))
+        else:
+            # Hints are expressions of size 0, so only the enumerations of
+            # size 0 depend on them.  The larger cached expressions are still
+            # valid; they just do not build on the new hints.
+            enum.load_state(cache, set(k for k in complete if k[1] > 0))
+            print("hints changed; restarting the search with |cache|={}".format(enum.cache_size()))
 
     target_fp = Fingerprint.of(targets[0], examples)
 
@@ -338,12 +551,14 @@ def search_for_improvements(
                     watches_by_context[ctx] = l
                 l.append((target, e, pool))
 
+        # Watched expressions keyed by the normal-equality key of their
+        # fingerprints, so each enumerated expression needs only one lookup.
         watches = OrderedDict()
         for ctx, exprs in watches_by_context.items():
             exs = ctx.instantiate_examples(examples)
             for target, e, pool in exprs:
                 fp = Fingerprint.of(e, exs)
-                k = (fp, ctx, pool)
+                k = (fp.normal_key(), ctx, pool)
                 l = watches.get(k)
                 if l is None:
                     l = []
@@ -361,25 +576,21 @@ def search_for_improvements(
         cost_model=cost_model,
         blacklist=blacklist)
 
-    size = 0
-    while True:
+    size = start_size
+    try:
+        while True:
 
-        print("starting minor iteration {} with |cache|={}".format(size, enum.cache_size()))
-        if stop_callback():
-            raise StopException()
-
-        for ctx, pool in watched_ctxs:
-            with task("searching for obvious substitutions", ctx=ctx, pool=pool_name(pool)):
-                for info in enum.enumerate_with_info(size=size, context=ctx, pool=pool):
-                    with task("searching for obvious substitution", expression=pprint(info.e)):
-                        fp = info.fingerprint
-                        for ((fpx, cc, pp), reses) in watches.items():
-                            if cc != ctx or pp != pool:
-                                continue
-
-                            if not fpx.equal_to(fp):
-                                continue
+            print("starting minor iteration {} with |cache|={}".format(size, enum.cache_size()))
+            if progress_callback is not None:
+                progress_callback(enum, size)
+            if stop_callback():
+                raise StopException()
 
+            for ctx, pool in watched_ctxs:
+                with task("searching for obvious substitutions", ctx=ctx, pool=pool_name(pool)):
+                    for info in enum.enumerate_with_info(size=size, context=ctx, pool=pool):
+                        with task("searching for obvious substitution", expression=pprint(info.e)):
+                            reses = watches.get((info.fingerprint.normal_key(), ctx, pool), ())
                             for target, watched_e in reses:
                                 replacement = info.e
                                 event("possible substitution: {} ---> {}".format(pprint(watched_e), pprint(replacement)))
@@ -391,37 +602,39 @@ def search_for_improvements(
 
                                 yield from _consider_replacement(target, watched_e, ctx, pool, replacement, search_info)
 
-        if check_blind_substitutions.value:
-            print("Guessing at substitutions...")
-            for target, e, ctx, pool in exploration_order(targets, root_ctx):
-                with task("checking substitutions",
-                        target=pprint(replace(target, root_ctx, RUNTIME_POOL, e, ctx, pool, EVar("___"))),
-                        e=pprint(e)):
-                    for info in enum.enumerate_with_info(size=size, context=ctx, pool=pool):
-                        with task("checking substitution", expression=pprint(info.e)):
-                            if stop_callback():
-                                raise StopException()
-                            replacement = info.e
-                            if replacement.type != e.type:
-                                event("wrong type (is {}, need {})".format(pprint(replacement.type), pprint(e.type)))
-                                continue
-                            if alpha_equivalent(replacement, e):
-                                event("no change")
-                                continue
-                            should_consider = should_consider_replacement(
-                                target, root_ctx,
-                                e, ctx, pool, Fingerprint.of(e, ctx.instantiate_examples(examples)),
-                                info.e, info.fingerprint)
-                            if not should_consider:
-                                event("skipped; `should_consider_replacement` returned {}".format(should_consider))
-                                continue
+            if check_blind_substitutions.value:
+                print("Guessing at substitutions...")
+                for target, e, ctx, pool in exploration_order(targets, root_ctx):
+                    with task("checking substitutions",
+                            target=pprint(replace(target, root_ctx, RUNTIME_POOL, e, ctx, pool, EVar("___"))),
+                            e=pprint(e)):
+                        for info in enum.enumerate_with_info(size=size, context=ctx, pool=pool):
+                            with task("checking substitution", expression=pprint(info.e)):
+                                if stop_callback():
+                                    raise StopException()
+                                replacement = info.e
+                                if replacement.type != e.type:
+                                    event("wrong type (is {}, need {})".format(pprint(replacement.type), pprint(e.type)))
+                                    continue
+                                if alpha_equivalent(replacement, e):
+                                    event("no change")
+                                    continue
+                                should_consider = should_consider_replacement(
+                                    target, root_ctx,
+                                    e, ctx, pool, Fingerprint.of(e, ctx.instantiate_examples(examples)),
+                                    info.e, info.fingerprint)
+                                if not should_consider:
+                                    event("skipped; `should_consider_replacement` returned {}".format(should_consider))
+                                    continue
 
-                            yield from _consider_replacement(target, e, ctx, pool, replacement, search_info)
+                                yield from _consider_replacement(target, e, ctx, pool, replacement, search_info)
 
-        if not enum.expressions_may_exist_above_size(context, RUNTIME_POOL, size):
-            raise StopException("no more expressions can exist above size={}".format(size))
+            if not enum.expressions_may_exist_above_size(context, RUNTIME_POOL, size):
+                raise StopException("no more expressions can exist above size={}".format(size))
 
-        size += 1
+            size += 1
+    finally:
+        enum.close()
 
 def _consider_replacement(
         target      : Exp,
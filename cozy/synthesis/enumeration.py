@@ -15,14 +15,19 @@ For more information on equivalence class deduplication, see section III.D on
     published in FMCAD 2013
 """
 
-from collections import namedtuple, defaultdict, OrderedDict
+from array import array
+from collections import namedtuple, defaultdict, OrderedDict, Counter, deque
 import datetime
 import itertools
 import functools
+import multiprocessing
+import os
+import tempfile
+import weakref
 
 from cozy.common import pick_to_sum, OrderedSet, unique, make_random_access, StopException, Periodically
 from cozy.syntax import (
-    Type, BOOL, INT,
+    Type, BOOL, INT, LONG, TEnum,
     Exp, ETRUE, EFALSE, ZERO, ONE, EVar, EUnaryOp, UOp, EBinOp, BOp, ECond, EEq,
     TTuple, ETupleGet,
     TRecord, THandle, EGetField,
@@ -37,18 +42,140 @@ from cozy.target_syntax import (
     TMap, EMakeMap2, EMapKeys, EMapGet, EHasKey)
 from cozy.structures import all_extension_handlers
 from cozy.syntax_tools import pprint, fresh_var, free_vars, freshen_binders, alpha_equivalent, all_types
-from cozy.evaluation import eval_bulk, construct_value, values_equal
+from cozy.evaluation import eval_bulk, construct_value
+from cozy.value_types import value_key
 from cozy.typecheck import is_numeric, is_collection, is_ordered, is_hashable
 from cozy.cost_model import CostModel, Order
 from cozy.pools import Pool, RUNTIME_POOL, STATE_POOL, pool_name
 from cozy.contexts import Context, RootCtx, UnderBinder, more_specific_context
 from cozy.logging import task, task_begin, task_end, event, verbose
+from cozy.solver import solver_cache, encoding_stats, deepening_stats
 from cozy.opts import Option
+from cozy import wire
 
 do_enumerate = Option("enumeration", bool, True,
     description="Enable brute-force enumeration.  "
         + "Disabling this option cripples Cozy, but makes the effect of the "
         + "acceleration rules more apparent.")
+enumeration_workers = Option("enumeration-workers", int, 0,
+    description="Number of worker processes that each query's enumerator "
+        + "uses to check and fingerprint candidate expressions.  "
+        + "0 disables parallel enumeration.",
+    metavar="N")
+enumeration_cache_limit = Option("enumeration-cache-limit", int, 0,
+    description="Maximum number of expressions that each query's enumerator "
+        + "keeps in memory.  When there are more, the largest expressions "
+        + "in the least recently used contexts are spilled to disk (see "
+        + "--enumeration-cache-spill-dir) or forgotten and enumerated again "
+        + "if they are needed later.  0 means no limit.",
+    metavar="N")
+enumeration_max_shadows = Option("enumeration-max-shadows", int, 4,
+    description="Maximum number of skipped or evicted expressions that each "
+        + "query's enumerator remembers for each equivalence class of cached "
+        + "expressions (see --incremental-examples).  When new examples split "
+        + "a class that had more, the sizes they came from are enumerated "
+        + "again.  0 means no limit.",
+    metavar="N")
+enumeration_cache_spill_dir = Option("enumeration-cache-spill-dir", str, "",
+    description="Directory where enumerators spill expressions that do not "
+        + "fit under --enumeration-cache-limit.  By default, those "
+        + "expressions are forgotten instead.",
+    metavar="DIR")
+
+bottom_up_fingerprints = Option("bottom-up-fingerprints", bool, True,
+    description="Compute the fingerprint of each enumerated expression from "
+        + "the cached fingerprints of its subexpressions instead of "
+        + "evaluating the whole expression on every example.")
+
+fingerprint_before_wf = Option("fingerprint-before-wf", bool, True,
+    description="Look up each enumerated expression's fingerprint in the "
+        + "cache before checking that it is well-formed, so that the "
+        + "(solver-based) check is skipped for expressions that would be "
+        + "discarded in favor of an equivalent one anyway.")
+
+# Number of candidate expressions sent to a worker process at once.
+PARALLEL_BATCH_SIZE = 32
+
+# Number of (pool, size, context) requests whose adapted expressions each
+# Enumerator remembers (see Enumerator.enumerate_with_info).
+ADAPTED_CACHE_SIZE = 256
+
+# Fingerprints store their outputs as packed columns (see _encode_column).
+# Columns of these array typecodes hold the values themselves:
+_INT_COLUMN  = "q" # ints (for INT and LONG)
+_BOOL_COLUMN = "b" # bools
+_ENUM_COLUMN = "h" # indexes into TEnum.cases
+# ... while columns of this typecode hold ids into a ValueTable:
+_ID_COLUMN   = "i"
+
+_ITEM_SIZES = { code : array(code).itemsize for code in (_INT_COLUMN, _BOOL_COLUMN, _ENUM_COLUMN, _ID_COLUMN) }
+
+class ValueTable(object):
+    """Distinct output values of fingerprints, by type.
+
+    Enumerators see the same values over and over (the empty bag, the
+    examples' collections, ...), so the fingerprints in one ExpCache share
+    one copy of each distinct value through the cache's table.  Fingerprints
+    made elsewhere get a table of their own.  A table lives as long as the
+    fingerprints that use it.
+    """
+    __slots__ = ("ids", "values")
+
+    def __init__(self):
+        self.ids = {}    # Type -> {value: id}
+        self.values = {} # Type -> [value]
+
+    def intern(self, t : Type, v) -> int:
+        ids = self.ids.get(t)
+        if ids is None:
+            ids = self.ids[t] = {}
+            self.values[t] = []
+        i = ids.get(v)
+        if i is None:
+            values = self.values[t]
+            i = len(values)
+            ids[v] = i
+            values.append(v)
+        return i
+
+    def __len__(self):
+        return sum(len(values) for values in self.values.values())
+
+def _encode_column(t : Type, outputs : [object], table : ValueTable) -> (str, bytes, ValueTable):
+    """Pack the outputs of an expression of type `t` into a column.
+
+    Returns the column's typecode and contents, and the table that holds the
+    column's values (None if the column holds the values themselves).  If
+    `table` is None and a table is needed, a new one is made.  Two columns
+    in the same table are equal exactly when the outputs are deeply equal.
+    """
+    try:
+        if t == INT or t == LONG:
+            return (_INT_COLUMN, array(_INT_COLUMN, outputs).tobytes(), None)
+        if t == BOOL:
+            return (_BOOL_COLUMN, array(_BOOL_COLUMN, outputs).tobytes(), None)
+        if isinstance(t, TEnum):
+            return (_ENUM_COLUMN, array(_ENUM_COLUMN, [t.cases.index(v) for v in outputs]).tobytes(), None)
+    except (OverflowError, TypeError, ValueError):
+        # e.g. an int that does not fit in 64 bits
+        pass
+    if table is None:
+        table = ValueTable()
+    return (_ID_COLUMN, array(_ID_COLUMN, [table.intern(t, v) for v in outputs]).tobytes(), table)
+
+def _decode_column(t : Type, code : str, data : bytes, table : ValueTable) -> tuple:
+    column = array(code)
+    column.frombytes(data)
+    if code == _INT_COLUMN:
+        return tuple(column)
+    if code == _BOOL_COLUMN:
+        return tuple(bool(x) for x in column)
+    if code == _ENUM_COLUMN:
+        return tuple(t.cases[i] for i in column)
+    if not column:
+        return ()
+    values = table.values[t]
+    return tuple(values[i] for i in column)
 
 @functools.total_ordering
 class Fingerprint(object):
@@ -64,30 +191,61 @@ class Fingerprint(object):
     equivalence classes.  It uses fingerprints as keys into a map to quickly
     determine whether a semantically-equivalent version of an expression
     exists.  While fingerprints derived from different example inputs might have
-    different sizes, the behavior here is safe since the set of examples is
-    fixed at construction time for any one Enumerator class.
+    different sizes, the behavior here is safe since any one Enumerator extends
+    all of its fingerprints at once when it gets new examples.
 
     External clients need to be more careful about how they use Fingerprints:
     comparisons between two Fingerprints are meaningless if they were derived
     from different inputs.  Clients also need to be aware that fingerprint
     equality does not imply full semantic equivalence between expressions.
+
+    Enumerators keep a lot of fingerprints, so the outputs are stored as a
+    packed column: ints, bools, and enum cases are stored directly, and other
+    values are replaced by ids into a ValueTable.  Deep equality between
+    fingerprints in the same table only looks at the packed bytes.
     """
-    __slots__ = ("type", "outputs")
+    __slots__ = ("type", "_code", "_data", "_table", "_hash", "_normal_key")
 
     @staticmethod
-    def of(e : Exp, inputs : [{str:object}]):
-        """Compute the fingerprint of an expression over the given inputs."""
-        return Fingerprint(e.type, eval_bulk(e, inputs))
+    def of(e : Exp, inputs : [{str:object}], table : ValueTable = None):
+        """Compute the fingerprint of an expression over the given inputs.
+
+        If given, `table` holds the fingerprint's values (see ValueTable).
+        """
+        return Fingerprint(e.type, eval_bulk(e, inputs), table)
 
-    def __init__(self, type : Type, outputs : [object]):
+    def __init__(self, type : Type, outputs : [object], table : ValueTable = None):
         self.type = type
-        self.outputs = tuple(outputs)
+        self._code, self._data, self._table = _encode_column(type, outputs, table)
+        self._hash = None
+        self._normal_key = None
+
+    def in_table(self, table : ValueTable):
+        """An equal fingerprint whose values are held by `table`."""
+        if self._table is None or self._table is table:
+            return self
+        return Fingerprint(self.type, self.outputs, table)
+
+    def __reduce__(self):
+        # Value ids are specific to this process, so send the values.  The
+        # normal-equality key is a cache; don't save it.
+        return (Fingerprint, (self.type, self.outputs))
+
+    @property
+    def outputs(self) -> tuple:
+        """The expression's output on each input."""
+        return _decode_column(self.type, self._code, self._data, self._table)
 
     def _as_tuple(self):
         return (self.type, self.outputs)
 
     def __hash__(self) -> int:
-        return hash(self._as_tuple())
+        h = self._hash
+        if h is None:
+            # ids depend on the table, so hash the values themselves
+            h = hash((self.type, self._data if self._table is None else self.outputs))
+            self._hash = h
+        return h
 
     def __eq__(self, other) -> bool:
         """Test for deep equality.
@@ -101,16 +259,27 @@ class Fingerprint(object):
         """
         if not isinstance(other, Fingerprint):
             return NotImplemented
-        return self._as_tuple() == other._as_tuple()
+        if self._code != other._code or self.type != other.type:
+            return False
+        if self._table is other._table:
+            return self._data == other._data
+        return self.outputs == other.outputs
 
     def __lt__(self, other) -> bool:
         if not isinstance(other, Fingerprint):
             return NotImplemented
         return self._as_tuple() < other._as_tuple()
 
+    def extend(self, outputs : [object]):
+        """The fingerprint over this one's inputs followed by some new ones.
+
+        The `outputs` are the expression's outputs on the new inputs.
+        """
+        return Fingerprint(self.type, self.outputs + tuple(outputs), self._table)
+
     def __len__(self) -> int:
         """Returns the number of examples used to compute this fingerprint."""
-        return len(self.outputs)
+        return len(self._data) // _ITEM_SIZES[self._code]
 
     def __repr__(self):
         return "Fingerprint{!r}".format(self._as_tuple())
@@ -133,10 +302,21 @@ class Fingerprint(object):
         compare_values in value_types.py.
         """
         self._require_comparable_to(other)
-        return (
-            self.type == other.type
-            and len(self.outputs) == len(other.outputs)
-            and all(values_equal(self.type, v1, v2) for (v1, v2) in zip(self.outputs, other.outputs)))
+        return self.normal_key() == other.normal_key()
+
+    def normal_key(self):
+        """A hashable key for this fingerprint under normal equality.
+
+        Two fingerprints have the same key exactly when `equal_to` holds
+        between them, so the key can be used to look up fingerprints by
+        normal equality in a dictionary.
+        """
+        k = self._normal_key
+        if k is None:
+            t = self.type
+            k = (t, tuple(value_key(t, v) for v in self.outputs))
+            self._normal_key = k
+        return k
 
     def subset_of(self, other) -> bool:
         """Test for subset inclusion.
@@ -163,8 +343,60 @@ EnumeratedExp = namedtuple("EnumeratedExp", [
     "size",             # The size at which the expression was first discovered
     ])
 
+class _UncheckedExp(EnumeratedExp):
+    """A shadow that has not been checked with `check_wf` yet.
+
+    With --fingerprint-before-wf, candidates that only become shadows are
+    not checked; Enumerator.add_examples checks them if they are ever moved
+    into the cache.
+    """
+    __slots__ = ()
+
 LITERALS = (ETRUE, EFALSE, ZERO, ONE)
 
+# Expression types whose subexpressions are all evaluated in the same
+# environment as the expression itself.  The enumerator can compute their
+# fingerprints from the fingerprints of their subexpressions.  Expressions
+# with binders (EMap, ELet, ...) evaluate their bodies in other environments
+# and have to be evaluated in full.
+_BOTTOM_UP_TYPES = (
+    EUnaryOp, EBinOp, ECond,
+    EGetField, ETupleGet,
+    ESingleton, EListGet, EListSlice,
+    EMapKeys, EMapGet, EHasKey)
+
+def _fingerprint_from_children(e : Exp, known : {int:EnumeratedExp}, inputs : [{str:object}], table : ValueTable = None) -> Fingerprint:
+    """Compute the fingerprint of `e` from its subexpressions' fingerprints.
+
+    The `known` map goes from the ids of cached expressions to their cache
+    entries.  The result's values are held by `table`, as for
+    Fingerprint.of.  Returns None if `e` is not one of the _BOTTOM_UP_TYPES or if
+    one of its subexpressions is not in `known`.
+
+    The operator at the root of `e` is evaluated on the subexpressions'
+    outputs, so the cost is proportional to the number of inputs rather than
+    to the size of `e`.
+    """
+    if type(e) not in _BOTTOM_UP_TYPES:
+        return None
+    args = []
+    columns = []
+    for child in e.children():
+        if isinstance(child, Exp):
+            entry = known.get(id(child))
+            if entry is None:
+                return None
+            v = EVar("_c{}".format(len(columns))).with_type(child.type)
+            args.append(v)
+            columns.append(entry.fingerprint.outputs)
+        else:
+            args.append(child)
+    op = type(e)(*args).with_type(e.type)
+    if not columns:
+        return Fingerprint.of(op, inputs, table)
+    names = ["_c{}".format(i) for i in range(len(columns))]
+    return Fingerprint(e.type, eval_bulk(op, [dict(zip(names, row)) for row in zip(*columns)]), table)
+
 def of_type(exps : [Exp], t : Type):
     """Filter `exps` to expressions of the given type."""
     for e in exps:
@@ -250,18 +482,79 @@ class ExpCache(object):
     efficiently
      - count how many tuples are in the cache (__len__)
      - find all unique contexts (all_contexts)
+     - find the context that is alpha equivalent to a given one (canonical_context)
      - find all expressions of a given size (find_expressions_of_size)
      - find all expressions with a given fingerprint (find_equivalent_expressions)
+
+    The cache can also hold "shadows": expressions that were skipped or
+    evicted in favor of an equivalent cached expression.  Shadows are not
+    part of the bag.  They are kept so that the cache can be updated when new
+    examples show that a shadow is not equivalent to anything in the cache
+    after all (see Enumerator.add_examples).  At most `max_shadows` shadows
+    are kept for each fingerprint; the sizes of the others are recorded in
+    `shadow_overflow`.
+
+    The fingerprints in the cache share one ValueTable (`values`).  Values
+    of expressions that leave the cache stay in the table until
+    `compact_values` rebuilds it.
     """
 
-    def __init__(self):
-        """Construct an empty cache."""
+    def __init__(self, limit : int = 0, spill_dir : str = None, max_shadows : int = 0):
+        """Construct an empty cache.
+
+        The `limit` and `spill_dir` parameters are described in
+        `Enumerator.shrink_cache`.  A `max_shadows` of 0 means no limit.
+        """
         self.data = OrderedDict() # (Pool, Context) -> (size -> [EnumeratedExp], Fingerprint -> [EnumeratedExp])
+        self.shadows = OrderedDict() # (Pool, Context) -> [EnumeratedExp]
+        self.shadow_counts = {}      # (Pool, Context) -> Fingerprint -> number of shadows
+        self.shadow_overflow = {}    # (Pool, Context) -> sizes of shadows that were not kept
+        self.max_shadows = max_shadows
+        self.contexts = {}           # Context.alpha_key() -> Context
+        self.versions = {}           # (Pool, Context) -> number of changes
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self._init_spilling()
+        self._init_values()
+
+    def _init_values(self):
+        self.values = ValueTable()
+        self.values_after_compaction = 0 # len(self.values) after the last compact_values
+
+    def _init_spilling(self):
+        self.spilled = {}              # (Pool, Context) -> size -> path of spill file
+        self.spilled_fingerprints = {} # (Pool, Context) -> hash(Fingerprint) -> {size}
+        self.spill_files = set()
+        weakref.finalize(self, _remove_files, self.spill_files)
+        self.last_use = {}             # (Pool, Context) -> value of self.clock
+        self.clock = 0
+        self.dropped = 0               # number of expressions dropped
+        self.spills = 0                # number of expressions written to disk
+        self.reloads = 0               # number of expressions read back
+
+    def __getstate__(self):
+        self.reload_all()
+        state = dict(self.__dict__)
+        for attr in ("spilled", "spilled_fingerprints", "spill_files", "values", "values_after_compaction", "shadow_counts"):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self._init_spilling()
+        self.__dict__.update(state)
+        self.shadow_counts = {} # recounted by compact_values
+        # unpickled fingerprints each have a table of their own
+        self._init_values()
+        self.compact_values()
 
     def __len__(self):
         """Return the total number of cached expressions across all contexts and pools."""
         return sum(sum(len(l) for l in d.values()) for d, _ in self.data.values())
 
+    def in_memory(self):
+        """Return the number of expressions and shadows held in memory."""
+        return len(self) + sum(len(l) for l in self.shadows.values())
+
     def add(self, context : Context, pool : Pool, enumerated_exp : EnumeratedExp):
         """Insert an expression into the cache for a given context and pool.
 
@@ -273,6 +566,10 @@ class ExpCache(object):
         if storage is None:
             storage = (defaultdict(list), defaultdict(list))
             self.data[key] = storage
+            self.contexts.setdefault(context.alpha_key(), context)
+        self._touch(key)
+        self._changed(key)
+        enumerated_exp = self._adopt(enumerated_exp)
         by_size, by_fingerprint = storage
         by_size[enumerated_exp.size].append(enumerated_exp)
         by_fingerprint[enumerated_exp.fingerprint].append(enumerated_exp)
@@ -289,21 +586,255 @@ class ExpCache(object):
         by_size, by_fingerprint = self.data[key]
         by_size[enumerated_exp.size].remove(enumerated_exp)
         by_fingerprint[enumerated_exp.fingerprint].remove(enumerated_exp)
+        self._changed(key)
+
+    def add_shadow(self, context : Context, pool : Pool, enumerated_exp : EnumeratedExp):
+        """Remember an expression that was left out of the cache.
+
+        If its fingerprint already has `max_shadows` shadows, only its size
+        is recorded (in `shadow_overflow`).
+        """
+        key = (pool, context)
+        counts = self.shadow_counts.get(key)
+        if counts is None:
+            counts = self.shadow_counts[key] = Counter()
+        if self.max_shadows and counts[enumerated_exp.fingerprint] >= self.max_shadows:
+            self.shadow_overflow.setdefault(key, set()).add(enumerated_exp.size)
+            return
+        shadows = self.shadows.get(key)
+        if shadows is None:
+            shadows = []
+            self.shadows[key] = shadows
+        enumerated_exp = self._adopt(enumerated_exp)
+        shadows.append(enumerated_exp)
+        counts[enumerated_exp.fingerprint] += 1
+
+    def set_shadows(self, context : Context, pool : Pool, shadows : [EnumeratedExp]):
+        """Replace the shadows for a context and pool."""
+        key = (pool, context)
+        self.shadows[key] = shadows
+        self._count_shadows(key)
+
+    def _count_shadows(self, key):
+        self.shadow_counts[key] = Counter(entry.fingerprint for entry in self.shadows.get(key, ()))
+
+    def _adopt(self, enumerated_exp : EnumeratedExp, table : ValueTable = None) -> EnumeratedExp:
+        """Move an entry's fingerprint into this cache's value table."""
+        fp = enumerated_exp.fingerprint
+        new_fp = fp.in_table(self.values if table is None else table)
+        return enumerated_exp if new_fp is fp else enumerated_exp._replace(fingerprint=new_fp)
+
+    def maybe_compact_values(self, min_size : int = 4096):
+        """Call `compact_values` if the value table has doubled since the last time."""
+        if len(self.values) > max(min_size, 2 * self.values_after_compaction):
+            self.compact_values()
+
+    def compact_values(self):
+        """Rebuild the value table from the expressions held in memory.
+
+        This forgets the values of expressions that were removed, dropped,
+        or spilled.  The cache's lists and dictionaries are updated in place.
+        """
+        table = ValueTable()
+        adopted = {} # id(old entry) -> new entry
+        def adopt(entry):
+            new_entry = adopted.get(id(entry))
+            if new_entry is None:
+                new_entry = adopted[id(entry)] = self._adopt(entry, table)
+            return new_entry
+        for by_size, by_fingerprint in self.data.values():
+            for entries in by_size.values():
+                entries[:] = [adopt(entry) for entry in entries]
+            old = list(by_fingerprint.items())
+            by_fingerprint.clear()
+            for fp, entries in old:
+                if entries:
+                    by_fingerprint[fp.in_table(table)] = [adopt(entry) for entry in entries]
+        for key, shadows in self.shadows.items():
+            shadows[:] = [adopt(entry) for entry in shadows]
+            self._count_shadows(key)
+        self.values = table
+        self.values_after_compaction = len(table)
+
+    def retain(self, keep):
+        """Drop every expression and shadow for which `keep(pool, size, context)` is false."""
+        for (pool, context), sizes in self.spilled.items():
+            for size in [size for size in sizes if not keep(pool, size, context)]:
+                os.remove(self._forget_spill_file((pool, context), size))
+        for (pool, context), (by_size, by_fingerprint) in self.data.items():
+            self._changed((pool, context))
+            for size in list(by_size.keys()):
+                if not keep(pool, size, context):
+                    for entry in by_size.pop(size):
+                        by_fingerprint[entry.fingerprint].remove(entry)
+            for fp in [fp for (fp, entries) in by_fingerprint.items() if not entries]:
+                del by_fingerprint[fp]
+        for (pool, context), shadows in self.shadows.items():
+            shadows[:] = [entry for entry in shadows if keep(pool, entry.size, context)]
+            self._count_shadows((pool, context))
+        for (pool, context), sizes in self.shadow_overflow.items():
+            sizes.intersection_update([size for size in sizes if keep(pool, size, context)])
 
     def all_contexts(self) -> [Context]:
         """Iterate over the unique contexts that the cache has seen."""
         return unique(context for pool, context in self.data.keys())
 
+    def canonical_context(self, context : Context) -> Context:
+        """Return the first context seen by the cache that is alpha equivalent to `context`.
+
+        Returns `context` itself if there is no such context.
+        """
+        return self.contexts.get(context.alpha_key(), context)
+
+    def version(self, context : Context, pool : Pool) -> int:
+        """A number that changes whenever expressions in the given context and pool are added or removed."""
+        return self.versions.get((pool, context), 0)
+
+    def _changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
     def find_expressions_of_size(self, context : Context, pool : Pool, size : int) -> [EnumeratedExp]:
         """Iterate over all expressions of the given size in the given context and pool."""
         key = (pool, context)
+        self._touch(key)
+        if size in self.spilled.get(key, ()):
+            self._reload(key, size)
         yield from self.data.get(key, ({}, {}))[0].get(size, ())
 
     def find_equivalent_expressions(self, context : Context, pool : Pool, fingerprint : Fingerprint) -> [EnumeratedExp]:
         """Iterate over all expressions with the given fingerprint in the given context and pool."""
         key = (pool, context)
+        self._touch(key)
+        spilled_fingerprints = self.spilled_fingerprints.get(key)
+        if spilled_fingerprints:
+            for size in list(spilled_fingerprints.get(hash(fingerprint), ())):
+                self._reload(key, size)
         yield from self.data.get(key, ({}, {}))[1].get(fingerprint, ())
 
+    def _touch(self, key):
+        self.clock += 1
+        self.last_use[key] = self.clock
+
+    def keys_by_age(self) -> [(Pool, Context)]:
+        """The (pool, context) keys of the cache, least recently used first."""
+        return sorted(self.data.keys(), key=lambda k: self.last_use.get(k, 0))
+
+    def largest_size_in_memory(self, context : Context, pool : Pool) -> int:
+        """The largest size with expressions or shadows in memory, or None."""
+        key = (pool, context)
+        sizes = [size for size, entries in self.data.get(key, ({}, {}))[0].items() if entries]
+        sizes.extend(entry.size for entry in self.shadows.get(key, ()))
+        return max(sizes) if sizes else None
+
+    def _pop_size(self, key, size) -> ([EnumeratedExp], [EnumeratedExp]):
+        """Remove and return the expressions and shadows of one size."""
+        entries = []
+        if key in self.data:
+            self._changed(key)
+            by_size, by_fingerprint = self.data[key]
+            entries = by_size.pop(size, [])
+            for entry in entries:
+                l = by_fingerprint[entry.fingerprint]
+                l.remove(entry)
+                if not l:
+                    del by_fingerprint[entry.fingerprint]
+        shadows = self.shadows.get(key, [])
+        popped_shadows = [entry for entry in shadows if entry.size == size]
+        shadows[:] = [entry for entry in shadows if entry.size != size]
+        self._count_shadows(key)
+        return (entries, popped_shadows)
+
+    def drop(self, context : Context, pool : Pool, size : int):
+        """Forget the expressions and shadows of the given size."""
+        key = (pool, context)
+        entries, shadows = self._pop_size(key, size)
+        self.shadow_overflow.get(key, set()).discard(size)
+        self.dropped += len(entries) + len(shadows)
+
+    def spill(self, context : Context, pool : Pool, size : int):
+        """Move the expressions and shadows of the given size to disk.
+
+        They are read back automatically when a lookup needs them.
+        """
+        key = (pool, context)
+        entries, shadows = self._pop_size(key, size)
+        fd, path = tempfile.mkstemp(prefix="cozy-cache-", dir=self.spill_dir)
+        self.spill_files.add(path)
+        with os.fdopen(fd, "wb") as f:
+            wire.dump((entries, shadows), f)
+        self.spilled.setdefault(key, {})[size] = path
+        spilled_fingerprints = self.spilled_fingerprints.setdefault(key, {})
+        for entry in entries:
+            spilled_fingerprints.setdefault(hash(entry.fingerprint), set()).add(size)
+        self.spills += len(entries) + len(shadows)
+
+    def _forget_spill_file(self, key, size) -> str:
+        path = self.spilled[key].pop(size)
+        spilled_fingerprints = self.spilled_fingerprints[key]
+        for h, sizes in list(spilled_fingerprints.items()):
+            sizes.discard(size)
+            if not sizes:
+                del spilled_fingerprints[h]
+        self.spill_files.discard(path)
+        return path
+
+    def _reload(self, key, size):
+        path = self._forget_spill_file(key, size)
+        try:
+            with open(path, "rb") as f:
+                entries, shadows = wire.load(f)
+        finally:
+            os.remove(path)
+        pool, context = key
+        for entry in entries:
+            self.add(context, pool, entry)
+        self.shadows.setdefault(key, []).extend(shadows)
+        self._count_shadows(key)
+        self.reloads += len(entries) + len(shadows)
+
+    def reload_all(self):
+        """Read every spilled expression back into memory."""
+        for key, sizes in list(self.spilled.items()):
+            for size in list(sizes):
+                self._reload(key, size)
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# State of an enumeration worker process.  The worker is forked from the
+# process that owns the Enumerator, so it inherits these without pickling.
+_worker_check_wf = None
+_worker_examples = None
+_worker_instantiated_examples = {}
+
+def _init_worker(check_wf, examples):
+    global _worker_check_wf, _worker_examples
+    _worker_check_wf = check_wf
+    _worker_examples = examples
+    _worker_instantiated_examples.clear()
+
+def _check_batch(context : Context, pool : Pool, batch : [Exp]) -> [(object, Fingerprint)]:
+    """Compute (wf, fingerprint) for each expression in a batch.
+
+    The fingerprint is None for expressions that are not well-formed.  This
+    runs in an enumeration worker process.
+    """
+    examples = _worker_instantiated_examples.get(context)
+    if examples is None:
+        if len(_worker_instantiated_examples) > 100:
+            _worker_instantiated_examples.clear()
+        examples = context.instantiate_examples(_worker_examples)
+        _worker_instantiated_examples[context] = examples
+    res = []
+    for e in batch:
+        wf = _worker_check_wf(e, context, pool)
+        res.append((wf, Fingerprint.of(e, examples) if wf else None))
+    return res
+
 class Enumerator(object):
     """Brute-force enumerator for expressions in order of AST size.
 
@@ -314,9 +845,17 @@ class Enumerator(object):
      - if two expressions behave the same on all examples, only the better one
        is kept in the cache (although clients might still see the worse one if
        it gets discovered first)
+     - it can spread the work of checking and fingerprinting candidates over
+       several worker processes; deduplication still happens in this process,
+       so the output is the same as with no workers
+     - new examples can be added with `add_examples`, which refines the
+       cached equivalence classes instead of starting over
+
+    Enumerators that use workers should be closed with `close` when they are
+    no longer needed.
     """
 
-    def __init__(self, examples, cost_model : CostModel, check_wf=None, hints=None, heuristics=None, stop_callback=None, do_eviction=True):
+    def __init__(self, examples, cost_model : CostModel, check_wf=None, hints=None, heuristics=None, stop_callback=None, do_eviction=True, workers=None, keep_shadows=False):
         """Set up a fresh enumerator.
 
         Parameters:
@@ -331,10 +870,18 @@ class Enumerator(object):
            enumeration
          - do_eviction: boolean. if true, this class spends time
            trying to evict older, slower versions of expressions from its cache
+         - workers: number of worker processes to use; defaults to the value
+           of the --enumeration-workers option
+         - keep_shadows: boolean. if true, the cache remembers expressions
+           that it skips or evicts in favor of equivalent ones.  This is
+           required by `add_examples`.
         """
         self.examples = list(examples)
         self.cost_model = cost_model
-        self.cache = ExpCache()
+        self.cache = ExpCache(
+            limit=enumeration_cache_limit.value,
+            spill_dir=enumeration_cache_spill_dir.value or None,
+            max_shadows=enumeration_max_shadows.value)
 
         # Set of (pool, size, context) tuples that are currently being
         # enumerated.  This is used to catch infinite recursion bugs, since
@@ -364,14 +911,180 @@ class Enumerator(object):
             stop_callback = lambda: False
         self.stop_callback = stop_callback
         self.do_eviction = do_eviction
+        if workers is None:
+            workers = enumeration_workers.value
+        self.workers = workers
+        self.worker_pool = None
+        self.keep_shadows = keep_shadows
+
+        # (pool, size, context) -> (cache version, [EnumeratedExp]) for
+        # requests in contexts that are only alpha equivalent to the ones in
+        # the cache, most recently used last.
+        self.adapted = OrderedDict()
+
+        self.wf_checks = 0         # calls to check_wf
+        self.wf_checks_avoided = 0 # candidates discarded without calling check_wf
         self.stat_timer = Periodically(self.print_stats, timespan=datetime.timedelta(seconds=2))
 
+    def close(self):
+        """Stop this enumerator's worker processes, if any."""
+        if self.worker_pool is not None:
+            self.worker_pool.terminate()
+            self.worker_pool.join()
+            self.worker_pool = None
+
     def print_stats(self):
-        print("  |cache|={}".format(self.cache_size()))
+        cache = self.cache
+        if cache.limit:
+            print("  |cache|={} (limit={}, dropped={}, spilled={}, reloaded={})".format(
+                self.cache_size(), cache.limit, cache.dropped, cache.spills, cache.reloads))
+        else:
+            print("  |cache|={}".format(self.cache_size()))
+        print("  wf checks: {} (avoided {})".format(self.wf_checks, self.wf_checks_avoided))
+        print("  solver cache: {}".format(solver_cache))
+        print("  encoding memo: {}".format(encoding_stats))
+        print("  iterative deepening: {}".format(deepening_stats))
 
     def cache_size(self):
         return len(self.cache)
 
+    def load_state(self, cache : ExpCache, complete : {(Pool, int, Context)}):
+        """Continue from the `cache` and `complete` set of an earlier Enumerator.
+
+        The earlier enumerator must have used the same examples and cost
+        model as this one.  If it used different hints, `complete` must not
+        include enumerations of size 0, where the hints appear.  It may have
+        been interrupted in the middle of an enumeration; expressions
+        discovered by unfinished enumerations are dropped, and those
+        enumerations will be redone.
+        """
+        cache.retain(lambda pool, size, context: (pool, size, context) in complete)
+        cache.limit = self.cache.limit
+        cache.spill_dir = self.cache.spill_dir
+        cache.max_shadows = self.cache.max_shadows
+        self.cache = cache
+        self.complete = set(complete)
+        self.in_progress = set()
+        self.adapted.clear()
+
+    def shrink_cache(self):
+        """Bring the cache under its limit, if it has one.
+
+        The cache's limit is a maximum number of expressions and shadows to
+        keep in memory.  This method removes the largest expressions of the
+        least recently used (pool, context) pairs until the cache is under
+        its limit.  If the cache has a spill directory, they are written
+        there and read back on demand; otherwise they are forgotten and
+        their sizes are enumerated again if needed.  Removing the largest
+        expressions first keeps the cache consistent: no cached expression
+        is larger than one that was forgotten.
+
+        Pairs that are being enumerated right now are left alone.
+        """
+        cache = self.cache
+        cache.maybe_compact_values()
+        if not cache.limit or cache.in_memory() <= cache.limit:
+            return
+        busy = set((pool, context) for (pool, size, context) in self.in_progress)
+        with task("shrinking cache", size=cache.in_memory(), limit=cache.limit):
+            for (pool, context) in cache.keys_by_age():
+                if (pool, context) in busy:
+                    continue
+                while cache.in_memory() > cache.limit:
+                    size = cache.largest_size_in_memory(context, pool)
+                    if size is None:
+                        break
+                    if cache.spill_dir is not None:
+                        event("spilling size {} of {}/{}".format(size, context, pool_name(pool)))
+                        cache.spill(context, pool, size)
+                    else:
+                        event("dropping size {} of {}/{}".format(size, context, pool_name(pool)))
+                        cache.drop(context, pool, size)
+                        self.complete.discard((pool, size, context))
+                if cache.in_memory() <= cache.limit:
+                    break
+
+    def add_examples(self, new_examples):
+        """Add examples to this enumerator without discarding its cache.
+
+        Each cached fingerprint is extended with the outputs on the new
+        examples; nothing is evaluated on the old examples again.  The new
+        examples may distinguish expressions that used to look equivalent.
+        Cached expressions that become distinguishable simply end up in
+        different equivalence classes.  A shadow (an expression that was
+        skipped or evicted; see ExpCache) whose new fingerprint matches no
+        cached expression is moved into the cache (shadows that were never
+        checked with `check_wf` are checked first, and dropped if they are not
+        well-formed).  Since larger expressions might be built from it, every
+        enumeration larger than the smallest such shadow is redone.  So is
+        every enumeration from the smallest size of a shadow that was not kept
+        (see ExpCache.add_shadow), since that shadow might have been
+        distinguished too.
+
+        Unfinished enumerations (e.g. one that was interrupted because it
+        produced a counterexample) are also redone.
+
+        Returns the number of shadows that were moved into the cache.
+        """
+        if not self.keep_shadows:
+            raise ValueError("add_examples requires an Enumerator with keep_shadows=True")
+        new_examples = list(new_examples)
+        # Worker processes have a copy of the old examples.
+        self.close()
+        complete = self.complete
+        self.cache.reload_all()
+        self.cache.retain(lambda pool, size, context: (pool, size, context) in complete)
+        self.in_progress = set()
+        self.examples.extend(new_examples)
+
+        cache = self.cache
+        promoted_sizes = []
+        with task("extending fingerprints", count=len(new_examples)):
+            for key in list(unique(itertools.chain(cache.data.keys(), cache.shadows.keys()))):
+                pool, context = key
+                inputs = context.instantiate_examples(new_examples)
+                def extend(entry):
+                    return entry._replace(fingerprint=entry.fingerprint.extend(eval_bulk(entry.e, inputs)))
+
+                old_by_size, _ = cache.data.get(key, ({}, {}))
+                by_size = defaultdict(list)
+                by_fingerprint = defaultdict(list)
+                for size, entries in old_by_size.items():
+                    for entry in entries:
+                        entry = extend(entry)
+                        by_size[size].append(entry)
+                        by_fingerprint[entry.fingerprint].append(entry)
+
+                shadows = []
+                for entry in sorted((extend(entry) for entry in cache.shadows.get(key, ())), key=lambda entry: entry.size):
+                    if by_fingerprint.get(entry.fingerprint):
+                        shadows.append(entry)
+                    else:
+                        if isinstance(entry, _UncheckedExp):
+                            self.wf_checks += 1
+                            wf = self.check_wf(entry.e, context, pool)
+                            if not wf:
+                                event("dropping shadow {} @ {} in {}/{} [wf={}]".format(pprint(entry.e), entry.size, context, pool_name(pool), wf))
+                                continue
+                            entry = EnumeratedExp(*entry)
+                        event("new examples distinguish {} @ {} in {}/{}".format(pprint(entry.e), entry.size, context, pool_name(pool)))
+                        by_size[entry.size].append(entry)
+                        by_fingerprint[entry.fingerprint].append(entry)
+                        promoted_sizes.append(entry.size)
+
+                cache.data[key] = (by_size, by_fingerprint)
+                cache._changed(key)
+                cache.set_shadows(context, pool, shadows)
+
+        cutoffs = list(promoted_sizes)
+        cutoffs.extend(size - 1 for sizes in cache.shadow_overflow.values() for size in sizes)
+        if cutoffs:
+            cutoff = min(cutoffs)
+            cache.retain(lambda pool, size, context: size <= cutoff)
+            self.complete = set(k for k in complete if k[1] <= cutoff)
+        self.shrink_cache()
+        return len(promoted_sizes)
+
     def _enumerate_core(self, context : Context, size : int, pool : Pool) -> [Exp]:
         """Build new expressions of the given size.
 
@@ -588,10 +1301,7 @@ class Enumerator(object):
         This canonical representative is the one used in the cache.
         """
         # TODO: deduplicate based on examples, not alpha equivalence
-        for ctx in self.cache.all_contexts():
-            if ctx != context and ctx.alpha_equivalent(context):
-                return ctx
-        return context
+        return self.cache.canonical_context(context)
 
     def enumerate_with_info(self, context : Context, size : int, pool : Pool) -> [EnumeratedExp]:
         """Enumerate expressions (and fingerprints) of the given size.
@@ -606,10 +1316,8 @@ class Enumerator(object):
         """
 
         canonical_context = self.canonical_context(context)
-        if canonical_context is not context:
-            print("adapting request: {} ---> {}".format(context, canonical_context))
-            for info in self.enumerate_with_info(canonical_context, size, pool):
-                yield info._replace(e=context.adapt(info.e, canonical_context))
+        if canonical_context is not context and canonical_context != context:
+            yield from self._enumerate_adapted(context, canonical_context, size, pool)
             return
 
         k = (pool, size, context)
@@ -623,6 +1331,41 @@ class Enumerator(object):
             yield from self._enumerate_with_info(context, size, pool)
             self.in_progress.remove(k)
             self.complete.add(k)
+            self.shrink_cache()
+
+    def _enumerate_adapted(self, context : Context, canonical_context : Context, size : int, pool : Pool) -> [EnumeratedExp]:
+        """Helper for enumerate_with_info for non-canonical contexts.
+
+        Adapting every expression to the requested context is expensive, and
+        the same requests come up over and over, so the adapted expressions
+        are remembered for as long as the canonical context's cache entries
+        do not change.
+        """
+        k = (pool, size, context)
+        adapted = self.adapted.get(k)
+        if adapted is not None:
+            version, infos = adapted
+            if version == self.cache.version(canonical_context, pool):
+                self.adapted.move_to_end(k)
+                yield from infos
+                return
+            del self.adapted[k]
+
+        print("adapting request: {} ---> {}".format(context, canonical_context))
+        complete = (pool, size, canonical_context) in self.complete
+        version = self.cache.version(canonical_context, pool)
+        infos = []
+        for info in self.enumerate_with_info(canonical_context, size, pool):
+            info = info._replace(e=context.adapt(info.e, canonical_context))
+            infos.append(info)
+            yield info
+
+        # Only remember the results of finished enumerations that did not
+        # change while they were being adapted.
+        if complete and version == self.cache.version(canonical_context, pool):
+            self.adapted[k] = (version, infos)
+            while len(self.adapted) > ADAPTED_CACHE_SIZE:
+                self.adapted.popitem(last=False)
 
     def _enumerate_with_info(self, context : Context, size : int, pool : Pool) -> [EnumeratedExp]:
         """Helper for enumerate_with_info that bypasses the cache.
@@ -638,12 +1381,34 @@ class Enumerator(object):
         queue = self._enumerate_core(context, size, pool)
         cost_model = self.cost_model
 
+        # Cache entries for the smaller expressions in this context and pool,
+        # by id.  _enumerate_core builds candidates out of these exact
+        # objects, so their fingerprints can be reused (see
+        # _fingerprint_from_children).  The map is filled in once
+        # _enumerate_core has loaded them.
+        known = None
+
+        # With --fingerprint-before-wf, candidates are checked only once
+        # they are known to be worth keeping.  Shadows are checked if they
+        # are ever moved into the cache (see add_examples).
+        wf_first = not fingerprint_before_wf.value
+
+        # Heuristics are only applied at size 0, where candidates may be
+        # added to the queue while it is being consumed.  Larger sizes can
+        # be checked ahead of time by the worker processes.
+        checked = None
+        if self.workers > 0 and size > 0:
+            checked = self._check_in_parallel(queue, context, pool)
+
         while True:
             if self.stop_callback():
                 raise StopException()
 
             try:
-                e = next(queue)
+                if checked is None:
+                    e = next(queue)
+                else:
+                    e, wf, fp = next(checked)
             except StopIteration:
                 # StopIteration is a "control flow exception" indicating that
                 # there isn't a next element.  Since the queue is exhausted,
@@ -652,21 +1417,37 @@ class Enumerator(object):
 
             self.stat_timer.check()
 
-            e = freshen_binders(e, context)
-            _consider(e, size, context, pool)
+            if checked is None:
+                e = freshen_binders(e, context)
+                _consider(e, size, context, pool)
+                wf = None
+                if wf_first:
+                    self.wf_checks += 1
+                    wf = self.check_wf(e, context, pool)
+            else:
+                _consider(e, size, context, pool)
 
-            wf = self.check_wf(e, context, pool)
-            if not wf:
+            if wf is not None and not wf:
                 _skip(e, size, context, pool, "wf={}".format(wf))
                 continue
 
-            fp = Fingerprint.of(e, examples)
+            if checked is None:
+                fp = None
+                if size > 0 and bottom_up_fingerprints.value:
+                    if known is None:
+                        known = { id(entry.e) : entry
+                            for sz in range(size)
+                            for entry in cache.find_expressions_of_size(context, pool, sz) }
+                    fp = _fingerprint_from_children(e, known, examples, cache.values)
+                if fp is None:
+                    fp = Fingerprint.of(e, examples, cache.values)
 
             # Collect all expressions from parent contexts that are
             # fingerprint-equivalent to this one.  There might be more than one
             # because of how `retention_policy` works.
             known_equivalents = list(cache.find_equivalent_expressions(context, pool, fp))
             to_evict = []
+            shadowed = False
 
             if any(e.type == prev_entry.e.type and alpha_equivalent(e, prev_entry.e) for prev_entry in known_equivalents):
                 _skip(e, size, context, pool, "duplicate")
@@ -683,12 +1464,27 @@ class Enumerator(object):
                             if e not in to_keep:
                                 _skip(e, size, context, pool, "preferring {}".format(pprint(prev_exp)))
                                 should_keep = False
+                                shadowed = self.keep_shadows
                                 break
                             if prev_exp not in to_keep:
                                 to_evict.append(entry)
 
             assert not (to_evict and not should_keep)
 
+            if wf is None:
+                if should_keep:
+                    self.wf_checks += 1
+                    wf = self.check_wf(e, context, pool)
+                    if not wf:
+                        _skip(e, size, context, pool, "wf={}".format(wf))
+                        continue
+                else:
+                    self.wf_checks_avoided += 1
+
+            if shadowed:
+                shadow_type = EnumeratedExp if wf else _UncheckedExp
+                cache.add_shadow(context, pool, shadow_type(e=e, fingerprint=fp, size=size))
+
             if should_keep:
 
                 if self.do_eviction and to_evict:
@@ -696,6 +1492,8 @@ class Enumerator(object):
                         for entry in to_evict:
                             _evict(entry.e, entry.size, context, pool, e, size)
                             cache.remove(context, pool, entry)
+                            if self.keep_shadows:
+                                cache.add_shadow(context, pool, entry)
 
                 _accept(e, size, context, pool, fp)
                 info = EnumeratedExp(
@@ -712,6 +1510,53 @@ class Enumerator(object):
                             event("trying {} accelerations of {}".format(len(to_try), pprint(e)))
                             queue = itertools.chain(to_try, queue)
 
+    def _check_in_parallel(self, queue : [Exp], context : Context, pool : Pool) -> [(Exp, object, Fingerprint)]:
+        """Check and fingerprint the expressions in `queue` using the workers.
+
+        Yields (e, wf, fp) tuples in queue order, where `e` has fresh binders,
+        `wf` is the result of `check_wf`, and `fp` is the fingerprint of `e`
+        (or None if `e` is not well-formed).  The queue is consumed a few
+        batches ahead of the output so that the workers stay busy.
+        """
+        if self.worker_pool is None:
+            self.worker_pool = multiprocessing.get_context("fork").Pool(
+                self.workers,
+                initializer=_init_worker,
+                initargs=(self.check_wf, self.examples))
+        in_flight = deque()
+        def submit() -> bool:
+            batch = [freshen_binders(e, context) for e in itertools.islice(queue, PARALLEL_BATCH_SIZE)]
+            if not batch:
+                return False
+            in_flight.append((batch, self.worker_pool.apply_async(_check_batch, (context, pool, batch))))
+            return True
+
+        more = True
+        while more and len(in_flight) < 2 * self.workers:
+            more = submit()
+        while in_flight:
+            batch, result = in_flight.popleft()
+            if more:
+                more = submit()
+            while not result.ready():
+                if self.stop_callback():
+                    raise StopException()
+                result.wait(timeout=0.1)
+            try:
+                checked = result.get()
+            except Exception as exn:
+                # Some results (e.g. values that are closures) cannot be sent
+                # between processes.
+                event("unable to check batch in a worker: {}".format(exn))
+                examples = context.instantiate_examples(self.examples)
+                checked = []
+                for e in batch:
+                    self.wf_checks += 1
+                    wf = self.check_wf(e, context, pool)
+                    checked.append((wf, Fingerprint.of(e, examples, self.cache.values) if wf else None))
+            for e, (wf, fp) in zip(batch, checked):
+                yield (e, wf, fp)
+
     def expressions_may_exist_above_size(self, context, pool, size):
         """Returns true if expressions larger than `size` might exist.
 
@@ -2,28 +2,34 @@
 
 This module exports one important function:
  - improve_implementation
+
+and a variant of it, improve_implementation_steps, that lets a caller drive
+many syntheses at once (see cozy.service).
 """
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import datetime
 import itertools
 from typing import Callable, Any
 import sys
 import os
-from queue import Empty
+from multiprocessing import Array
 
-from cozy.common import typechecked, OrderedSet, LINE_BUFFER_MODE
-from cozy.syntax import Query, Op, Exp, EVar, EAll
+from cozy.common import typechecked, OrderedSet, find_one, LINE_BUFFER_MODE
+from cozy.syntax import Query, Op, Exp, EVar, EAll, Visibility
 from cozy.target_syntax import EStateVar
-from cozy.syntax_tools import pprint, unpack_representation, shallow_copy, wrap_naked_statevars
+from cozy.syntax_tools import pprint, unpack_representation, pack_representation, shallow_copy, wrap_naked_statevars
 from cozy.timeouts import Timeout
 from cozy import jobs
 from cozy.contexts import Context
 from cozy.opts import Option
-from cozy.cost_model import CostModel
+from cozy.cost_model import CostModel, asymptotic_runtime
+from cozy.evaluation import mkval
+from cozy.logging import task
 
 from . import core
 from .impls import Implementation
+from .result_cache import ResultCache, cache_dir
 
 nice_children = Option("nice-children", bool, False,
     description='Apply a high Unix "niceness" value to child processes. '
@@ -33,17 +39,103 @@ nice_children = Option("nice-children", bool, False,
 log_dir = Option("log-dir", str, "/tmp",
     description="Location to place log files for child processes.")
 
+max_jobs = Option("max-jobs", int, os.cpu_count() or 1,
+    description="Maximum number of improvement jobs (child processes) to run "
+        + "at once.  Queries beyond this limit wait in a queue and take turns "
+        + "with the running ones.")
+
+job_time_slice = Option("job-time-slice", int, 0,
+    description="Seconds a job may run without finding an improvement before "
+        + "it is parked to let a waiting job run.  The default (0) divides "
+        + "the remaining synthesis time evenly among all jobs.",
+    metavar="SECONDS")
+
+search_state_interval = Option("search-state-interval", int, 300,
+    description="When synthesis progress is being saved (e.g. with "
+        + "--checkpoint-prefix), how often each job reports the state of its "
+        + "search so that a resumed run can continue it.",
+    metavar="SECONDS")
+
+# Lower bound on automatically-computed time slices and on the share of a time
+# slice that a low-priority job gets, to avoid thrashing when the remaining
+# time is short or there are many more jobs than slots.
+MIN_TIME_SLICE = datetime.timedelta(seconds=10)
+
+class ExamplePool(object):
+    """Counterexamples shared among improvement jobs.
+
+    Examples are grouped by a signature of the state variables and functions
+    they bind, so that a job only sees examples found by jobs over the same
+    state.  Each example is stored with the types of the variables it binds
+    (see `adapt_shared_example`).  Only the most recent `limit` examples per
+    signature are kept.
+    """
+
+    def __init__(self, limit : int = 500):
+        self.limit = limit
+        self.examples = OrderedDict()
+
+    @staticmethod
+    def signature(state : [EVar], context : Context) -> tuple:
+        return (
+            tuple((v.id, v.type) for v in state),
+            tuple(sorted(context.funcs().items())))
+
+    def add(self, signature : tuple, example : dict, var_types : dict) -> bool:
+        """Add an example.  Returns False if it was already in the pool."""
+        l = self.examples.setdefault(signature, [])
+        if any(x == example for (x, _) in l):
+            return False
+        l.append((example, var_types))
+        del l[:-self.limit]
+        return True
+
+    def get(self, signature : tuple) -> [(dict, dict)]:
+        return list(self.examples.get(signature, ()))
+
+def adapt_shared_example(example : dict, var_types : dict, context : Context) -> dict:
+    """Rebind a counterexample found by another job to the given context.
+
+    Variables that the other job bound at the same type keep their values and
+    every other variable in `context` gets a default value.  Returns None if
+    the example is missing one of the context's functions.
+    """
+    res = OrderedDict()
+    for v, _ in context.vars():
+        res[v.id] = example[v.id] if var_types.get(v.id) == v.type else mkval(v.type)
+    for f in context.funcs():
+        if f not in example:
+            return None
+        res[f] = example[f]
+    return res
+
+# What a checkpoint contains: the implementation found so far and, for each
+# query, the last reported state of the search for a better implementation
+# (see core.SearchState).
+Checkpoint = namedtuple("Checkpoint", ("impl", "search_states"))
+
 class ImproveQueryJob(jobs.Job):
+    """A job that improves one query.
+
+    The job reports its progress to the parent with these messages:
+     - ("solution", new_rep, new_ret): a better implementation of the query
+     - ("example", example, var_types): a new counterexample (see ExamplePool)
+     - ("search_state", state): a core.SearchState for the query
+    """
+
     @typechecked
     def __init__(self,
             state       : [EVar],
             assumptions : [Exp],
             q           : Query,
             context     : Context,
-            k,
             hints       : [Exp]     = [],
             freebies    : [Exp]     = [],
-            ops         : [Op]      = []):
+            ops         : [Op]      = [],
+            report_initial : bool   = True,
+            shared_examples         = [],
+            search_states : dict    = None,
+            periodic_search_states : bool = False):
         super().__init__()
         self.state = state
         self.assumptions = assumptions
@@ -54,9 +146,62 @@ class ImproveQueryJob(jobs.Job):
         self.hints = hints
         self.freebies = freebies
         self.ops = ops
-        self.k = k
+        self.report_initial = report_initial
+        self.shared_examples = list(shared_examples)
+        self.search_states = search_states
+        self.search_state = None
+        self.periodic_search_states = periodic_search_states
+        self._save_search_state = Array("b", [False])
+
+        # The best expression reported so far and when it was reported.  Only
+        # the parent process updates these fields; they are used to schedule
+        # jobs and to resume preempted ones.
+        self.latest = q.ret
+        self.last_improvement = None
     def __str__(self):
         return "ImproveQueryJob[{}]".format(self.q.name)
+    def note_solution(self, new_rep : [(EVar, Exp)], new_ret : Exp, now : datetime.datetime = None):
+        """Record a solution for this job's query.
+
+        Call this from the parent process.  The solution may come from this
+        job or from another job for the same query (e.g. the one that this
+        job replaces).  A job that has not started yet will start from it.
+        """
+        self.latest = pack_representation(new_rep, new_ret)
+        self.last_improvement = now or datetime.datetime.now()
+        if self.pid is None:
+            self.q.ret = wrap_naked_statevars(self.latest, OrderedSet(self.state))
+            self.report_initial = False
+    def update_hints(self, hints : [Exp], freebies : [Exp]):
+        """Give this job new hints and freebies.
+
+        Call this from the parent process.  A running job picks up the change
+        without throwing away the examples it has already found.
+        """
+        if hints == self.hints and freebies == self.freebies:
+            return
+        self.hints = hints
+        self.freebies = freebies
+        if self.pid is not None:
+            self.send(("hints", hints, freebies))
+    def save_search_state(self):
+        """Ask the job to report the state of its search when it stops."""
+        self._save_search_state[0] = True
+    def start(self):
+        # pick up the latest state of any earlier job for the same query
+        if self.search_states is not None:
+            self.search_state = self.search_states.get(self.q.name)
+        super().start()
+    def offer_examples(self, examples : [(dict, dict)]):
+        """Give this job counterexamples found by other jobs.
+
+        Call this from the parent process.  The examples are (example,
+        var_types) pairs as stored in an ExamplePool.
+        """
+        if self.pid is not None:
+            self.send(("examples", examples))
+        else:
+            self.shared_examples.extend(examples)
     def run(self):
         print("STARTING IMPROVEMENT JOB {}".format(self.q.name))
         os.makedirs(log_dir.value, exist_ok=True)
@@ -74,27 +219,103 @@ class ImproveQueryJob(jobs.Job):
                     freebies=self.freebies,
                     ops=self.ops)
 
+            received_hints = []
+            received_examples = list(self.shared_examples)
+            def receive():
+                for message in self.receive():
+                    if message[0] == "hints":
+                        received_hints.append(message[1:])
+                    elif message[0] == "examples":
+                        received_examples.extend(message[1])
+
+            def new_hints():
+                receive()
+                if not received_hints:
+                    return None
+                self.hints, self.freebies = received_hints[-1]
+                received_hints.clear()
+                cost_model.freebies = self.freebies
+                print("received {} hints and {} freebies".format(len(self.hints), len(self.freebies)))
+                return self.hints
+
+            def new_examples():
+                receive()
+                res = [adapt_shared_example(x, var_types, self.context) for (x, var_types) in received_examples]
+                received_examples.clear()
+                return [x for x in res if x is not None]
+
+            var_types = { v.id : v.type for v, _ in self.context.vars() }
+            def publish_example(x):
+                try:
+                    self.report(("example", x, var_types))
+                except Exception:
+                    # Functions with arguments in solver models are closures,
+                    # which cannot be sent to another process.
+                    pass
+
+            last_report = [None]
+            def checkpoint(state):
+                now = datetime.datetime.now()
+                if self.stop_requested:
+                    if not self._save_search_state[0]:
+                        return
+                elif not self.periodic_search_states:
+                    return
+                elif last_report[0] is not None and (now - last_report[0]).total_seconds() < search_state_interval.value:
+                    return
+                last_report[0] = now
+                with task("saving search state", size=state.size):
+                    try:
+                        self.report(("search_state", state))
+                    except Exception as e:
+                        print("unable to save search state: {}".format(e))
+
             try:
-                for expr in itertools.chain((self.q.ret,), core.improve(
+                initial = (self.q.ret,) if self.report_initial else ()
+                for expr in itertools.chain(initial, core.improve(
                         target=self.q.ret,
                         assumptions=EAll(self.assumptions),
                         context=self.context,
                         hints=self.hints,
                         stop_callback=lambda: self.stop_requested,
                         cost_model=cost_model,
-                        ops=self.ops)):
+                        ops=self.ops,
+                        hints_callback=new_hints,
+                        examples_callback=new_examples,
+                        counterexample_callback=publish_example,
+                        resume=self.search_state,
+                        checkpoint_callback=checkpoint)):
 
                     new_rep, new_ret = unpack_representation(expr)
-                    self.k(new_rep, new_ret)
+                    self.report(("solution", new_rep, new_ret))
                 print("PROVED OPTIMALITY FOR {}".format(self.q.name))
             except core.StopException:
                 print("stopping synthesis of {}".format(self.q.name))
                 return
 
+def job_priority(j : ImproveQueryJob, now : datetime.datetime = None) -> float:
+    """How much of the synthesis budget job `j` deserves, relative to others.
+
+    Queries whose current implementation is asymptotically expensive get more
+    time, as do public queries and queries that improved recently.  Queries
+    that already look done get very little.
+    """
+    _, ret = unpack_representation(j.latest)
+    if core.heuristic_done(ret):
+        return 0.1
+    weight = 1 + asymptotic_runtime(ret).exponent
+    if j.q.visibility == Visibility.Public:
+        weight *= 2
+    if j.last_improvement is not None:
+        minutes_idle = ((now or datetime.datetime.now()) - j.last_improvement).total_seconds() / 60
+        weight *= 1 + 1 / (1 + minutes_idle)
+    return weight
+
 def improve_implementation(
         impl              : Implementation,
         timeout           : datetime.timedelta = datetime.timedelta(seconds=60),
-        progress_callback : Callable[[Implementation], Any] = None) -> Implementation:
+        progress_callback : Callable[[Implementation], Any] = None,
+        search_states     : {str : core.SearchState} = None) -> Implementation:
     """Improve an implementation.
 
     This function tries to synthesize a better version of the given
@@ -103,78 +324,249 @@ def improve_implementation(
     If provided, progress_callback will be called whenever a better
     implementation is found.  It will be given the better implementation, which
     it should not modify or cache.
+
+    If provided, search_states maps query names to the state of earlier
+    searches for better implementations of those queries (e.g. from a
+    Checkpoint).  Those searches are continued, and the dictionary is kept up
+    to date as synthesis runs so that it can be saved alongside the
+    implementation passed to progress_callback.
     """
+    steps = improve_implementation_steps(impl, timeout, progress_callback, search_states)
+    try:
+        scheduler, wait_time = next(steps)
+        while True:
+            scheduler, wait_time = steps.send(scheduler.wait(wait_time))
+    except StopIteration as stop:
+        return stop.value
+
+def improve_implementation_steps(
+        impl              : Implementation,
+        timeout           : datetime.timedelta = datetime.timedelta(seconds=60),
+        progress_callback : Callable[[Implementation], Any] = None,
+        search_states     : {str : core.SearchState} = None,
+        stop_callback     : Callable[[], bool] = None,
+        job_slots         : jobs.JobSlots = None):
+    """The body of improve_implementation, as a generator.
+
+    This lets one thread drive many syntheses at once.  The generator yields
+    (scheduler, wait_time) pairs whenever it needs to wait for its jobs; the
+    caller should resume it with the messages from `scheduler.wait(wait_time)`
+    (or an equivalent call such as jobs.wait_for_schedulers).  It is fine
+    to resume it early, with fewer messages.  The generator's return value is
+    the improved implementation.
+
+    The first four parameters are as for improve_implementation.  In addition,
+    synthesis stops early when stop_callback returns True; it is checked every
+    time the generator is resumed.  If given, job_slots limits the number of
+    jobs that run at once across all syntheses that share it.
+    """
+
+    if stop_callback is None:
+        stop_callback = lambda: False
 
     start_time = datetime.datetime.now()
 
     # we statefully modify `impl`, so let's make a defensive copy which we will modify instead
     impl = impl.safe_copy()
 
-    # worker threads ("jobs"), one per query
-    improvement_jobs = []
-
-    with jobs.SafeQueue() as solutions_q:
-
-        def stop_jobs(js):
-            """Stop the given jobs and remove them from `improvement_jobs`."""
-            js = list(js)
-            jobs.stop_jobs(js)
-            for j in js:
-                improvement_jobs.remove(j)
-
-        def reconcile_jobs():
-            """Sync up the current set of jobs and the set of queries.
-
-            This function spawns new jobs for new queries and cleans up old
-            jobs whose queries have been dead-code-eliminated."""
-
-            # figure out what new jobs we need
-            job_query_names  = set(j.q.name for j in improvement_jobs)
-            new = []
-            for q in impl.query_specs:
-                if q.name not in job_query_names:
-                    states_maintained_by_q = impl.states_maintained_by(q)
-                    new.append(ImproveQueryJob(
-                        impl.abstract_state,
-                        list(impl.spec.assumptions) + list(q.assumptions),
-                        q,
-                        context=impl.context_for_method(q),
-                        k=(lambda q: lambda new_rep, new_ret: solutions_q.put((q, new_rep, new_ret)))(q),
-                        hints=[EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()],
-                        freebies=[e for (v, e) in impl.concretization_functions.items() if EVar(v) in states_maintained_by_q],
-                        ops=impl.op_specs))
-
-            # figure out what old jobs we can stop
-            impl_query_names = set(q.name for q in impl.query_specs)
-            old = [j for j in improvement_jobs if j.q.name not in impl_query_names]
-
-            # make it so
-            stop_jobs(old)
-            for j in new:
-                j.start()
-            improvement_jobs.extend(new)
-
+    # counterexamples found so far, shared among jobs
+    example_pool = ExamplePool()
+
+    # results remembered across runs
+    result_cache = ResultCache(cache_dir.value) if cache_dir.value else None
+    looked_up = set()  # names of queries already looked up in the cache
+    seeded = {}        # query name -> cached result to start its job from
+
+    # The latest search state of each query's job, used to resume preempted
+    # jobs and (if the caller asked for them) to save progress.
+    save_search_states = search_states is not None
+    if search_states is None:
+        search_states = {}
+
+    def hints_for(q : Query) -> [Exp]:
+        return [EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()]
+
+    def freebies_for(q : Query) -> [Exp]:
+        states_maintained_by_q = impl.states_maintained_by(q)
+        return [e for (v, e) in impl.concretization_functions.items() if EVar(v) in states_maintained_by_q]
+
+    def assumptions_for(q : Query) -> [Exp]:
+        return list(impl.spec.assumptions) + list(q.assumptions)
+
+    def make_job(q : Query, start_from : Exp = None) -> ImproveQueryJob:
+        """Create a job to improve `q`.
+
+        If given, the job starts from `start_from` (an expression
+        equivalent to q.ret that was already reported) instead of q.ret.
+        """
+        if start_from is None:
+            start_from = seeded.get(q.name)
+        if start_from is not None:
+            q = shallow_copy(q)
+            q.ret = start_from
+        context = impl.context_for_method(q)
+        return ImproveQueryJob(
+            impl.abstract_state,
+            assumptions_for(q),
+            q,
+            context=context,
+            hints=hints_for(q),
+            freebies=freebies_for(q),
+            ops=impl.op_specs,
+            report_initial=start_from is None,
+            shared_examples=example_pool.get(ExamplePool.signature(impl.abstract_state, context)),
+            search_states=search_states,
+            periodic_search_states=save_search_states)
+
+    def respawn(j : ImproveQueryJob) -> ImproveQueryJob:
+        """Build a job that resumes the work of a preempted job."""
+        j.save_search_state()
+        q = find_one(impl.query_specs, lambda qq: qq.name == j.q.name)
+        if q is None:
+            return None
+        new_job = make_job(q, start_from=j.latest)
+        new_job.last_improvement = j.last_improvement
+        return new_job
+
+    # names of queries whose jobs exited on their own (e.g. because they
+    # proved optimality); those queries do not get new jobs
+    finished_queries = set()
+
+    # worker processes ("jobs"), one per query, at most max_jobs at once
+    scheduler = jobs.JobScheduler(
+        max_running=max_jobs.value,
+        respawn=respawn,
+        priority=job_priority,
+        slots=job_slots,
+        min_time_slice=MIN_TIME_SLICE)
+
+    def seed_from_cache() -> bool:
+        """Start unchanged queries from results remembered by earlier runs.
+
+        Returns True if this changed the implementation."""
+        if result_cache is None:
+            return False
+        changed = False
+        while True:
+            new_queries = [q for q in impl.query_specs if q.name not in looked_up]
+            if not new_queries:
+                return changed
+            hits = 0
+            for q in new_queries:
+                looked_up.add(q.name)
+                context = impl.context_for_method(q)
+                res = result_cache.lookup(q, impl.abstract_state, assumptions_for(q), context.funcs(), impl.op_specs)
+                if res is None:
+                    continue
+                rep, ret, examples = res
+                print("starting {} from a cached result".format(q.name))
+                impl.set_impl(q, rep, ret)
+                seeded[q.name] = pack_representation(rep, ret)
+                signature = ExamplePool.signature(impl.abstract_state, context)
+                for (x, var_types) in examples:
+                    example_pool.add(signature, x, var_types)
+                hits += 1
+            if hits:
+                # the new implementations may have introduced subqueries,
+                # which we will look up on the next iteration
+                impl.cleanup()
+                changed = True
+
+    def remember(q : Query, new_rep : [(EVar, Exp)], new_ret : Exp):
+        """Save a new result for `q` in the cache."""
+        if result_cache is None:
+            return
+        context = impl.context_for_method(q)
+        result_cache.store(q, impl.abstract_state, assumptions_for(q), context.funcs(), impl.op_specs,
+            new_rep, new_ret,
+            examples=example_pool.get(ExamplePool.signature(impl.abstract_state, context)))
+
+    def reconcile_jobs():
+        """Sync up the current set of jobs and the set of queries.
+
+        This function queues new jobs for new queries, cleans up old
+        jobs whose queries have been dead-code-eliminated, and sends
+        up-to-date hints and freebies to the remaining jobs."""
+
+        # forget finished queries that were cleaned up, in case a new query
+        # reuses the name
+        impl_query_names = set(q.name for q in impl.query_specs)
+        finished_queries.intersection_update(impl_query_names)
+
+        # figure out what new jobs we need
+        job_query_names = set(j.q.name for j in scheduler.jobs()) | finished_queries
+        for q in impl.query_specs:
+            if q.name not in job_query_names:
+                scheduler.submit(make_job(q))
+
+        # figure out what old jobs we can stop
+        scheduler.cancel([j for j in scheduler.jobs() if j.q.name not in impl_query_names])
+
+        # tell surviving jobs about the new concretization functions
+        queries_by_name = { q.name : q for q in impl.query_specs }
+        for j in scheduler.jobs():
+            q = queries_by_name[j.q.name]
+            j.update_hints(hints_for(q), freebies_for(q))
+
+    def current_time_slice() -> datetime.timedelta:
+        if job_time_slice.value > 0:
+            return datetime.timedelta(seconds=job_time_slice.value)
+        njobs = len(scheduler.jobs())
+        if njobs <= scheduler.max_running:
+            return timeout.remaining()
+        return max(MIN_TIME_SLICE, timeout.remaining() * scheduler.max_running / njobs)
+
+    def handle_messages(messages) -> [(Query, [(EVar, Exp)], Exp)]:
+        """Process messages from jobs.
+
+        Shares new counterexamples with the other jobs and records search
+        states.  Returns the new solutions, in the order they were found.
+        """
+        results = []
+        for (source, message) in messages:
+            if message[0] == "solution":
+                _, new_rep, new_ret = message
+                results.append((source.q, new_rep, new_ret))
+            elif message[0] == "example":
+                _, x, var_types = message
+                signature = ExamplePool.signature(source.state, source.context)
+                if example_pool.add(signature, x, var_types):
+                    for j in scheduler.jobs():
+                        if j.q.name != source.q.name and ExamplePool.signature(j.state, j.context) == signature:
+                            j.offer_examples([(x, var_types)])
+            elif message[0] == "search_state":
+                search_states[source.q.name] = message[1]
+        return results
+
+    try:
         # start jobs
+        if seed_from_cache() and progress_callback is not None:
+            progress_callback(impl)
         reconcile_jobs()
 
         # wait for results
         timeout = Timeout(timeout)
-        done = False
-        while not done and not timeout.is_timed_out():
-            for j in improvement_jobs:
-                if j.done:
-                    if j.successful:
-                        j.join()
-                    else:
-                        print("failed job: {}".format(j), file=sys.stderr)
-                        # raise Exception("failed job: {}".format(j))
-
-            done = all(j.done for j in improvement_jobs)
-
-            try:
-                # list of (Query, new_rep, new_ret) objects
-                results = solutions_q.drain(block=True, timeout=0.5)
-            except Empty:
+        while not timeout.is_timed_out() and not stop_callback():
+            time_slice = current_time_slice()
+            for j in scheduler.step(time_slice):
+                finished_queries.add(j.q.name)
+                if not j.successful:
+                    print("failed job: {}".format(j), file=sys.stderr)
+                    # raise Exception("failed job: {}".format(j))
+
+            if scheduler.finished:
+                break
+
+            # sleep until a job has news, a job's time slice runs out, or time
+            # is up
+            wait_time = timeout.remaining()
+            until_preemption = scheduler.time_until_preemption(time_slice)
+            if until_preemption is not None:
+                wait_time = min(wait_time, until_preemption)
+
+            # list of (Query, new_rep, new_ret) objects
+            results = handle_messages((yield (scheduler, wait_time)))
+            if not results:
                 continue
 
             # group by query name, favoring later (i.e. better) solutions
@@ -186,6 +578,12 @@ def improve_implementation(
                 if q.name in improved_queries_by_name:
                     killed += 1
                 improved_queries_by_name[q.name] = r
+                # The solution may come from a job that is stopping, whose
+                # replacement is already waiting to start.
+                for j in scheduler.running + scheduler.stopping + scheduler.pending:
+                    if j.q.name == q.name:
+                        j.note_solution(new_rep, new_ret)
+                        scheduler.note_progress(j)
             if killed:
                 print(" --> dropped {} worse solutions".format(killed))
 
@@ -217,7 +615,8 @@ def improve_implementation(
                 #   - both improvements were in the `results` list pulled from the queue
                 #   - we visited the improvement for X first
                 #   - after cleanup, q is no longer needed and was removed
-                if q.name in [qq.name for qq in impl.query_specs]:
+                spec = find_one(impl.query_specs, lambda qq: qq.name == q.name)
+                if spec is not None:
                     elapsed = datetime.datetime.now() - start_time
                     print("SOLUTION FOR {} AT {} [size={}]".format(q.name, elapsed, new_ret.size() + sum(proj.size() for (v, proj) in new_rep)))
                     print("-" * 40)
@@ -226,9 +625,11 @@ def improve_implementation(
                     print("  return {}".format(pprint(new_ret)))
                     print("-" * 40)
                     impl.set_impl(q, new_rep, new_ret)
+                    remember(spec, new_rep, new_ret)
 
                     # clean up
                     impl.cleanup()
+                    seed_from_cache()
                     if progress_callback is not None:
                         progress_callback(impl)
                     reconcile_jobs()
@@ -237,5 +638,18 @@ def improve_implementation(
 
         # stop jobs
         print("Stopping jobs")
-        stop_jobs(list(improvement_jobs))
+        if save_search_states:
+            for j in scheduler.running:
+                j.save_search_state()
+        handle_messages(scheduler.stop_all())
+        if save_search_states:
+            for name in list(search_states.keys()):
+                if not any(q.name == name for q in impl.query_specs):
+                    del search_states[name]
+        if result_cache is not None:
+            print("synthesis cache: {} hits, {} misses".format(result_cache.hits, result_cache.misses))
         return impl
+    except BaseException:
+        # don't leave jobs behind if synthesis fails or is abandoned
+        scheduler.stop_all()
+        raise
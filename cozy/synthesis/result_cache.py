@@ -0,0 +1,180 @@
+"""Persistent cache of query synthesis results.
+
+Without this cache, every run of Cozy synthesizes every query from scratch,
+even if the query did not change since the last run.  A ResultCache stores
+the best implementation found so far for each query, along with the
+counterexamples discovered while looking for it, so that a later run can
+start each unchanged query from its previous best result.
+
+Entries are content-addressed: the key is a hash of everything that affects
+the meaning of a query (its return expression, its assumptions, the types
+of the abstract state, the extern functions, the update operations) together
+with the options that affect synthesis.  Names of bound variables and query
+arguments do not affect the key.
+"""
+
+import hashlib
+import os
+import pickle
+
+from cozy.common import AtomicWriteableFile
+from cozy.syntax import Query, Op, Exp, EVar, EAll, EImplies, EEq
+from cozy.syntax_tools import alpha_key, subst, fresh_var, pack_representation
+from cozy.opts import Option
+from cozy.logging import task, event
+from cozy.solver import valid, collection_depth_opt, use_quantified_encoding
+from cozy.cost_model import cost_model_selection
+
+from . import core
+from .acceleration import accelerate
+from .enumeration import do_enumerate
+
+cache_dir = Option("synthesis-cache", str, "",
+    description="Directory in which to remember synthesis results across "
+        + "runs.  Queries that have not changed since a previous run start "
+        + "from the best implementation found by that run.  By default, "
+        + "nothing is remembered.",
+    metavar="DIR")
+
+# Bump this whenever the format of the cache entries or keys changes.
+FORMAT_VERSION = 1
+
+# Options whose values can change the outcome of synthesis.
+RELEVANT_OPTIONS = (
+    core.allow_conditional_state,
+    core.allow_peels,
+    core.allow_big_sets,
+    core.allow_big_maps,
+    core.allow_int_arithmetic_state,
+    core.allow_nonzero_state_constants,
+    core.allow_binop_state,
+    accelerate,
+    do_enumerate,
+    cost_model_selection,
+    collection_depth_opt,
+    use_quantified_encoding)
+
+# Examples saved with each entry are limited to this many.
+MAX_SAVED_EXAMPLES = 100
+
+def _arg_placeholder(i : int, t) -> EVar:
+    # "#" cannot appear in identifiers in Cozy specifications, so these names
+    # never clash with real variables.
+    return EVar("#arg{}".format(i)).with_type(t)
+
+def _rename_args(e : Exp, old_args, new_args) -> Exp:
+    return subst(e, { a.id : b for (a, b) in zip(old_args, new_args) })
+
+def _rename_example(x : dict, old_args, new_args) -> dict:
+    renaming = { a.id : b.id for (a, b) in zip(old_args, new_args) }
+    return { renaming.get(k, k) : v for (k, v) in x.items() }
+
+class ResultCache(object):
+    """A directory of synthesis results.
+
+    Entries are written atomically, so several Cozy processes may share the
+    same directory.
+    """
+
+    def __init__(self, directory : str):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def key(self,
+            q           : Query,
+            state       : [EVar],
+            assumptions : [Exp],
+            funcs       : dict,
+            ops         : [Op]) -> str:
+        """Compute the content-addressed key for a query."""
+        args = [EVar(a).with_type(t) for (a, t) in q.args]
+        data = (
+            FORMAT_VERSION,
+            tuple((v.id, v.type) for v in state),
+            tuple(sorted(funcs.items())),
+            tuple(t for (a, t) in q.args),
+            alpha_key(q.ret, bound_vars=args),
+            alpha_key(EAll(assumptions), bound_vars=args),
+            tuple(alpha_key(op) for op in ops),
+            tuple((o.name, o.value) for o in RELEVANT_OPTIONS))
+        return hashlib.sha256(repr(data).encode("utf-8")).hexdigest()
+
+    def _path(self, key : str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".pickle")
+
+    def lookup(self,
+            q           : Query,
+            state       : [EVar],
+            assumptions : [Exp],
+            funcs       : dict,
+            ops         : [Op]):
+        """Find a previous result for `q`.
+
+        Returns None or a tuple (rep, ret, examples) with the same meaning
+        as the arguments to `store`.  The result is checked for correctness
+        before it is returned, and its concrete state variables are fresh.
+        """
+        path = self._path(self.key(q, state, assumptions, funcs, ops))
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            print("unable to read synthesis cache entry {}: {}".format(path, e))
+            self.misses += 1
+            return None
+
+        args = [EVar(a).with_type(t) for (a, t) in q.args]
+        placeholders = [_arg_placeholder(i, a.type) for (i, a) in enumerate(args)]
+
+        rep = []
+        ret = _rename_args(entry["ret"], placeholders, args)
+        for (v, e) in entry["rep"]:
+            new_v = fresh_var(v.type)
+            ret = subst(ret, { v.id : new_v })
+            rep.append((new_v, e))
+        examples = [(_rename_example(x, placeholders, args), _rename_example(var_types, placeholders, args))
+            for (x, var_types) in entry["examples"]]
+
+        with task("checking cached result", query=q.name):
+            if not valid(EImplies(EAll(assumptions), EEq(q.ret, pack_representation(rep, ret))), funcs=funcs):
+                print("ignoring incorrect cached result for {}".format(q.name))
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        return (rep, ret, examples)
+
+    def store(self,
+            q           : Query,
+            state       : [EVar],
+            assumptions : [Exp],
+            funcs       : dict,
+            ops         : [Op],
+            rep         : [(EVar, Exp)],
+            ret         : Exp,
+            examples    : [(dict, dict)] = ()):
+        """Remember that (rep, ret) is the best known implementation of q.
+
+        The examples are (example, var_types) pairs as used by ExamplePool.
+        """
+        args = [EVar(a).with_type(t) for (a, t) in q.args]
+        placeholders = [_arg_placeholder(i, a.type) for (i, a) in enumerate(args)]
+        examples = list(examples)[-MAX_SAVED_EXAMPLES:]
+        entry = {
+            "rep": rep,
+            "ret": _rename_args(ret, args, placeholders),
+            "examples": [(_rename_example(x, args, placeholders), _rename_example(var_types, args, placeholders))
+                for (x, var_types) in examples] }
+        try:
+            data = pickle.dumps(entry)
+        except Exception as e:
+            event("unable to cache result for {}: {}".format(q.name, e))
+            return
+        path = self._path(self.key(q, state, assumptions, funcs, ops))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with AtomicWriteableFile(path, mode="wb") as f:
+            f.write(data)
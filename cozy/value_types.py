@@ -19,6 +19,7 @@ Python types:
 
 Important functions:
  - compare_values: compare two Cozy values
+ - value_key: a hashable key for a Cozy value under normal equality
 """
 
 from collections import namedtuple
@@ -230,3 +231,66 @@ def compare_values(t : Type, v1, v2, deep : bool = False) -> int:
 def values_equal(t : Type, v1, v2) -> bool:
     """Shorthand for `compare_values(t, v1, v2) == EQ`."""
     return compare_values(t, v1, v2) == EQ
+
+def value_key(t : Type, v):
+    """A hashable key for a Cozy value that respects normal equality.
+
+    For any two values v1 and v2 of type t,
+
+        value_key(t, v1) == value_key(t, v2)
+
+    exactly when `values_equal(t, v1, v2)`.  This lets values be grouped by
+    normal equality using a dictionary instead of pairwise comparisons.  (For
+    deep equality, values can be used as keys directly.)
+    """
+    f = _key_function(t)
+    return v if f is None else f(v)
+
+_key_functions = {}
+
+def _key_function(t : Type):
+    """Get the function that computes value_key for type t.
+
+    Returns None if values of type t are their own keys.  The functions are
+    cached, since value_key is called on many values of the same few types.
+    """
+    try:
+        return _key_functions[t]
+    except KeyError:
+        pass
+
+    # Each case mirrors the corresponding case in compare_values with
+    # deep=False.
+    f = None
+    h = extension_handler(type(t))
+    if h is not None:
+        f = _key_function(h.encoding_type(t))
+    elif isinstance(t, THandle):
+        f = lambda v: v.address
+    elif isinstance(t, TBag) or isinstance(t, TSet):
+        elem_key = _key_function(t.elem_type)
+        if elem_key is None:
+            f = lambda v: tuple(sorted(v))
+        else:
+            f = lambda v: tuple(elem_key(x) for x in sorted(v))
+    elif isinstance(t, TMap):
+        keys_key = _key_function(TSet(t.k)) or tuple
+        val_key = _key_function(t.v) or (lambda v: v)
+        def f(m):
+            keys = sorted(m.keys())
+            return (val_key(m.default), keys_key(Bag(keys)), tuple(val_key(m[k]) for k in keys))
+    elif isinstance(t, TTuple):
+        elem_keys = [_key_function(tt) or (lambda v: v) for tt in t.ts]
+        f = lambda v: tuple(k(vv) for (k, vv) in zip(elem_keys, v))
+    elif isinstance(t, TList):
+        elem_key = _key_function(t.elem_type)
+        if elem_key is None:
+            f = tuple
+        else:
+            f = lambda v: tuple(elem_key(x) for x in v)
+    elif isinstance(t, TRecord):
+        field_keys = [(fname, _key_function(ft) or (lambda v: v)) for (fname, ft) in t.fields]
+        f = lambda v: tuple(k(v[fname]) for (fname, k) in field_keys)
+
+    _key_functions[t] = f
+    return f
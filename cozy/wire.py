@@ -0,0 +1,255 @@
+"""Compact serialization for objects that contain Cozy syntax trees.
+
+Checkpoints hold the implementation, the saved search states, and the
+enumerator caches inside them: a great many syntax trees.  Pickling them
+directly is wasteful: every node carries its attribute names, and
+structurally identical subtrees---especially the types attached to every
+expression---are written out again and again.
+
+An `Encoder` uses pickle for everything except ADTs (expressions, types,
+queries, ...).  ADTs are hash-consed into a table of flat tuples, so every
+distinct subtree is written once.  Types go into a separate table that the
+Encoder remembers across calls: a stream of messages from one Encoder sends
+each type only once.  Such a stream must be read, in order, by a single
+`Decoder`.
+
+Like BottomUpRewriter, this module assumes that an ADT `x` can be rebuilt
+with `type(x)(*x.children())`.  Apart from `.type` on expressions, other
+attributes of ADTs are not preserved.  Decoded trees may share structurally
+identical subtrees that were distinct objects before encoding.
+
+The output is smaller than pickle's, but it takes longer to produce and to
+read, so messages between processes are plain pickles.
+
+To compare the two on some specifications, run:
+
+    python -m benchmarks.wire examples/*.ds
+"""
+
+import importlib
+import io
+import pickle
+
+from cozy.common import ADT
+from cozy.syntax import Exp, Type
+
+# Bump this whenever the encoding changes.
+FORMAT_VERSION = 1
+
+# Prefix of files written by `dump`.
+MAGIC = b"cozy-wire\n"
+
+# Kinds of table entries.  Entries are tuples whose first element is the kind.
+#   (_ADT, class index, type ref or None, child refs...)
+#   (_PRIMITIVE, value)
+#   (_TUPLE, element refs...)
+#   (_LIST, element refs...)
+#   (_PICKLED, pickled bytes, with ADTs replaced by refs)
+# An even ref 2*i refers to entry i of the current message, while an odd ref
+# 2*i+1 refers to entry i of the type table.
+_ADT, _PRIMITIVE, _TUPLE, _LIST, _PICKLED = range(5)
+
+_PRIMITIVE_TYPES = frozenset((str, int, float, bool, bytes, type(None)))
+
+def _class_name(cls) -> str:
+    return "{}:{}".format(cls.__module__, cls.__qualname__)
+
+def _resolve_class(name : str):
+    module, qualname = name.split(":")
+    x = importlib.import_module(module)
+    for part in qualname.split("."):
+        x = getattr(x, part)
+    return x
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, f, table, in_type=False):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.table = table
+        self.in_type = in_type
+    def persistent_id(self, obj):
+        if isinstance(obj, ADT):
+            return self.table.ref(obj, self.in_type)
+        return None
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, f, objects, types):
+        super().__init__(f)
+        self.objects = objects
+        self.types = types
+    def persistent_load(self, ref):
+        return self.types[ref >> 1] if ref & 1 else self.objects[ref >> 1]
+
+class _Table(object):
+    """The entries produced while encoding one message."""
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.entries = []
+        self.keys = {}       # hash-consing key -> ref
+        self.memo = {}       # id(object) -> ref, for objects in the message table
+        self.type_memo = {}  # id(object) -> ref, for objects in the type table
+        self.keep_alive = [] # objects whose ids are in memo or type_memo
+        self.new_classes = []
+        self.new_class_ids = {}
+        self.new_types = []
+        self.new_type_keys = {}
+
+    def class_index(self, cls) -> int:
+        i = self.encoder.classes.get(cls)
+        if i is None:
+            i = self.new_class_ids.get(cls)
+        if i is None:
+            i = len(self.encoder.classes) + len(self.new_classes)
+            self.new_classes.append(_class_name(cls))
+            self.new_class_ids[cls] = i
+        return i
+
+    def add(self, key, entry, in_type : bool) -> int:
+        """Add an entry to the message table or the type table.
+
+        Entries with the same non-None key are only added once."""
+        if in_type:
+            if key is not None:
+                ref = self.encoder.type_keys.get(key)
+                if ref is None:
+                    ref = self.new_type_keys.get(key)
+                if ref is not None:
+                    return ref
+            ref = 2 * (self.encoder.type_count + len(self.new_types)) + 1
+            self.new_types.append(entry)
+            if key is not None:
+                self.new_type_keys[key] = ref
+            return ref
+        if key is not None:
+            ref = self.keys.get(key)
+            if ref is not None:
+                return ref
+        ref = 2 * len(self.entries)
+        self.entries.append(entry)
+        if key is not None:
+            self.keys[key] = ref
+        return ref
+
+    def ref(self, x, in_type : bool = False) -> int:
+        t = type(x)
+        if not in_type and issubclass(t, Type):
+            in_type = True
+        memo = self.type_memo if in_type else self.memo
+        ref = memo.get(id(x))
+        if ref is not None:
+            return ref
+        if t in _PRIMITIVE_TYPES:
+            entry = (_PRIMITIVE, x)
+            key = (_PRIMITIVE, t, x)
+        elif isinstance(x, ADT):
+            typ = getattr(x, "type", None) if isinstance(x, Exp) else None
+            entry = (_ADT, self.class_index(t), None if typ is None else self.ref(typ, True)) + tuple(self.ref(c, in_type) for c in x.children())
+            key = entry
+        elif t is tuple:
+            entry = (_TUPLE,) + tuple(self.ref(c, in_type) for c in x)
+            key = entry
+        elif t is list:
+            entry = (_LIST,) + tuple(self.ref(c, in_type) for c in x)
+            key = None
+        else:
+            # ADTs inside the pickled object become refs to earlier entries.
+            f = io.BytesIO()
+            _Pickler(f, self, in_type).dump(x)
+            entry = (_PICKLED, f.getvalue())
+            key = entry
+        ref = self.add(key, entry, in_type)
+        memo[id(x)] = ref
+        self.keep_alive.append(x)
+        return ref
+
+class Encoder(object):
+    """Converts objects to bytes for a Decoder."""
+
+    def __init__(self):
+        self.classes = {}   # class -> index in the Decoder's class table
+        self.type_keys = {} # hash-consing key -> ref into the type table
+        self.type_count = 0 # size of the type table
+
+    def encode(self, obj) -> bytes:
+        """Encode an object.
+
+        If this raises an exception (e.g. because `obj` contains something
+        that pickle cannot handle), the Encoder is unchanged.
+        """
+        table = _Table(self)
+        body = io.BytesIO()
+        _Pickler(body, table).dump(obj)
+        data = pickle.dumps((
+            FORMAT_VERSION,
+            table.new_classes,
+            table.new_types,
+            table.entries,
+            body.getvalue()), protocol=pickle.HIGHEST_PROTOCOL)
+        self.classes.update(table.new_class_ids)
+        self.type_keys.update(table.new_type_keys)
+        self.type_count += len(table.new_types)
+        return data
+
+class Decoder(object):
+    """Converts bytes from an Encoder back to objects."""
+
+    def __init__(self):
+        self.classes = []
+        self.types = []
+
+    def decode(self, data : bytes):
+        version, new_classes, new_types, entries, body = pickle.loads(data)
+        if version != FORMAT_VERSION:
+            raise ValueError("unsupported wire format version {}".format(version))
+        self.classes.extend(_resolve_class(name) for name in new_classes)
+        self._build(new_types, self.types)
+        objects = []
+        self._build(entries, objects)
+        return _Unpickler(io.BytesIO(body), objects, self.types).load()
+
+    def _build(self, entries, out):
+        """Construct the objects for the given entries, appending them to `out`."""
+        classes = self.classes
+        types = self.types
+        for entry in entries:
+            kind = entry[0]
+            if kind == _ADT:
+                x = classes[entry[1]](*[types[r >> 1] if r & 1 else out[r >> 1] for r in entry[3:]])
+                r = entry[2]
+                if r is not None:
+                    x.type = types[r >> 1]
+            elif kind == _PRIMITIVE:
+                x = entry[1]
+            elif kind == _TUPLE:
+                x = tuple(types[r >> 1] if r & 1 else out[r >> 1] for r in entry[1:])
+            elif kind == _LIST:
+                x = [types[r >> 1] if r & 1 else out[r >> 1] for r in entry[1:]]
+            elif kind == _PICKLED:
+                x = _Unpickler(io.BytesIO(entry[1]), out, types).load()
+            else:
+                raise ValueError("unknown entry kind {}".format(kind))
+            out.append(x)
+
+def encode(obj) -> bytes:
+    """Encode one object on its own."""
+    return Encoder().encode(obj)
+
+def decode(data : bytes):
+    """Decode the output of `encode`."""
+    return Decoder().decode(data)
+
+def dump(obj, f):
+    """Write an object to a binary file."""
+    f.write(MAGIC)
+    f.write(encode(obj))
+
+def load(f):
+    """Read an object written by `dump` from a binary file.
+
+    For compatibility with older files, anything that does not start with the
+    right header is unpickled instead.
+    """
+    data = f.read()
+    if data.startswith(MAGIC):
+        return decode(data[len(MAGIC):])
+    return pickle.loads(data)
@@ -1,6 +1,6 @@
 import unittest
 
-from cozy.syntax_tools import alpha_equivalent, mk_lambda
+from cozy.syntax_tools import alpha_equivalent, alpha_key, mk_lambda
 from cozy.target_syntax import *
 
 class TestAlphaEquivalent(unittest.TestCase):
@@ -62,3 +62,31 @@ class TestAlphaEquivalent(unittest.TestCase):
         assert not alpha_equivalent(
             EMakeRecord((("x", ENum(0)), ("y", ETRUE))),
             EMakeRecord((("y", ETRUE), ("x", ENum(0)))))
+
+class TestAlphaKey(unittest.TestCase):
+
+    def test_binders(self):
+        v1 = EVar("foo").with_type(INT_BAG)
+        e1 = EMap(v1, mk_lambda(INT, lambda arg: arg))
+        e2 = EMap(v1, mk_lambda(INT, lambda arg: arg))
+        assert e1.transform_function.arg.id != e2.transform_function.arg.id
+        self.assertEqual(alpha_key(e1), alpha_key(e2))
+        self.assertEqual(repr(alpha_key(e1)), repr(alpha_key(e2)))
+
+    def test_mixed_binders(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        e1 = ELambda(x, ELambda(y, x))
+        e2 = ELambda(x, ELambda(x, x))
+        self.assertNotEqual(alpha_key(e1), alpha_key(e2))
+
+    def test_free_vars(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        self.assertNotEqual(alpha_key(x), alpha_key(y))
+        self.assertEqual(alpha_key(x, bound_vars=[x]), alpha_key(y, bound_vars=[y]))
+
+    def test_types(self):
+        self.assertNotEqual(
+            alpha_key(EVar("x").with_type(INT)),
+            alpha_key(EVar("x").with_type(BOOL)))
@@ -108,6 +108,26 @@ class TestContexts(unittest.TestCase):
         assert c1 != c2
         assert not c1.alpha_equivalent(c2)
 
+    def test_alpha_key(self):
+        root = RootCtx(args=[x, int_bag], state_vars=[])
+        def nested(outer, inner):
+            # inner in [inner + outer | ...], outer in xs, (root)
+            ctx = UnderBinder(root, outer, int_bag, RUNTIME_POOL)
+            bag = ESingleton(EBinOp(x, "+", outer).with_type(INT)).with_type(INT_BAG)
+            return UnderBinder(ctx, inner, bag, RUNTIME_POOL)
+        c1 = nested(y, z)
+        c2 = nested(z, y)
+        assert c1 != c2
+        assert c1.alpha_equivalent(c2)
+        self.assertEqual(c1.alpha_key(), c2.alpha_key())
+        self.assertEqual(hash(c1.alpha_key()), hash(c2.alpha_key()))
+
+        different_bag = UnderBinder(c1.parent(), z, ESingleton(y).with_type(INT_BAG), RUNTIME_POOL)
+        assert not c1.alpha_equivalent(different_bag)
+        self.assertNotEqual(c1.alpha_key(), different_bag.alpha_key())
+        different_pool = UnderBinder(c1.parent(), z, c1.bag, STATE_POOL)
+        self.assertNotEqual(c1.alpha_key(), different_pool.alpha_key())
+
     def test_let(self):
         e1 = ELet(ZERO, ELambda(x, x))
         root_ctx = RootCtx(args=(), state_vars=())
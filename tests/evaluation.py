@@ -2,9 +2,10 @@ import unittest
 
 from cozy.target_syntax import *
 from cozy.syntax_tools import *
-from cozy.value_types import Bag, Map, Handle, compare_values, values_equal, EQ
+from cozy.common import FrozenDict
+from cozy.value_types import Bag, Map, Handle, compare_values, values_equal, value_key, EQ
 from cozy.structures.heaps import TMinHeap
-from cozy.evaluation import eval, uneval
+from cozy.evaluation import eval, eval_bulk, uneval, compiled_programs, evaluator
 from cozy.typecheck import retypecheck
 
 zero = ENum(0).with_type(INT)
@@ -30,6 +31,73 @@ class TestEvaluation(unittest.TestCase):
         res = eval(e, env={})
         print(res)
 
+    def test_column_eval(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        b = EVar("b").with_type(BOOL)
+        t = TEnum(("A", "B", "C"))
+        c = EVar("c").with_type(t)
+        xs = EVar("xs").with_type(INT_BAG)
+        exps = [
+            EBinOp(EBinOp(x, "+", y).with_type(INT), "*", EUnaryOp("-", x).with_type(INT)).with_type(INT),
+            ECond(EBinOp(x, "<", y).with_type(BOOL), x, EBinOp(y, "-", ONE).with_type(INT)).with_type(INT),
+            EBinOp(b, BOp.Or, ENot(EBinOp(x, ">=", y).with_type(BOOL))).with_type(BOOL),
+            EBinOp(b, "=>", EEq(x, ZERO)).with_type(BOOL),
+            EBinOp(c, "<", EEnumEntry("B").with_type(t)).with_type(BOOL),
+            EStateVar(EBinOp(x, "!=", y).with_type(BOOL)).with_type(BOOL),
+            EBinOp(ELen(xs), "+", x).with_type(INT), # not scalar all the way down
+        ]
+        envs = [
+            {"x": x_val, "y": y_val, "b": b_val, "c": c_val, "xs": Bag((1,) * y_val)}
+            for x_val in (-1, 0, 2) for y_val in (0, 3) for b_val in (False, True) for c_val in t.cases]
+        for e in exps:
+            self.assertEqual(eval_bulk(e, envs), [eval(e, env) for env in envs], pprint(e))
+
+    def test_compiled_program_cache(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        def make_exp():
+            # fresh binder every time
+            return EFilter(xs, mk_lambda(INT, lambda x: EBinOp(x, ">", ONE).with_type(BOOL))).with_type(INT_BAG)
+        env = {"xs": Bag((1, 2, 3))}
+        assert eval(make_exp(), env) == Bag((2, 3))
+        hits = compiled_programs.hits
+        misses = compiled_programs.misses
+        assert eval(make_exp(), env) == Bag((2, 3))
+        self.assertEqual(compiled_programs.hits, hits + 1)
+        self.assertEqual(compiled_programs.misses, misses)
+        # same shape, different type: compiled separately
+        ys = EVar("xs").with_type(TBag(STRING))
+        self.assertEqual(eval(EUnaryOp(UOp.The, ys).with_type(STRING), {"xs": Bag(())}), "")
+        self.assertEqual(eval(EUnaryOp(UOp.The, xs).with_type(INT), {"xs": Bag(())}), 0)
+
+    def test_python_evaluator(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        r = TRecord((("a", INT), ("b", BOOL)))
+        exps = [
+            EFilter(xs, mk_lambda(INT, lambda v: EBinOp(v, ">", x).with_type(BOOL))).with_type(INT_BAG),
+            EMap(xs, mk_lambda(INT, lambda v: EBinOp(v, "*", x).with_type(INT))).with_type(INT_BAG),
+            EFlatMap(xs, mk_lambda(INT, lambda v: ESingleton(v).with_type(INT_BAG))).with_type(INT_BAG),
+            EArgMin(xs, mk_lambda(INT, lambda v: EUnaryOp("-", v).with_type(INT))).with_type(INT),
+            ELet(ELen(xs).with_type(INT), mk_lambda(INT, lambda n: EBinOp(n, "+", x).with_type(INT))).with_type(INT),
+            EMakeMap2(xs, mk_lambda(INT, lambda k: EBinOp(k, "+", x).with_type(INT))).with_type(TMap(INT, INT)),
+            EGetField(EMakeRecord((("a", x), ("b", EIn(x, xs).with_type(BOOL)))).with_type(r), "b").with_type(BOOL),
+            EUnaryOp(UOp.Distinct, xs).with_type(INT_BAG),
+            EUnaryOp(UOp.Sum, xs).with_type(INT),
+        ]
+        envs = [{"x": x_val, "xs": Bag(xs_val)} for x_val in (0, 1, 2) for xs_val in ((), (1,), (2, 1, 2))]
+        expected = [[eval(e, env) for env in envs] for e in exps]
+        old = evaluator.value
+        evaluator.value = "python"
+        compiled_programs.clear()
+        try:
+            for e, results in zip(exps, expected):
+                self.assertEqual(eval_bulk(e, envs), results, pprint(e))
+                self.assertEqual([eval(e, env) for env in envs], results, pprint(e))
+        finally:
+            evaluator.value = old
+            compiled_programs.clear()
+
     def test_map_eq(self):
         m = Map(TMap(THandle('Entry', TRecord((('key', TNative('uint64_t')), ('pixmap', TNative('QPixmap *')), ('indexData', TNative('QByteArray')), ('memSize', TInt()), ('diskSize', TInt()), ('st', TEnum(('Disk', 'Loading', 'DiskAndMemory', 'MemoryOnly', 'Saving', 'NetworkPending', 'IndexPending', 'Invalid'))), ('inUse', TBool())))), TEnum(('Disk', 'Loading', 'DiskAndMemory', 'MemoryOnly', 'Saving', 'NetworkPending', 'IndexPending', 'Invalid'))), 'Disk', [])
         assert m == m
@@ -49,6 +117,36 @@ class TestEvaluation(unittest.TestCase):
         assert b1 != b2
         assert values_equal(TBag(t), b1, b2)
 
+    def test_value_key(self):
+        h = THandle("H", INT)
+        h1 = Handle(address=0, value=0)
+        h2 = Handle(address=0, value=1)
+        h3 = Handle(address=1, value=0)
+        cases = [
+            (TBag(h), [Bag((h1, h3, h3)), Bag((h3, h2, h3)), Bag((h3, h3)), Bag(())]),
+            (TList(h), [(h1, h3), (h2, h3), (h3, h1)]),
+            (TMap(INT, TBag(h)), [
+                Map(TMap(INT, TBag(h)), Bag(()), [(1, Bag((h1,))), (2, Bag(()))]),
+                Map(TMap(INT, TBag(h)), Bag(()), [(2, Bag(())), (1, Bag((h2,)))]),
+                Map(TMap(INT, TBag(h)), Bag(()), [(1, Bag((h3,)))])]),
+            (TRecord((("x", h), ("y", TSet(INT)))), [
+                FrozenDict({"x": h1, "y": Bag((1, 2))}),
+                FrozenDict({"x": h2, "y": Bag((2, 1))}),
+                FrozenDict({"x": h3, "y": Bag((1, 2))})]),
+            (TMinHeap(BOOL, INT), [
+                Bag(((False, 7), (False, 13), (False, 13))),
+                Bag(((False, 13), (False, 13), (False, 7))),
+                Bag(((True, 7), (False, 13), (False, 13)))]),
+        ]
+        for t, values in cases:
+            for v1 in values:
+                for v2 in values:
+                    self.assertEqual(
+                        value_key(t, v1) == value_key(t, v2),
+                        values_equal(t, v1, v2),
+                        "{} vs {}".format(v1, v2))
+                    hash(value_key(t, v1))
+
     def test_set_sub(self):
         t = TSet(INT)
         s1 = Bag((0, 1))
@@ -0,0 +1,142 @@
+import datetime
+import time
+import unittest
+
+from cozy.jobs import Job, JobScheduler
+
+class SpinJob(Job):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+    def run(self):
+        while not self.stop_requested:
+            time.sleep(0.01)
+
+class ReportJob(Job):
+    def __init__(self, name, n):
+        super().__init__()
+        self.name = name
+        self.n = n
+    def run(self):
+        for i in range(self.n):
+            self.report((self.name, i))
+        while not self.stop_requested:
+            time.sleep(0.01)
+        self.report((self.name, "stopped"))
+
+class TestJobScheduler(unittest.TestCase):
+
+    def test_bounded_concurrency(self):
+        scheduler = JobScheduler(max_running=2)
+        for i in range(5):
+            scheduler.submit(SpinJob(i))
+        try:
+            scheduler.step(time_slice=datetime.timedelta(hours=1))
+            self.assertEqual(len(scheduler.running), 2)
+            self.assertEqual(len(scheduler.pending), 3)
+        finally:
+            scheduler.stop_all()
+        assert scheduler.finished
+
+    def test_preemption(self):
+        respawned = []
+        def respawn(j):
+            respawned.append(j.name)
+            return SpinJob(j.name)
+        scheduler = JobScheduler(max_running=1, respawn=respawn)
+        scheduler.submit(SpinJob("a"))
+        scheduler.submit(SpinJob("b"))
+        try:
+            scheduler.step(time_slice=datetime.timedelta(hours=1))
+            self.assertEqual([j.name for j in scheduler.running], ["a"])
+
+            # "a" has used up its slice while "b" waits
+            scheduler.step(time_slice=datetime.timedelta(0))
+            self.assertEqual(respawned, ["a"])
+            self.assertEqual([j.name for j in scheduler.pending], ["b", "a"])
+
+            # "b" starts once "a" has actually exited
+            deadline = time.time() + 30
+            while not scheduler.running and time.time() < deadline:
+                scheduler.step(time_slice=datetime.timedelta(hours=1))
+                time.sleep(0.05)
+            self.assertEqual([j.name for j in scheduler.running], ["b"])
+        finally:
+            scheduler.stop_all()
+
+    def test_priority_order(self):
+        weights = { "low": 1, "high": 10 }
+        scheduler = JobScheduler(max_running=1, priority=lambda j: weights[j.name])
+        scheduler.submit(SpinJob("low"))
+        scheduler.submit(SpinJob("high"))
+        try:
+            scheduler.step(time_slice=datetime.timedelta(hours=1))
+            self.assertEqual([j.name for j in scheduler.running], ["high"])
+            self.assertEqual([j.name for j in scheduler.pending], ["low"])
+        finally:
+            scheduler.stop_all()
+
+    def test_min_time_slice(self):
+        weights = { "low": 0.1, "high": 8 }
+        scheduler = JobScheduler(max_running=1, priority=lambda j: weights[j.name], min_time_slice=datetime.timedelta(minutes=10))
+        time_slice = datetime.timedelta(hours=1)
+        start = datetime.datetime.now()
+        scheduler.submit(SpinJob("low"))
+        try:
+            scheduler.step(time_slice, now=start)
+            scheduler.submit(SpinJob("high"))
+            # "low" would only get 1h * 0.1 / 4.05 (about 90s) without the bound
+            self.assertEqual(
+                scheduler.time_until_preemption(time_slice, now=start),
+                datetime.timedelta(minutes=10))
+            scheduler.step(time_slice, now=start + datetime.timedelta(minutes=5))
+            self.assertEqual([j.name for j in scheduler.running], ["low"])
+            scheduler.step(time_slice, now=start + datetime.timedelta(minutes=11))
+            self.assertEqual(scheduler.running, [])
+            self.assertEqual([j.name for j in scheduler.stopping], ["low"])
+        finally:
+            scheduler.stop_all()
+
+    def test_messages(self):
+        scheduler = JobScheduler(max_running=2)
+        scheduler.submit(ReportJob("a", 3))
+        scheduler.submit(ReportJob("b", 0))
+        try:
+            scheduler.step(time_slice=datetime.timedelta(hours=1))
+            received = []
+            deadline = time.time() + 30
+            while len(received) < 3 and time.time() < deadline:
+                received.extend(m for (j, m) in scheduler.wait(datetime.timedelta(seconds=30)))
+            self.assertEqual(received, [("a", 0), ("a", 1), ("a", 2)])
+        finally:
+            received = [m for (j, m) in scheduler.stop_all()]
+        self.assertEqual(sorted(received), [("a", "stopped"), ("b", "stopped")])
+
+    def test_channels_live_only_while_running(self):
+        scheduler = JobScheduler(max_running=1)
+        a = ReportJob("a", 1)
+        b = ReportJob("b", 0)
+        scheduler.submit(a)
+        scheduler.submit(b)
+        try:
+            scheduler.step(time_slice=datetime.timedelta(hours=1))
+            self.assertEqual(scheduler.running, [a])
+            assert a._inbox is not None and not a._outbox.closed
+            assert b._inbox is None and b._outbox is None
+            b.send("ignored")
+        finally:
+            received = [m for (j, m) in scheduler.stop_all()]
+        self.assertEqual(received, [("a", 0), ("a", "stopped")])
+        assert a._inbox is None and a._outbox.closed
+        a.send("ignored")
+
+    def test_wait_timeout(self):
+        scheduler = JobScheduler(max_running=1)
+        scheduler.submit(SpinJob("a"))
+        try:
+            scheduler.step(time_slice=datetime.timedelta(hours=1))
+            start = time.time()
+            self.assertEqual(scheduler.wait(datetime.timedelta(seconds=0.2)), [])
+            self.assertLess(time.time() - start, 5)
+        finally:
+            scheduler.stop_all()
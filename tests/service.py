@@ -0,0 +1,77 @@
+import unittest
+import asyncio
+import datetime
+import time
+
+from cozy.syntax import BOOL
+from cozy import service
+from cozy.main import InvalidSpecification
+
+SPEC = """
+    MyDataStructure:
+
+        state elements : Bag<Int>
+
+        query containsZero()
+            exists [x | x <- elements, x == 0]
+
+        op addElement(x : Int)
+            elements.add(x);
+"""
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+async def last(iterator):
+    res = None
+    async for x in iterator:
+        res = x
+    return res
+
+class TestService(unittest.TestCase):
+
+    def test_concurrent_synthesis(self):
+        driver = service.SynthesisDriver(max_running=2)
+        timeout = datetime.timedelta(seconds=30)
+        async def go():
+            return await asyncio.gather(
+                last(service.synthesize(SPEC, timeout, driver=driver)),
+                last(service.synthesize(SPEC.replace("x == 0", "x == 1"), timeout, driver=driver)))
+        for impl in run(go()):
+            (v, e), = list(impl.concretization_functions.items())
+            assert e.type == BOOL
+        self.assertEqual(driver.slots.available, 2)
+
+    def test_cancellation(self):
+        driver = service.SynthesisDriver(max_running=1)
+        async def go():
+            async for impl in service.synthesize(SPEC, datetime.timedelta(seconds=60), driver=driver):
+                # stop right after the initial implementation
+                return impl
+        impl = run(go())
+        assert impl is not None
+        deadline = time.time() + 30
+        while driver._thread is not None and time.time() < deadline:
+            time.sleep(0.1)
+        assert driver._thread is None
+        self.assertEqual(driver.slots.available, 1)
+
+    def test_invalid_specification(self):
+        async def go():
+            async for impl in service.synthesize("Broken:\n    query q()\n        x\n"):
+                pass
+        with self.assertRaises(InvalidSpecification):
+            run(go())
+
+    def test_generate_code(self):
+        driver = service.SynthesisDriver()
+        async def go():
+            async for impl in service.synthesize(SPEC, driver=driver):
+                return await service.generate_code(impl, java=True, driver=driver)
+        outputs = run(go())
+        assert "class MyDataStructure" in outputs["java"]
@@ -1,7 +1,8 @@
+import tempfile
 import unittest
 
-from cozy.common import OrderedSet
-from cozy.solver import satisfy, valid, satisfiable, IncrementalSolver, ModelCachingSolver
+from cozy.common import OrderedSet, save_property
+from cozy.solver import satisfy, valid, satisfiable, IncrementalSolver, ModelCachingSolver, solver_cache, solver_cache_dir, encoding_stats, encoding_memo_size, deepening_stats, iterative_deepening
 from cozy.typecheck import typecheck, retypecheck
 from cozy.target_syntax import *
 from cozy.structures.heaps import *
@@ -460,6 +461,151 @@ class TestSolver(unittest.TestCase):
         assert s.calls == 2
         assert s.hits == 1
 
+    def test_caching_solver_shared_examples(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        s = ModelCachingSolver(vars=[x, y], funcs=(), assumptions=EGt(x, ZERO))
+        # incomplete examples and examples violating the assumptions are dropped
+        assert s.add_examples([{"x": 1}, {"x": 0, "y": 0}, {"x": 2, "y": 2}]) == 1
+        assert s.add_examples([{"x": 2, "y": 2}]) == 0
+        assert s.satisfy(EEq(x, y)) == {"x": 2, "y": 2}
+        assert s.hits == 1
+
+    def test_solver_cache(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        def formula(binder):
+            # exists x in xs. x > 1
+            return EUnaryOp(UOp.Exists, EFilter(xs, ELambda(binder, EGt(binder, ONE))).with_type(INT_BAG)).with_type(BOOL)
+        solver_cache.clear()
+        m = satisfy(formula(EVar("a").with_type(INT)))
+        assert m is not None
+        self.assertEqual((solver_cache.hits, solver_cache.misses), (0, 1))
+        # alpha equivalent formulas hit the cache, and the model is still good
+        self.assertEqual(satisfy(formula(EVar("b").with_type(INT))), m)
+        self.assertEqual(solver_cache.hits, 1)
+        # unsatisfiable formulas too
+        unsat = EAll([formula(EVar("a").with_type(INT)), EEq(xs, EEmptyList().with_type(INT_BAG))])
+        assert not satisfiable(unsat)
+        assert not satisfiable(unsat)
+        self.assertEqual(solver_cache.hits, 2)
+        # the assumptions are part of the key
+        s = IncrementalSolver()
+        s.add_assumption(EEq(xs, EEmptyList().with_type(INT_BAG)))
+        assert s.satisfy(formula(EVar("a").with_type(INT))) is None
+        self.assertEqual(solver_cache.hits, 2)
+
+    def test_solver_cache_key_tracks_assumptions(self):
+        x = EVar("x").with_type(INT)
+        e = EGt(x, ONE)
+        s = IncrementalSolver()
+        key = s._cache_key(e)
+        s.push()
+        s.add_assumption(ELt(x, TWO))
+        assert s._cache_key(e) != key
+        s.pop()
+        self.assertEqual(s._cache_key(e), key)
+        # the key does not depend on the names of bound variables
+        xs = EVar("xs").with_type(INT_BAG)
+        def assumption(binder):
+            return EUnaryOp(UOp.All, EMap(xs, ELambda(binder, EGt(binder, ONE))).with_type(TBag(BOOL))).with_type(BOOL)
+        s1 = IncrementalSolver()
+        s1.add_assumption(assumption(EVar("a").with_type(INT)))
+        s2 = IncrementalSolver()
+        s2.add_assumption(assumption(EVar("b").with_type(INT)))
+        self.assertEqual(s1._cache_key(e), s2._cache_key(e))
+
+    def test_solver_cache_rejects_bad_models(self):
+        x = EVar("x").with_type(INT)
+        e = EGt(x, ONE)
+        solver_cache.clear()
+        assert satisfy(e) is not None
+        key, = solver_cache.entries.keys()
+        solver_cache.entries[key] = {"x": 0}
+        self.assertGreater(satisfy(e)["x"], 1)
+        self.assertEqual(solver_cache.rejected, 1)
+
+    def test_solver_cache_dir(self):
+        x = EVar("x").with_type(INT)
+        e = EGt(x, ONE)
+        with tempfile.TemporaryDirectory() as d:
+            with save_property(solver_cache_dir, "value"):
+                solver_cache_dir.value = d
+                solver_cache.clear()
+                m = satisfy(e)
+                # as if in another process
+                solver_cache.clear()
+                self.assertEqual(satisfy(e), m)
+                self.assertEqual(solver_cache.disk_hits, 1)
+
+    def test_define(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        target = EUnaryOp(UOp.Sum, xs).with_type(INT)
+        s = ModelCachingSolver(vars=[xs, y], funcs={})
+        s.push()
+        v = s.define(target)
+        assert v not in (xs, y)
+        m = s.satisfy(EAll([EGt(v, ONE), ELt(ELen(xs), TWO)]))
+        assert m is not None
+        assert v.id not in m
+        self.assertGreater(sum(m["xs"]), 1)
+        assert s.satisfy(EAll([EGt(v, ONE), EEq(xs, EEmptyList().with_type(INT_BAG))])) is None
+        # cached examples are checked against the definition too
+        assert s.satisfy(ENot(EEq(v, target))) is None
+        s.pop()
+        assert v.id not in s.solver.definitions
+
+    def test_encoding_memo(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        positives = EFilter(xs, mk_lambda(INT, lambda x: EGt(x, ZERO))).with_type(INT_BAG)
+        s = IncrementalSolver()
+        m = s.satisfy(EGt(ELen(positives), ONE))
+        assert m is not None
+        self.assertGreater(len([x for x in m["xs"] if x > 0]), 1)
+        hits = encoding_stats.hits
+        m = s.satisfy(EAll([EEq(ELen(positives), ZERO), EGt(ELen(xs), ZERO)]))
+        assert m is not None
+        assert all(x <= 0 for x in m["xs"])
+        self.assertGreater(encoding_stats.hits, hits)
+        # a structurally equal subterm with different types is not a hit
+        ys = EVar("ys").with_type(TBag(FLOAT))
+        s.satisfy(EGt(ELen(EFilter(ys, mk_lambda(FLOAT, lambda y: EGt(y, ENum(0).with_type(FLOAT)))).with_type(TBag(FLOAT))), ONE))
+        with save_property(encoding_memo_size, "value"):
+            encoding_memo_size.value = 0
+            hits = encoding_stats.hits
+            s = IncrementalSolver()
+            s.satisfy(EGt(ELen(positives), ONE))
+            s.satisfy(EEq(ELen(positives), ZERO))
+            self.assertEqual(encoding_stats.hits, hits)
+
+    def test_iterative_deepening(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        with save_property(iterative_deepening, "value"):
+            iterative_deepening.value = 1
+            deepening_stats.clear()
+            s = IncrementalSolver(collection_depth=4)
+            m = s.satisfy(EIn(x, xs))
+            assert m["x"] in m["xs"]
+            self.assertEqual(deepening_stats.resolved[1], 1)
+            m = s.satisfy(EGt(ELen(xs), ENum(2).with_type(INT)))
+            self.assertGreater(len(m["xs"]), 2)
+            self.assertEqual(deepening_stats.resolved[4], 1)
+            self.assertEqual(deepening_stats.escalations, 2)
+            assert s.satisfy(EGt(ELen(xs), ENum(4).with_type(INT))) is None
+            # queries without collections are solved at full depth only
+            escalations = deepening_stats.escalations
+            assert s.satisfy(EGt(x, ONE)) is not None
+            self.assertEqual(deepening_stats.escalations, escalations)
+            # assumptions (and their scopes) apply at every depth
+            s.push()
+            s.add_assumption(EGt(ELen(xs), ONE))
+            m = s.satisfy(EIn(x, xs))
+            self.assertGreater(len(m["xs"]), 1)
+            s.pop()
+            m = s.satisfy(EEq(ELen(xs), ONE))
+            self.assertEqual(len(m["xs"]), 1)
+
     def test_regression26(self):
         e = EMap(EVar('_tmp639').with_type(TList(TFloat())), ELambda(EVar('x').with_type(TFloat()), EVar('x').with_type(TFloat()))).with_type(TList(TFloat()))
         v = fresh_var(e.type)
@@ -0,0 +1,105 @@
+import os
+import unittest
+
+import z3
+
+from cozy.common import save_property
+from cozy.target_syntax import *
+from cozy.jobs import Job, stop_jobs
+from cozy.solver import IncrementalSolver, satisfy, valid, solver_cache
+from cozy.solver_service import SolverService, STRATEGIES, SAT, UNSAT, UNKNOWN, model_hints, solver_processes, solver_portfolio, default_service
+
+def smt2(*constraints):
+    s = z3.Solver(ctx=constraints[0].ctx)
+    s.add(*constraints)
+    return s.to_smt2()
+
+class SolveJob(Job):
+    def run(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        m = satisfy(EAll([EIn(x, xs), EGt(x, ONE)]), validate_model=True)
+        service = default_service()
+        self.report((
+            m is not None and m["x"] in m["xs"],
+            os.getpid(),
+            [w.process.pid for w in service.workers if w is not None],
+            service.calls))
+
+class TestSolverService(unittest.TestCase):
+
+    def setUp(self):
+        self.service = SolverService(2)
+
+    def tearDown(self):
+        self.service.close()
+
+    def test_portfolio(self):
+        ctx = z3.Context()
+        x = z3.Int("x", ctx)
+        y = z3.Real("y", ctx)
+        formula = smt2(x > 3, y * 3 == x)
+        answer, values, i = self.service.check(
+            [(formula, s, (SAT, UNSAT)) for s in STRATEGIES.values()])
+        self.assertEqual(answer, SAT)
+        assert i is not None
+        s = z3.Solver(ctx=ctx)
+        s.add(x > 3, y * 3 == x)
+        self.assertEqual(s.check(*model_hints(values, ctx)), z3.sat)
+        answer, _, _ = self.service.check([(smt2(x > 3, x < 2), STRATEGIES["default"], (SAT, UNSAT))])
+        self.assertEqual(answer, UNSAT)
+        # answers that are not definitive do not end the race
+        answer, _, i = self.service.check([(formula, STRATEGIES["default"], (UNSAT,))])
+        self.assertEqual(answer, UNKNOWN)
+        assert i is None
+
+    def test_timeout(self):
+        ctx = z3.Context()
+        x, y, z = z3.Ints("x y z", ctx)
+        hard = smt2(x*x*x + y*y*y + z*z*z == 33)
+        answer, reason, i = self.service.check(
+            [(hard, STRATEGIES["default"], (SAT, UNSAT)), (hard, STRATEGIES["simplify"], (SAT, UNSAT))],
+            timeout=1)
+        self.assertEqual(answer, UNKNOWN)
+        self.assertEqual(self.service.timeouts, 1)
+        # the pool recovers from killed workers
+        answer, _, _ = self.service.check([(smt2(x > 3), STRATEGIES["default"], (SAT, UNSAT))])
+        self.assertEqual(answer, SAT)
+
+    def test_incremental_solver(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        with save_property(solver_processes, "value"), save_property(solver_portfolio, "value"):
+            solver_processes.value = 2
+            solver_portfolio.value = "default,simplify"
+            m = satisfy(EAll([EIn(x, xs), EGt(x, ONE)]), validate_model=True)
+            assert m is not None
+            assert m["x"] in m["xs"]
+            assert valid(EImplies(EGt(x, ONE), EGt(x, ZERO)))
+            s = IncrementalSolver()
+            s.add_assumption(EGt(ELen(xs), ONE))
+            assert s.satisfy(EEq(xs, EEmptyList().with_type(INT_BAG))) is None
+
+    def test_job(self):
+        with save_property(solver_processes, "value"), save_property(solver_portfolio, "value"):
+            solver_processes.value = 2
+            solver_portfolio.value = "default,simplify"
+            solver_cache.clear()
+            # the parent's service exists before the job is forked
+            assert valid(EImplies(EGt(EVar("x").with_type(INT), ONE), EGt(EVar("x").with_type(INT), ZERO)))
+            parent_service = default_service()
+            parent_workers = [w.process.pid for w in parent_service.workers if w is not None]
+            assert parent_workers
+            j = SolveJob()
+            j.start()
+            j.join(timeout=60)
+            messages = [m for (job, m) in stop_jobs([j])]
+            assert j.successful
+            (ok, pid, workers, calls), = messages
+            assert ok
+            self.assertNotEqual(pid, os.getpid())
+            assert workers and not set(workers) & set(parent_workers)
+            assert calls > 0
+            # the parent's workers are untouched
+            self.assertEqual([w.process.pid for w in parent_service.workers if w is not None], parent_workers)
+            assert all(w.process.is_alive() for w in parent_service.workers if w is not None)
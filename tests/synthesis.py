@@ -1,8 +1,11 @@
 import unittest
 import datetime
+import pickle
+import itertools
+import tempfile
 
-from cozy.common import save_property
-from cozy.syntax_tools import mk_lambda, pprint, alpha_equivalent, deep_copy
+from cozy.common import save_property, StopException
+from cozy.syntax_tools import mk_lambda, pprint, alpha_equivalent, alpha_key, deep_copy, all_exps, free_vars
 from cozy.target_syntax import *
 from cozy.contexts import RootCtx, UnderBinder
 from cozy.typecheck import retypecheck, typecheck
@@ -10,14 +13,16 @@ from cozy.evaluation import mkval
 from cozy.cost_model import CostModel
 from cozy.synthesis import construct_initial_implementation, improve_implementation
 from cozy.synthesis.core import improve
-from cozy.synthesis.enumeration import Enumerator, Fingerprint
+from cozy.synthesis.enumeration import enumeration_workers, Enumerator, Fingerprint, ValueTable, ExpCache, EnumeratedExp, bottom_up_fingerprints, fingerprint_before_wf, enumeration_max_shadows, _fingerprint_from_children
 from cozy.parse import parse_spec
 from cozy.solver import valid, satisfy
 from cozy.pools import RUNTIME_POOL, STATE_POOL
 from cozy.desugar import desugar
-from cozy.value_types import Bag
+from cozy.value_types import Bag, Handle
 from cozy.structures.heaps import EMakeMinHeap, EMakeMaxHeap, EHeapPeek, EHeapPeek2
 from cozy.synthesis.acceleration import accelerate
+from cozy.synthesis.result_cache import ResultCache
+from cozy.synthesis import high_level_interface, core
 
 handle_type = THandle("H", INT)
 handle1 = (1, mkval(INT))
@@ -51,6 +56,128 @@ class TestSynthesisCore(unittest.TestCase):
         assert retypecheck(assumptions)
         assert check_discovery(target, EStateVar(EVar("xs")), args=[x], state_vars=[xs], assumptions=assumptions)
 
+    def test_hints_callback(self):
+        x = EVar("x").with_type(BOOL)
+        xs = EVar("xs").with_type(TBag(BOOL))
+        target = EFilter(EStateVar(xs), ELambda(x, x))
+        assumptions = EUnaryOp(UOp.All, xs)
+        assert retypecheck(target)
+        assert retypecheck(assumptions)
+        updates = [[EStateVar(xs).with_type(xs.type)]]
+        def hints_callback():
+            return updates.pop() if updates else None
+        for r in improve(target,
+                assumptions=assumptions,
+                context=RootCtx(state_vars=[xs], args=[x]),
+                hints_callback=hints_callback):
+            if alpha_equivalent(r, EStateVar(xs)):
+                break
+        else:
+            assert False, "did not find the solution"
+        assert not updates
+
+    def test_callbacks_are_rate_limited(self):
+        x = EVar("x").with_type(BOOL)
+        xs = EVar("xs").with_type(TBag(BOOL))
+        target = EFilter(EStateVar(xs), ELambda(x, x))
+        assert retypecheck(target)
+        checks = []
+        polls = []
+        def stop_callback():
+            checks.append(None)
+            return len(checks) > 2000
+        def hints_callback():
+            polls.append("hints")
+            return None
+        def examples_callback():
+            polls.append("examples")
+            return []
+        with self.assertRaises(StopException):
+            for r in improve(target,
+                    context=RootCtx(state_vars=[xs], args=[x]),
+                    stop_callback=stop_callback,
+                    hints_callback=hints_callback,
+                    examples_callback=examples_callback):
+                pass
+        assert polls.count("hints") == polls.count("examples")
+        assert 1 <= len(polls) < len(checks) / 10, "{} polls for {} checks".format(len(polls), len(checks))
+
+    def test_resume(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        target = EUnaryOp(UOp.Length, EFilter(EStateVar(xs), mk_lambda(INT, lambda x: EEq(x, y)))).with_type(INT)
+        assert retypecheck(target)
+        ctx = RootCtx(state_vars=[xs], args=[y])
+        states = []
+        try:
+            for r in improve(target, context=ctx,
+                    stop_callback=lambda: bool(states) and states[-1].size is not None and states[-1].size >= 2,
+                    checkpoint_callback=states.append):
+                target = r
+        except StopException:
+            pass
+        state = states[-1]
+        assert state.size == 2
+        resumed = []
+        try:
+            for r in improve(target, context=ctx,
+                    stop_callback=lambda: bool(resumed),
+                    resume=state,
+                    checkpoint_callback=resumed.append):
+                pass
+        except StopException:
+            pass
+        assert resumed[0].size == 2
+        assert resumed[0].examples == state.examples
+
+    def test_new_hints_keep_the_cache(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        target = EUnaryOp(UOp.Length, EFilter(EStateVar(xs), mk_lambda(INT, lambda x: EEq(x, y)))).with_type(INT)
+        assert retypecheck(target)
+        hint = ELen(EStateVar(xs).with_type(INT_BAG)).with_type(INT)
+        states = []
+        delivered = []
+        def hints_callback():
+            if not delivered and states and states[-1].size is not None and states[-1].size >= 2:
+                delivered.append(len(states))
+                return [hint]
+            return None
+        with save_property(core, "POLL_INTERVAL"):
+            core.POLL_INTERVAL = datetime.timedelta(0)
+            try:
+                for r in improve(target, context=RootCtx(state_vars=[xs], args=[y]),
+                        stop_callback=lambda: bool(delivered) and len(states) > delivered[0] and states[-1].size >= 1,
+                        hints_callback=hints_callback,
+                        checkpoint_callback=states.append):
+                    pass
+            except StopException:
+                pass
+        before, after = states[delivered[0] - 1], states[delivered[0]]
+        assert any(alpha_equivalent(h, hint) for h in after.hints)
+        self.assertEqual(after.size, 0)
+        assert after.enumerator_cache is before.enumerator_cache
+
+    def test_unchanged_hints_do_not_restart(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        target = EUnaryOp(UOp.Length, EFilter(EStateVar(xs), mk_lambda(INT, lambda x: EEq(x, y)))).with_type(INT)
+        assert retypecheck(target)
+        states = []
+        with save_property(core, "POLL_INTERVAL"):
+            core.POLL_INTERVAL = datetime.timedelta(0)
+            try:
+                for r in improve(target, context=RootCtx(state_vars=[xs], args=[y]),
+                        stop_callback=lambda: len(states) > 50 or (bool(states) and states[-1].size >= 2),
+                        hints_callback=lambda: [],
+                        checkpoint_callback=states.append):
+                    pass
+            except StopException:
+                pass
+        # every poll returns the same (empty) hints; restarting each time
+        # would never get past size 0
+        self.assertEqual(states[-1].size, 2)
+
     def test_bag_plus_minus(self):
         t = THandle("H", INT)
         x = EVar("x").with_type(t)
@@ -131,6 +258,281 @@ class TestEnumeration(unittest.TestCase):
         assert not fp1.subset_of(fp2)
         assert fp2.subset_of(fp1)
 
+    def test_fingerprint_columns(self):
+        t_enum = TEnum(("A", "B"))
+        t_handle = THandle("H", INT)
+        cases = [
+            (INT, [0, -3, 2**70]),
+            (BOOL, [True, False]),
+            (t_enum, ["B", "A"]),
+            (INT_BAG, [Bag((1, 2)), Bag(())]),
+            (t_handle, [Handle(1, 5), Handle(1, 6)])]
+        for t, outputs in cases:
+            fp = Fingerprint(t, outputs)
+            self.assertEqual(fp.outputs, tuple(outputs))
+            self.assertEqual(len(fp), len(outputs))
+            same = Fingerprint(t, list(outputs))
+            self.assertEqual(fp, same)
+            self.assertEqual(hash(fp), hash(same))
+            self.assertNotEqual(fp, Fingerprint(t, outputs[::-1]))
+            self.assertEqual(pickle.loads(pickle.dumps(fp)), fp)
+        # deep equality: handles with the same address but different values differ
+        assert not Fingerprint(t_handle, [Handle(1, 5)]) == Fingerprint(t_handle, [Handle(1, 6)])
+        assert Fingerprint(t_handle, [Handle(1, 5)]).equal_to(Fingerprint(t_handle, [Handle(1, 6)]))
+
+    def test_fingerprint_value_tables(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        context = RootCtx(state_vars=[xs])
+        outputs = [Bag((1, 2)), Bag(())]
+        fp = Fingerprint(INT_BAG, outputs)
+        other = Fingerprint(INT_BAG, outputs, ValueTable())
+        self.assertEqual(fp, other)
+        self.assertEqual(hash(fp), hash(other))
+
+        cache = ExpCache()
+        keep = EnumeratedExp(xs, fp, 0)
+        gone = EnumeratedExp(EEmptyList().with_type(INT_BAG), Fingerprint(INT_BAG, [Bag((i,)) for i in range(100)]), 1)
+        cache.add(context, RUNTIME_POOL, keep)
+        cache.add(context, RUNTIME_POOL, gone)
+        entry, = cache.find_equivalent_expressions(context, RUNTIME_POOL, fp)
+        assert entry.fingerprint._table is cache.values
+        cache.remove(context, RUNTIME_POOL, gone)
+        self.assertEqual(len(cache.values), 102)
+        # values of removed expressions are forgotten
+        cache.compact_values()
+        self.assertEqual(len(cache.values), 2)
+        entry, = cache.find_equivalent_expressions(context, RUNTIME_POOL, fp)
+        assert entry.fingerprint._table is cache.values
+        self.assertEqual(entry.fingerprint.outputs, tuple(outputs))
+        self.assertEqual([entry], list(cache.find_expressions_of_size(context, RUNTIME_POOL, 0)))
+        # unpickled caches share one table again
+        cache = pickle.loads(pickle.dumps(cache))
+        entry, = cache.find_equivalent_expressions(context, RUNTIME_POOL, fp)
+        assert entry.fingerprint._table is cache.values
+
+    def test_parallel_enumeration(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[xs], args=[y])
+        examples = [{"xs": Bag(()), "y": 0}, {"xs": Bag((1,2)), "y": 1}, {"xs": Bag((1,1)), "y": 2}]
+        def check_wf(e, ctx, pool):
+            return not (isinstance(e, EUnaryOp) and e.op == "-")
+
+        def run(workers):
+            enumerator = Enumerator(
+                examples=examples,
+                cost_model=CostModel(),
+                check_wf=check_wf,
+                workers=workers)
+            try:
+                return [(info.e, info.fingerprint)
+                    for size in range(2)
+                    for info in enumerator.enumerate_with_info(context, size, RUNTIME_POOL)]
+            finally:
+                enumerator.close()
+
+        sequential = run(0)
+        parallel = run(2)
+        assert not any(isinstance(e, EUnaryOp) and e.op == "-" for e, _ in sequential)
+        assert len(sequential) > 10
+        assert len(sequential) == len(parallel)
+        for (e1, fp1), (e2, fp2) in zip(sequential, parallel):
+            assert alpha_equivalent(e1, e2), "{} != {}".format(pprint(e1), pprint(e2))
+            assert fp1 == fp2
+
+    def test_add_examples(self):
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[], args=[y])
+        enumerator = Enumerator(
+            examples=[{"y": 0}],
+            cost_model=CostModel(),
+            keep_shadows=True)
+        before = [info.e for size in range(2) for info in enumerator.enumerate_with_info(context, size, RUNTIME_POOL)]
+        # y and 0 look equivalent, so only one of them is cached
+        assert not (y in before and ZERO in before)
+
+        enumerator.add_examples([{"y": 1}])
+        examples = [{"y": 0}, {"y": 1}]
+        after = [info for size in range(2) for info in enumerator.enumerate_with_info(context, size, RUNTIME_POOL)]
+        for info in after:
+            assert info.fingerprint == Fingerprint.of(info.e, examples)
+        assert any(info.e == y for info in after)
+        assert any(info.e == ZERO for info in after)
+
+        fresh = Enumerator(examples=examples, cost_model=CostModel())
+        expected = [info.e for size in range(2) for info in fresh.enumerate_with_info(context, size, RUNTIME_POOL)]
+        self.assertEqual(
+            sorted(pprint(info.e) for info in after),
+            sorted(pprint(e) for e in expected))
+
+    def test_shadows_are_checked_lazily(self):
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[], args=[y])
+        checked = []
+        def check_wf(e, ctx, pool):
+            checked.append(e)
+            return e != y
+        enumerator = Enumerator(
+            examples=[{"y": 0}],
+            cost_model=CostModel(),
+            check_wf=check_wf,
+            keep_shadows=True)
+        assert ZERO in list(enumerator.enumerate(context, 0, RUNTIME_POOL))
+        # y looks like 0, so it is only a shadow and is not checked
+        assert any(entry.e == y for entry in itertools.chain(*enumerator.cache.shadows.values()))
+        assert y not in checked
+
+        # ...until new examples distinguish it
+        enumerator.add_examples([{"y": 1}])
+        assert y in checked
+        assert y not in list(enumerator.enumerate(context, 0, RUNTIME_POOL))
+        assert not any(entry.e == y for entry in itertools.chain(*enumerator.cache.shadows.values()))
+        self.assertEqual(enumerator.wf_checks, len(checked))
+
+    def test_shadows_are_bounded(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[xs], args=[y])
+        examples = [{"xs": Bag(()), "y": 0}]
+
+        def run(max_shadows):
+            with save_property(enumeration_max_shadows, "value"):
+                enumeration_max_shadows.value = max_shadows
+                enumerator = Enumerator(examples=list(examples), cost_model=CostModel(), keep_shadows=True)
+            for size in range(3):
+                for e in enumerator.enumerate(context, size, RUNTIME_POOL):
+                    pass
+            return enumerator
+
+        unbounded = run(0).cache
+        enumerator = run(2)
+        cache = enumerator.cache
+        # with one example nearly everything looks equivalent
+        assert unbounded.in_memory() > 3 * len(unbounded)
+        assert cache.in_memory() <= 3 * len(cache)
+        for key, shadows in cache.shadows.items():
+            counts = {}
+            for entry in shadows:
+                counts[entry.fingerprint] = counts.get(entry.fingerprint, 0) + 1
+            assert all(n <= 2 for n in counts.values())
+            self.assertEqual(counts, dict(cache.shadow_counts[key]))
+        assert any(cache.shadow_overflow.values())
+        self.assertEqual(pickle.loads(pickle.dumps(cache)).shadow_counts, cache.shadow_counts)
+
+        # sizes whose shadows were not all kept are enumerated again
+        key, sizes = next((key, sizes) for key, sizes in cache.shadow_overflow.items() if sizes)
+        pool, ctx = key
+        size = min(sizes)
+        assert (pool, size, ctx) in enumerator.complete
+        enumerator.add_examples(examples)
+        assert not any(cache.shadow_overflow.values())
+        assert (pool, size, ctx) not in enumerator.complete
+        assert all(k[1] < size for k in enumerator.complete)
+
+    def test_bottom_up_fingerprints(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[xs], args=[y])
+        examples = [{"xs": Bag(()), "y": 0}, {"xs": Bag((1,2)), "y": 1}, {"xs": Bag((1,1)), "y": 2}]
+
+        def run(bottom_up):
+            with save_property(bottom_up_fingerprints, "value"):
+                bottom_up_fingerprints.value = bottom_up
+                enumerator = Enumerator(examples=examples, cost_model=CostModel())
+                return enumerator, [list(enumerator.enumerate_with_info(context, size, RUNTIME_POOL)) for size in range(3)]
+
+        enumerator, infos = run(True)
+        _, expected = run(False)
+        for size in range(3):
+            for info in infos[size]:
+                self.assertEqual(info.fingerprint, Fingerprint.of(info.e, examples), pprint(info.e))
+            self.assertEqual(
+                set(alpha_key(info.e) for info in infos[size]),
+                set(alpha_key(info.e) for info in expected[size]))
+
+        known = { id(info.e) : info for info in infos[0] + infos[1] }
+        y_entry = next(info for info in infos[0] if info.e == y)
+        e = EBinOp(y_entry.e, "+", y_entry.e).with_type(INT)
+        self.assertEqual(_fingerprint_from_children(e, known, examples), Fingerprint.of(e, examples))
+        xs_entry = next(info for info in infos[1] if info.e == EStateVar(xs))
+        e = EUnaryOp(UOp.Length, xs_entry.e).with_type(INT)
+        self.assertEqual(_fingerprint_from_children(e, known, examples), Fingerprint.of(e, examples))
+        # binders are not handled
+        assert _fingerprint_from_children(EMap(xs_entry.e, mk_lambda(INT, lambda x: x)).with_type(INT_BAG), known, examples) is None
+
+    def test_fingerprint_before_wf(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[xs], args=[y])
+        examples = [{"xs": Bag(()), "y": 0}, {"xs": Bag((1,2)), "y": 1}, {"xs": Bag((1,1)), "y": 2}]
+
+        def run(fingerprint_first):
+            checked = []
+            def check_wf(e, ctx, pool):
+                checked.append(e)
+                # reject subtraction
+                return not any(isinstance(x, EBinOp) and x.op == "-" for x in all_exps(e))
+            with save_property(fingerprint_before_wf, "value"):
+                fingerprint_before_wf.value = fingerprint_first
+                enumerator = Enumerator(examples=examples, cost_model=CostModel(), check_wf=check_wf)
+                res = [set(alpha_key(e) for e in enumerator.enumerate(context, size, RUNTIME_POOL)) for size in range(3)]
+            self.assertEqual(enumerator.wf_checks, len(checked))
+            return res, enumerator
+
+        expected, eager = run(False)
+        res, lazy = run(True)
+        self.assertEqual(res, expected)
+        self.assertEqual(eager.wf_checks_avoided, 0)
+        assert lazy.wf_checks_avoided > 0
+        self.assertEqual(lazy.wf_checks + lazy.wf_checks_avoided, eager.wf_checks)
+
+    def test_adapted_requests(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        a = EVar("a").with_type(INT)
+        b = EVar("b").with_type(INT)
+        root = RootCtx(state_vars=[], args=[xs])
+        c1 = UnderBinder(root, a, xs, RUNTIME_POOL)
+        c2 = UnderBinder(root, b, xs, RUNTIME_POOL)
+        enumerator = Enumerator(examples=[{"xs": Bag((1, 2))}], cost_model=CostModel())
+        for size in range(2):
+            list(enumerator.enumerate(c1, size, RUNTIME_POOL))
+        self.assertIs(enumerator.canonical_context(c2), c1)
+        first = list(enumerator.enumerate(c2, 1, RUNTIME_POOL))
+        assert (RUNTIME_POOL, 1, c2) in enumerator.adapted
+        assert any(e == b for e in enumerator.enumerate(c2, 0, RUNTIME_POOL))
+        assert not any(a in free_vars(e) for e in first)
+        self.assertEqual(list(enumerator.enumerate(c2, 1, RUNTIME_POOL)), first)
+
+    def test_cache_limit(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[xs], args=[y])
+        examples = [{"xs": Bag(()), "y": 0}, {"xs": Bag((1,2)), "y": 1}, {"xs": Bag((1,1)), "y": 2}]
+
+        def run(limit, spill_dir=None):
+            enumerator = Enumerator(examples=examples, cost_model=CostModel())
+            enumerator.cache.limit = limit
+            enumerator.cache.spill_dir = spill_dir
+            for size in range(2):
+                for e in enumerator.enumerate(context, size, RUNTIME_POOL):
+                    pass
+            # ask again; some of these have been forgotten or spilled by now
+            res = [set(alpha_key(e) for e in enumerator.enumerate(context, size, RUNTIME_POOL)) for size in range(2)]
+            return res, enumerator.cache
+
+        expected, _ = run(0)
+        dropped, cache = run(15)
+        assert cache.dropped > 0
+        for size in range(2):
+            # Re-enumerating may bring back expressions that were evicted
+            # the first time around, but nothing should be missing.
+            assert expected[size] <= dropped[size]
+        with tempfile.TemporaryDirectory() as d:
+            spilled, cache = run(15, spill_dir=d)
+            self.assertEqual(expected, spilled)
+            assert cache.spills > 0
+            assert cache.reloads > 0
+
     def test_state_pool_boundary(self):
         """
         When enumerating expressions, we shouldn't ever enumerate state
@@ -256,6 +658,31 @@ class TestEnumeration(unittest.TestCase):
                     print("^^^ FOUND")
             assert found_heap_peek
 
+class TestResultCache(unittest.TestCase):
+
+    def test_lookup_ignores_argument_names(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        def query(arg_name):
+            a = EVar(arg_name).with_type(INT)
+            ret = EUnaryOp(UOp.Exists, EFilter(xs, mk_lambda(INT, lambda x: EEq(x, a))).with_type(INT_BAG)).with_type(BOOL)
+            return Query("q", Visibility.Public, ((arg_name, INT),), (), ret, "")
+        state = [xs]
+        v = EVar("v").with_type(TMap(INT, BOOL))
+        new_ret = EHasKey(v, EVar("a").with_type(INT)).with_type(BOOL)
+        new_rep = [(v, EMakeMap2(xs, mk_lambda(INT, lambda x: ETRUE)).with_type(v.type))]
+        with tempfile.TemporaryDirectory() as d:
+            cache = ResultCache(d)
+            assert cache.lookup(query("a"), state, [], {}, []) is None
+            cache.store(query("a"), state, [], {}, [], new_rep, new_ret, examples=[({"xs": Bag((1,)), "a": 1}, {"xs": INT_BAG, "a": INT})])
+            res = cache.lookup(query("b"), state, [], {}, [])
+            assert res is not None
+            rep, ret, examples = res
+            assert len(rep) == 1
+            assert ret.map == rep[0][0]
+            self.assertEqual(ret.key, EVar("b"))
+            self.assertEqual(examples, [({"xs": Bag((1,)), "b": 1}, {"xs": INT_BAG, "b": INT})])
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
 class TestSpecificationSynthesis(unittest.TestCase):
 
     def test_bag_elimination(self):
@@ -285,3 +712,106 @@ class TestSpecificationSynthesis(unittest.TestCase):
         (v, e), = list(impl.concretization_functions.items())
         print("{} = {}".format(v, pprint(e)))
         assert e.type == BOOL
+
+    def test_finished_queries_are_not_restarted(self):
+        spec = """
+            MyDataStructure:
+
+                state elements : Bag<Int>
+                state n : Int
+
+                query getN()
+                    n
+
+                query containsZero()
+                    exists [x | x <- elements, x == 0]
+
+                op addElement(x : Int)
+                    elements.add(x);
+        """
+
+        spec = parse_spec(spec)
+        errs = typecheck(spec)
+        assert not errs, str(errs)
+        spec = desugar(spec)
+
+        started = []
+        original_start = high_level_interface.ImproveQueryJob.start
+        def start(job):
+            started.append(job.q.name)
+            original_start(job)
+        with save_property(high_level_interface.ImproveQueryJob, "start"), save_property(high_level_interface.max_jobs, "value"):
+            high_level_interface.ImproveQueryJob.start = start
+            high_level_interface.max_jobs.value = 2
+            impl = construct_initial_implementation(spec)
+            impl = improve_implementation(impl, timeout=datetime.timedelta(seconds=30))
+
+        # getN is already done, so its job exits right away; improvements to
+        # containsZero must not start it again
+        self.assertEqual(started.count("getN"), 1)
+        (v, e), = [(v, e) for (v, e) in impl.concretization_functions.items() if e.type == BOOL]
+
+    def test_jobs_with_enumeration_workers(self):
+        spec = """
+            MyDataStructure:
+
+                state elements : Bag<Int>
+
+                query containsZero()
+                    exists [x | x <- elements, x == 0]
+
+                op addElement(x : Int)
+                    elements.add(x);
+        """
+
+        spec = parse_spec(spec)
+        errs = typecheck(spec)
+        assert not errs, str(errs)
+        spec = desugar(spec)
+
+        started = []
+        original_start = high_level_interface.ImproveQueryJob.start
+        def start(job):
+            started.append(job)
+            original_start(job)
+        with save_property(high_level_interface.ImproveQueryJob, "start"), save_property(enumeration_workers, "value"):
+            high_level_interface.ImproveQueryJob.start = start
+            enumeration_workers.value = 2
+            impl = construct_initial_implementation(spec)
+            impl = improve_implementation(impl, timeout=datetime.timedelta(seconds=20))
+
+        assert started
+        for j in started:
+            assert j.successful, "{} failed".format(j)
+        (v, e), = [(v, e) for (v, e) in impl.concretization_functions.items() if e.type == BOOL]
+
+    def test_pending_jobs_start_from_the_latest_solution(self):
+        spec = """
+            MyDataStructure:
+
+                state elements : Bag<Int>
+
+                query containsZero()
+                    exists [x | x <- elements, x == 0]
+
+                op addElement(x : Int)
+                    elements.add(x);
+        """
+
+        spec = parse_spec(spec)
+        errs = typecheck(spec)
+        assert not errs, str(errs)
+        spec = desugar(spec)
+        impl = construct_initial_implementation(spec)
+        q, = [q for q in impl.query_specs if q.name == "containsZero"]
+        job = high_level_interface.ImproveQueryJob(impl.abstract_state, [], q, context=impl.context_for_method(q))
+        elements, = impl.abstract_state
+        v = EVar("_hasZero").with_type(BOOL)
+        job.note_solution([(v, EIn(ZERO, elements).with_type(BOOL))], v)
+        solution = EStateVar(EIn(ZERO, elements).with_type(BOOL)).with_type(BOOL)
+        self.assertEqual(job.latest, solution)
+        self.assertEqual(job.q.ret, solution)
+        assert not job.report_initial
+        assert job.last_improvement is not None
+        # the query itself is not modified
+        self.assertNotEqual(q.ret, solution)
@@ -0,0 +1,38 @@
+import unittest
+
+from cozy.target_syntax import *
+from cozy.syntax_tools import mk_lambda
+from cozy.structures.heaps import TMinHeap
+from cozy import wire
+
+class TestWire(unittest.TestCase):
+
+    def test_round_trip(self):
+        x = EVar("x").with_type(TBag(INT))
+        e = EMap(x, mk_lambda(INT, lambda v: EBinOp(v, "+", ONE).with_type(INT))).with_type(TBag(INT))
+        message = ("solution", [(EVar("y").with_type(INT), ELen(x).with_type(INT))], e, {"k": 1.5})
+        res = wire.decode(wire.encode(message))
+        assert res == message
+        assert res[2].type == e.type
+        assert res[2].transform_function.body.type == INT
+        assert res[1][0][1].type == INT
+
+    def test_types_are_sent_once(self):
+        t = TMap(TRecord((("a", INT), ("b", TList(TString())))), TBag(THandle("H", INT)))
+        enc = wire.Encoder()
+        dec = wire.Decoder()
+        first = enc.encode(EVar("x").with_type(t))
+        second = enc.encode(EVar("y").with_type(t))
+        assert len(second) < len(first)
+        assert dec.decode(first).type == t
+        y = dec.decode(second)
+        assert y == EVar("y")
+        assert y.type == t
+
+    def test_failed_encode_leaves_encoder_unchanged(self):
+        enc = wire.Encoder()
+        dec = wire.Decoder()
+        with self.assertRaises(Exception):
+            enc.encode((EVar("x").with_type(TMinHeap(INT, INT)), lambda: 0))
+        x = dec.decode(enc.encode(EVar("x").with_type(TMinHeap(INT, INT))))
+        assert x.type == TMinHeap(INT, INT)